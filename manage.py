@@ -10,9 +10,10 @@ from flask_script.commands import ShowUrls, Clean
 
 from flask_migrate import Migrate, MigrateCommand
 
-from server import create_app, generate
-from server.models import db, User, Course, Version
+from server import create_app, generate, jobs
+from server.models import db, User, Course, Version, Assignment, AssignmentStats
 from server.extensions import assets_env, cache
+from server.jobs import similarity
 
 # default to dev config
 env = os.environ.get('OK_ENV', 'dev')
@@ -53,6 +54,18 @@ def cacheflush():
         cache.clear()
         print("Flushed")
 
+@manager.command
+def cache_stats():
+    """ Show how often each memoized function is served from each tier. """
+    with app.app_context():
+        row_format = '{:<60} {:>10} {:>10} {:>10} {:>8}'
+        print(row_format.format('FUNCTION', 'LOCAL', 'SHARED', 'MISSES', 'HIT RATE'))
+        for name, stats in sorted(cache.memoize_stats().items()):
+            hit_rate = stats['hit_rate']
+            hit_rate = '{:.1%}'.format(hit_rate) if hit_rate is not None else '-'
+            print(row_format.format(name, stats['local_hits'], stats['shared_hits'],
+                                    stats['misses'], hit_rate))
+
 @manager.command
 def setup_default():
     admin = User(email="sumukh@berkeley.edu", is_admin=True)
@@ -111,9 +124,36 @@ def generate_session_key():
     """
     return binascii.hexlify(os.urandom(24))
 
+@manager.option('-a', '--assignment', dest='assignment_id', type=int, default=None)
+def index_submissions(assignment_id=None):
+    """ Add submissions that are not in the fingerprint index yet. Safe to
+    run repeatedly, e.g. nightly or after importing a past semester.
+    """
+    with app.app_context():
+        count = similarity.index_submissions(assignment_id)
+        print("Indexed {} submissions".format(count))
+
+@manager.option('-a', '--assignment', dest='assignment_id', type=int, default=None)
+def reconcile_stats(assignment_id=None):
+    """ Apply pending changes to the statistics counters, then recompute the
+    counters of active assignments (or of ASSIGNMENT_ID) and of assignments
+    whose counters are stale, to correct any drift. Run every few minutes by
+    the ok-reconcile-stats CronJob.
+    """
+    with app.app_context():
+        stale_ids = AssignmentStats.apply_changes()
+        if assignment_id is not None:
+            assignment_ids = {assignment_id}
+        else:
+            assignment_ids = {a.id for a in Assignment.query if a.active}
+        assignment_ids.update(stale_ids)
+        for aid in sorted(assignment_ids):
+            AssignmentStats.reconcile(aid)
+        print("Reconciled statistics of {} assignments".format(len(assignment_ids)))
+
 @manager.command
 def worker():
-    get_worker().work()
+    get_worker(*jobs.WORKER_QUEUES).work()
 
 if __name__ == "__main__":
     manager.run()
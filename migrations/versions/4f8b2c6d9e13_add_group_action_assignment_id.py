@@ -0,0 +1,43 @@
+"""Add group_action.assignment_id and canvas_assignment.synced
+
+Revision ID: 4f8b2c6d9e13
+Revises: c7a4e1b9d3f2
+Create Date: 2026-10-19 01:04:52.118337
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f8b2c6d9e13'
+down_revision = 'c7a4e1b9d3f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('group_action', sa.Column('assignment_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(op.f('fk_group_action_assignment_id_assignment'), 'group_action', 'assignment', ['assignment_id'], ['id'])
+    op.execute('''
+    UPDATE group_action
+    SET assignment_id = JSON_EXTRACT(group_before, '$.assignment_id')
+    ''')
+    op.drop_index(op.f('ix_group_action_created'), table_name='group_action')
+    op.create_index('ix_group_action_assignment_id_created', 'group_action', ['assignment_id', 'created'], unique=False)
+
+    op.add_column('canvas_assignment', sa.Column('synced', sa.DateTime(timezone=True), nullable=True))
+    # Start from the oldest sync, like uploads did before
+    op.execute('''
+    UPDATE canvas_assignment AS a
+    JOIN (SELECT canvas_assignment_id, MIN(synced) AS synced
+          FROM canvas_grade GROUP BY canvas_assignment_id) AS g
+      ON g.canvas_assignment_id = a.id
+    SET a.synced = g.synced
+    ''')
+
+
+def downgrade():
+    op.drop_column('canvas_assignment', 'synced')
+    op.drop_index('ix_group_action_assignment_id_created', table_name='group_action')
+    op.create_index(op.f('ix_group_action_created'), 'group_action', ['created'], unique=False)
+    op.drop_constraint(op.f('fk_group_action_assignment_id_assignment'), 'group_action', type_='foreignkey')
+    op.drop_column('group_action', 'assignment_id')
@@ -0,0 +1,24 @@
+"""Count group changes in assignment_stats_change
+
+Revision ID: 8a3e5d1c7f64
+Revises: 4f8b2c6d9e13
+Create Date: 2026-10-19 02:12:37.804519
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a3e5d1c7f64'
+down_revision = '4f8b2c6d9e13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('assignment_stats_change', sa.Column('groups', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('assignment_stats_change', sa.Column('active_groups', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('assignment_stats_change', 'active_groups')
+    op.drop_column('assignment_stats_change', 'groups')
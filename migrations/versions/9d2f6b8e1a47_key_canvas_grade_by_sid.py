@@ -0,0 +1,39 @@
+"""Key canvas_grade by SID and index group_action.created
+
+Revision ID: 9d2f6b8e1a47
+Revises: 3b7d1e9a4c62
+Create Date: 2026-10-18 22:41:19.204377
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d2f6b8e1a47'
+down_revision = '3b7d1e9a4c62'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The foreign key needs an index on canvas_assignment_id while the
+    # primary key is replaced
+    op.drop_constraint(op.f('fk_canvas_grade_canvas_assignment_id_canvas_assignment'), 'canvas_grade', type_='foreignkey')
+    op.drop_constraint(op.f('pk_canvas_grade'), 'canvas_grade', type_='primary')
+    op.alter_column('canvas_grade', 'canvas_user_id',
+               existing_type=sa.Integer(),
+               nullable=True)
+    op.create_primary_key(op.f('pk_canvas_grade'), 'canvas_grade', ['canvas_assignment_id', 'sid'])
+    op.create_foreign_key(op.f('fk_canvas_grade_canvas_assignment_id_canvas_assignment'), 'canvas_grade', 'canvas_assignment', ['canvas_assignment_id'], ['id'])
+    op.create_index(op.f('ix_group_action_created'), 'group_action', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_group_action_created'), table_name='group_action')
+    op.execute('DELETE FROM canvas_grade WHERE canvas_user_id IS NULL')
+    op.drop_constraint(op.f('fk_canvas_grade_canvas_assignment_id_canvas_assignment'), 'canvas_grade', type_='foreignkey')
+    op.drop_constraint(op.f('pk_canvas_grade'), 'canvas_grade', type_='primary')
+    op.alter_column('canvas_grade', 'canvas_user_id',
+               existing_type=sa.Integer(),
+               nullable=False)
+    op.create_primary_key(op.f('pk_canvas_grade'), 'canvas_grade', ['canvas_assignment_id', 'canvas_user_id'])
+    op.create_foreign_key(op.f('fk_canvas_grade_canvas_assignment_id_canvas_assignment'), 'canvas_grade', 'canvas_assignment', ['canvas_assignment_id'], ['id'])
@@ -10,6 +10,7 @@ import json
 import logging
 import time
 
+from flask_rq import get_connection
 import oauthlib.common
 import requests
 
@@ -61,28 +62,34 @@ def create_autograder_token(user_id):
     db.session.commit()
     return token
 
-def send_batch(token, assignment, backup_ids, priority='default'):
+def send_batch(token, assignment, backup_ids, priority='default',
+               callback_url=None):
     """Send a batch of backups to the autograder, returning a dict mapping
-    backup ID -> autograder job ID.
+    backup ID -> autograder job ID. If CALLBACK_URL is given, the autograder
+    posts job status changes to it (see api.AutograderResult).
     """
     if not assignment.autograding_key:
         raise ValueError('Assignment has no autograder key')
 
-    response_json = send_autograder('/api/ok/v3/grade/batch', {
+    data = {
         'subm_ids': [utils.encode_id(bid) for bid in backup_ids],
         'assignment': assignment.autograding_key,
         'access_token': token.access_token,
         'priority': priority,
         'ok-server-version': 'v3',
-    })
+    }
+    if callback_url:
+        data['callback_url'] = callback_url
+    response_json = send_autograder('/api/ok/v3/grade/batch', data)
     if response_json:
         return dict(zip(backup_ids, response_json['jobs']))
     else:
         return {}
     
-def autograde_backup(token, assignment, backup_id):
+def autograde_backup(token, assignment, backup_id, callback_url=None):
     """Autograde a backup, returning and autograder job ID."""
-    jobs = send_batch(token, assignment, [backup_id], priority='high')
+    jobs = send_batch(token, assignment, [backup_id], priority='high',
+                      callback_url=callback_url)
     return jobs.get(backup_id)
 
 def submit_continous(backup):
@@ -116,6 +123,50 @@ def check_job_results(job_ids):
     """
     return send_autograder('/results', job_ids)
 
+def job_results_key(assignment_id):
+    return 'autograder:results:{}'.format(assignment_id)
+
+def record_job_result(assignment_id, job_id, status):
+    """Called when the autograder reports that job JOB_ID for an assignment
+    has a new STATUS. The result is picked up by autograde_assignment.
+    """
+    key = job_results_key(assignment_id)
+    connection = get_connection()
+    connection.rpush(key, json.dumps({'job_id': job_id, 'status': status}))
+    connection.expire(key, RESULTS_TTL)
+
+def receive_job_results(assignment_id, timeout):
+    """Wait up to TIMEOUT seconds for the autograder to report job results
+    for an assignment. Return a dict mapping job IDs to results (in the same
+    format as check_job_results), which is empty if nothing was reported.
+    """
+    key = job_results_key(assignment_id)
+    connection = get_connection()
+    item = connection.blpop(key, timeout=timeout)
+    if not item:
+        return {}
+    values = [item[1]]
+    value = connection.lpop(key)
+    while value is not None:
+        values.append(value)
+        value = connection.lpop(key)
+    results = {}
+    for value in values:
+        result = json.loads(value.decode('utf-8'))
+        results[result['job_id']] = result
+    return results
+
+def scored_backups(backup_ids, since):
+    """Return the set of BACKUP_IDS that have received a score after SINCE."""
+    if not backup_ids:
+        return set()
+    query = db.session.query(Score.backup_id).filter(
+        Score.backup_id.in_(backup_ids),
+        Score.archived == False,
+        Score.created > since
+    ).distinct()
+    return {backup_id for backup_id, in query}
+
 GradingStatus = enum.Enum('GradingStatus', [
     'QUEUED',   # a job is queued
     'RUNNING',  # a job is running
@@ -146,11 +197,18 @@ MAX_RETRIES = 3           # maximum number of times to retry a score
 QUEUED_TIMEOUT = 30 * 60  # maximum time or an autograder job to be queued for, in seconds
 RUNNING_TIMEOUT = 5 * 60  # time to wait for an autograder job to run, in seconds
 WAITING_TIMEOUT = 2 * 60  # time to wait for a score, in seconds
-POLL_INTERVAL = 10        # how often to poll the autograder, in seconds
+# how long to wait for pushed results between timeout checks, in seconds
+POLL_INTERVAL = 10
+# how often to poll the autograder for results it has not pushed, in seconds
+RECONCILE_INTERVAL = 60
+# how long pushed results are kept if nobody reads them, in seconds
+RESULTS_TTL = 24 * 60 * 60
 
-@jobs.background_job
-def autograde_assignment(assignment_id):
-    """Autograde all enrolled students for this assignment.
+@jobs.background_job(queue='bulk', singleton=True)
+def autograde_assignment(assignment_id, callback_url=None):
+    """Autograde all enrolled students for this assignment. The autograder
+    pushes results to CALLBACK_URL, and the autograder is polled only for
+    jobs it has not reported on.
 
     We set up a state machine for each backup to check its progress through
     the autograder. If any step takes too long, we'll retry autograding that
@@ -166,7 +224,7 @@ def autograde_assignment(assignment_id):
 
     # start by sending a batch of all backups
     start_time = time.time()
-    job_ids = send_batch(token, assignment, backup_ids)
+    job_ids = send_batch(token, assignment, backup_ids, callback_url=callback_url)
     tasks = [
         GradingTask(
             status=GradingStatus.QUEUED,
@@ -185,24 +243,40 @@ def autograde_assignment(assignment_id):
             task.set_status(GradingStatus.FAILED)
         else:
             task.set_status(GradingStatus.QUEUED)
-            task.job_id = autograde_backup(token, assignment, task.backup_id)
+            task.job_id = autograde_backup(token, assignment, task.backup_id,
+                                           callback_url)
             task.retries += 1
 
+    results = {}
+    last_reconcile = start_time
+    last_graded = None
     while True:
-        time.sleep(POLL_INTERVAL)
-        results = check_job_results([task.job_id for task in tasks])
+        # The autograder pushes results to record_job_result as jobs change
+        # status. Polling it is only a fallback for results that get lost.
+        results.update(receive_job_results(assignment_id, POLL_INTERVAL))
+        if time.time() > last_reconcile + RECONCILE_INTERVAL:
+            last_reconcile = time.time()
+            results.update(check_job_results([task.job_id for task in tasks
+                if task.status in (GradingStatus.QUEUED, GradingStatus.RUNNING)]))
 
         graded = len([task for task in tasks
             if task.status in (GradingStatus.DONE, GradingStatus.FAILED)])
-        logger.info('Graded {:>4}/{} ({:>5.1f}%)'.format(
-            graded, num_tasks, 100 * graded / num_tasks))
+        if graded != last_graded:
+            last_graded = graded
+            logger.info('Graded {:>4}/{} ({:>5.1f}%)'.format(
+                graded, num_tasks, 100 * graded / num_tasks))
+            jobs.report_progress(graded, num_tasks)
         if graded == num_tasks:
             break
 
+        scored = scored_backups(
+            [task.backup_id for task in tasks if task.status == GradingStatus.WAITING],
+            datetime.datetime.fromtimestamp(start_time))
+
         for task in tasks:
             hashid = utils.encode_id(task.backup_id)
             if task.status == GradingStatus.QUEUED:
-                result = results[task.job_id]
+                result = results.get(task.job_id, {'status': 'queued'})
                 if not result:
                     logger.warning('Autograder job {} disappeared, retrying'.format(task.job_id))
                     retry_task(task)
@@ -215,7 +289,7 @@ def autograde_assignment(assignment_id):
                         task.job_id, QUEUED_TIMEOUT))
                     retry_task(task)
             elif task.status == GradingStatus.RUNNING:
-                result = results[task.job_id]
+                result = results.get(task.job_id, {'status': 'started'})
                 if not result:
                     logger.warning('Autograder job {} disappeared, retrying'.format(task.job_id))
                     retry_task(task)
@@ -231,12 +305,7 @@ def autograde_assignment(assignment_id):
                         task.job_id, RUNNING_TIMEOUT))
                     retry_task(task)
             elif task.status == GradingStatus.WAITING:
-                score = Score.query.filter(
-                    Score.backup_id == task.backup_id,
-                    Score.archived == False,
-                    Score.created > datetime.datetime.fromtimestamp(start_time)
-                ).first()
-                if score:
+                if task.backup_id in scored:
                     logger.debug('Received score for backup {}'.format(hashid))
                     task.set_status(GradingStatus.DONE)
                 elif task.expired(WAITING_TIMEOUT):
@@ -0,0 +1,405 @@
+""" A two-tier cache for memoized functions.
+
+Values memoized with cache.memoize are kept for a few seconds in a small
+LRU cache in each process, in front of the shared (Redis) cache, so hot
+functions like User.is_enrolled do not go to Redis on every call. When
+cache.delete_memoized is called, the entries are dropped from the local
+cache of every process through Redis pub/sub. The local timeout bounds how
+stale a value can be if an invalidation message is missed. Like Redis, the
+local cache holds pickled copies, so callers never share an object (such as
+a model instance that a later commit expires).
+
+With single_flight=True, when a memoized value expires only one process
+recomputes it, under a short lock, while the others keep returning the
+stale value. Values are also refreshed early with a probability that grows
+as they get closer to expiring and the longer they took to compute
+(Vattani, Chierichetti and Lowenstein, "Optimal Probabilistic Cache
+Stampede Prevention"), so hot values are usually replaced before they
+expire at all.
+
+A memoized function can also name a scope for each call, like the user and
+course that is_enrolled depends on. The version of the scope is part of the
+cache key, so cache.invalidate_scope replaces only the entries in that scope
+instead of every cached value of the function.
+"""
+import collections
+import functools
+import inspect
+import json
+import logging
+import math
+import os
+import pickle
+import random
+import threading
+import time
+
+from flask_caching import Cache
+import redis
+
+from server.constants import (LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT,
+                              CACHE_STATS_FLUSH_INTERVAL, SINGLE_FLIGHT_BETA,
+                              SINGLE_FLIGHT_LOCK_TIMEOUT,
+                              SINGLE_FLIGHT_STALE_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache-invalidate'
+STATS_KEY = 'cache-stats'
+STATS_KINDS = ('local_hits', 'shared_hits', 'misses')
+# how long to wait before resubscribing after an error, in seconds
+RECONNECT_INTERVAL = 5
+
+class LRUCache:
+    """A thread-safe in-process cache that holds at most MAXSIZE entries,
+    evicting the least recently used one first. Entries can also expire
+    after a timeout.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            value, expires = self._entries[key]
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Delete every entry whose key satisfies PREDICATE."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def function_name(f):
+    return '{}.{}'.format(f.__module__, f.__qualname__)
+
+def scope_key(scope):
+    return 'scope-version/' + '/'.join(str(part) for part in scope)
+
+def suffixed_name(make_name, suffix):
+    """Return a make_name function for memoize that appends SUFFIX() to the
+    name given by MAKE_NAME, or to the function name.
+    """
+    def name(fname):
+        return (make_name(fname) if make_name else fname) + suffix()
+    return name
+
+def single_flight_entry(entry):
+    """Return ENTRY if it is a (value, expiry time, duration) tuple stored by
+    _single_flight, or None otherwise.
+    """
+    if isinstance(entry, tuple) and len(entry) == 3:
+        return entry
+
+def argument_key(arg):
+    """Identify an argument the way flask_caching does in memoized keys."""
+    return getattr(arg, '__caching_id__', lambda: repr(arg))()
+
+class TwoTierCache(Cache):
+    """A flask_caching Cache whose memoized functions also keep values in a
+    per-process LRU cache for up to LOCAL_CACHE_TIMEOUT seconds. Pass
+    local=False to memoize to skip the local cache for a function.
+
+    Pass scope=SCOPE to memoize to version entries by SCOPE(*args, **kwargs),
+    a tuple such as ('enrollment', user_id, course_id). Pass single_flight=True
+    to protect an expensive function from cache stampedes.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = {}  # function name -> LRUCache
+        self._versions = LRUCache(LOCAL_CACHE_SIZE)  # scope key -> version
+        self._stats = collections.defaultdict(collections.Counter)
+        self._unflushed = collections.defaultdict(collections.Counter)
+        self._stats_lock = threading.Lock()
+        self._last_flush = time.time()
+        self._client = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def init_app(self, app, config=None):
+        super().init_app(app, config)
+        self._client = None
+        if app.config.get('CACHE_TYPE') == 'redis':
+            if app.config.get('CACHE_REDIS_URL'):
+                self._client = redis.StrictRedis.from_url(app.config['CACHE_REDIS_URL'])
+            else:
+                self._client = redis.StrictRedis(
+                    host=app.config.get('CACHE_REDIS_HOST', 'localhost'),
+                    port=app.config.get('CACHE_REDIS_PORT', 6379),
+                    password=app.config.get('CACHE_REDIS_PASSWORD'),
+                    db=app.config.get('CACHE_REDIS_DB', 0))
+        self._listener_pid = None
+        self.clear_local()
+
+    def memoize(self, timeout=None, *args, local=True, scope=None,
+                single_flight=False, **kwargs):
+        if single_flight and not timeout:
+            raise ValueError('single_flight needs a timeout')
+        version = threading.local()
+        if single_flight:
+            # Keep (value, expiry, duration) entries apart from the plain
+            # values memoized before single_flight was turned on
+            kwargs['make_name'] = suffixed_name(kwargs.get('make_name'),
+                                                lambda: '/single-flight')
+        if scope:
+            kwargs['make_name'] = suffixed_name(
+                kwargs.get('make_name'),
+                lambda: '@{}'.format(getattr(version, 'current', 0)))
+        memoize = super().memoize(timeout, *args, **kwargs)
+
+        def decorator(f):
+            name = function_name(f)
+            stats = self._stats[name]
+            local_cache = self._local[name] = LRUCache(LOCAL_CACHE_SIZE)
+            local_timeout = min(timeout or LOCAL_CACHE_TIMEOUT, LOCAL_CACHE_TIMEOUT)
+
+            def count(kind):
+                # _flush_stats replaces self._unflushed, so look it up each time
+                with self._stats_lock:
+                    stats[kind] += 1
+                    self._unflushed[name][kind] += 1
+
+            # Count the calls that reach F, i.e. misses in both caches
+            @functools.wraps(f)
+            def computed(*args, **kwargs):
+                count('misses')
+                return f(*args, **kwargs)
+            computed.__signature__ = inspect.signature(f)
+            memoized = memoize(computed)
+            if single_flight:
+                fetch = functools.partial(self._single_flight, memoized,
+                                          computed, timeout)
+            else:
+                fetch = memoized
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                key = None
+                if local or scope:
+                    self._start_listener()
+                if scope:
+                    version.current = self.scope_version(scope(*args, **kwargs))
+                if local:
+                    key = (tuple(argument_key(arg) for arg in args) +
+                           tuple(sorted((k, argument_key(v))
+                                        for k, v in kwargs.items())))
+                    if scope:
+                        key += (version.current,)
+                    data = local_cache.get(key)
+                    if data is not None:
+                        count('local_hits')
+                        self._flush_stats()
+                        return pickle.loads(data)
+                misses = stats['misses']
+                value = fetch(*args, **kwargs)
+                if stats['misses'] == misses:
+                    count('shared_hits')
+                if local and value is not None:
+                    local_cache.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                    local_timeout)
+                self._flush_stats()
+                return value
+
+            decorated_function.__signature__ = inspect.signature(f)
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.make_cache_key = memoized.make_cache_key
+            decorated_function.delete_memoized = lambda: self.delete_memoized(f)
+            return decorated_function
+        return decorator
+
+    def _single_flight(self, memoized, computed, timeout, *args, **kwargs):
+        """ Return the value of a memoized function with single_flight=True.
+        The shared cache holds (value, expiry time, time taken to compute),
+        and keeps it for SINGLE_FLIGHT_STALE_TIMEOUT seconds after it expires.
+        """
+        try:
+            key = memoized.make_cache_key(computed, *args, **kwargs)
+            entry = single_flight_entry(self.cache.get(key))
+        except Exception:
+            logger.exception('Exception possibly due to cache backend.')
+            return computed(*args, **kwargs)
+        lock_key = key + '/lock'
+        locked = False
+        if entry is not None:
+            value, expires, duration = entry
+            # Refresh early with a probability that grows as the value gets
+            # closer to expiring, and for values that are slow to compute
+            early = duration * SINGLE_FLIGHT_BETA * -math.log(1 - random.random())
+            if time.time() + early < expires:
+                return value
+            try:
+                locked = self.cache.add(lock_key, True,
+                                        timeout=SINGLE_FLIGHT_LOCK_TIMEOUT)
+            except Exception:
+                logger.exception('Exception possibly due to cache backend.')
+            if not locked:
+                # Another process is recomputing the value
+                return value
+
+        start = time.time()
+        try:
+            value = computed(*args, **kwargs)
+            duration = time.time() - start
+            try:
+                self.cache.set(key, (value, time.time() + timeout, duration),
+                               timeout=timeout + SINGLE_FLIGHT_STALE_TIMEOUT)
+            except Exception:
+                logger.exception('Exception possibly due to cache backend.')
+        finally:
+            if locked:
+                self.cache.delete(lock_key)
+        return value
+
+    def delete_memoized(self, f, *args, **kwargs):
+        super().delete_memoized(f, *args, **kwargs)
+        instance = getattr(f, '__self__', None)
+        if instance is not None and not inspect.isclass(instance):
+            args = (instance,) + args
+        message = {
+            'name': function_name(getattr(f, '__func__', f)),
+            'instance': argument_key(args[0]) if args else None,
+        }
+        self._publish(message)
+
+    def scope_version(self, scope):
+        key = scope_key(scope)
+        version = self._versions.get(key)
+        if version is None:
+            version = self.cache.get(key) or 0
+            self._versions.set(key, version, LOCAL_CACHE_TIMEOUT)
+        return version
+
+    def invalidate_scope(self, *scope):
+        """Replace the cached values of every memoized function for SCOPE,
+        e.g. cache.invalidate_scope('enrollment', user.id, course.id).
+        """
+        key = scope_key(scope)
+        self.cache.inc(key)
+        message = {'scope': key}
+        self._publish(message)
+
+    def _publish(self, message):
+        """Apply an invalidation MESSAGE here and in every other process."""
+        self._invalidate(message)
+        if self._client:
+            try:
+                self._client.publish(INVALIDATION_CHANNEL, json.dumps(message))
+            except redis.exceptions.ConnectionError:
+                logger.exception('Could not publish cache invalidation')
+
+    def clear_local(self):
+        for local_cache in self._local.values():
+            local_cache.clear()
+        self._versions.clear()
+
+    def _invalidate(self, message):
+        """Drop the local version of a scope, or local entries for a memoized
+        function, or only those whose first argument (usually self) is
+        INSTANCE.
+        """
+        if 'scope' in message:
+            self._versions.delete(message['scope'])
+            return
+        local_cache = self._local.get(message['name'])
+        if not local_cache:
+            return
+        if message['instance'] is None:
+            local_cache.clear()
+        else:
+            local_cache.delete_matching(lambda key: key[:1] == (message['instance'],))
+
+    def _start_listener(self):
+        """Subscribe to invalidations once in each process (e.g. after a
+        gunicorn worker forks).
+        """
+        if not self._client or self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            listener = threading.Thread(target=self._listen, args=(self._client,),
+                                        daemon=True)
+            listener.start()
+
+    def _listen(self, client):
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations may have been missed while disconnected
+                self.clear_local()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._invalidate(json.loads(message['data'].decode('utf-8')))
+            except redis.exceptions.ConnectionError:
+                logger.warning('Lost cache invalidation subscription, retrying')
+                time.sleep(RECONNECT_INTERVAL)
+
+    def _flush_stats(self, force=False):
+        """Add the hit counts since the last flush to the site-wide totals
+        in Redis, at most every CACHE_STATS_FLUSH_INTERVAL seconds.
+        """
+        if not self._client:
+            return
+        if not force and time.time() < self._last_flush + CACHE_STATS_FLUSH_INTERVAL:
+            return
+        self._last_flush = time.time()
+        with self._stats_lock:
+            unflushed = self._unflushed
+            self._unflushed = collections.defaultdict(collections.Counter)
+        try:
+            pipe = self._client.pipeline(transaction=False)
+            for name, counts in unflushed.items():
+                for kind, n in counts.items():
+                    pipe.hincrby(STATS_KEY, '{}:{}'.format(name, kind), n)
+            pipe.execute()
+        except redis.exceptions.ConnectionError:
+            logger.exception('Could not save cache statistics')
+
+    def memoize_stats(self):
+        """Return a dict mapping each memoized function to its number of
+        local hits, shared hits and misses, and its overall hit rate. Counts
+        are for the whole site if Redis is used, or this process otherwise.
+        """
+        if self._client:
+            self._flush_stats(force=True)
+            totals = collections.defaultdict(collections.Counter)
+            for field, n in self._client.hgetall(STATS_KEY).items():
+                name, _, kind = field.decode('utf-8').rpartition(':')
+                totals[name][kind] = int(n)
+        else:
+            totals = self._stats
+        stats = {}
+        for name, counts in totals.items():
+            calls = sum(counts[kind] for kind in STATS_KINDS)
+            stats[name] = dict({kind: counts[kind] for kind in STATS_KINDS},
+                               hit_rate=1 - counts['misses'] / calls if calls else None)
+        return stats
@@ -1,30 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
+from server import utils
 from server.extensions import cache
 
+API_SCHEME = 'https'        # changed by tests to use a local fake Canvas server
+MAX_WORKERS = 8             # maximum number of pages fetched at once
+PAGE_SIZE = 100             # number of items requested per page
+RETRIES = 5                 # number of times to retry a request that failed
+# retries wait 0.5, 1, 2, ... seconds (or as long as Retry-After says)
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+GRADE_BATCH_SIZE = 500      # number of grades sent to update_grades at a time
+PROGRESS_POLL_INTERVAL = 2  # how often to check on a batch of grades, in seconds
+PROGRESS_TIMEOUT = 10 * 60  # how long to wait for a batch of grades, in seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return the requests Session shared by all Canvas API calls in this
+    process, so that connections are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS,
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.headers['Accept'] = 'application/json'
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+def api_url(canvas_course, endpoint):
+    return '{}://{}/api/v1{}'.format(API_SCHEME, canvas_course.api_domain, endpoint)
+
+def auth_headers(canvas_course):
+    return {'Authorization': 'Bearer ' + canvas_course.access_token}
+
 def canvas_api_request(canvas_course, method, endpoint, **kwargs):
-    url = 'https://' + canvas_course.api_domain + '/api/v1' + endpoint
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': 'Bearer ' + canvas_course.access_token,
-    }
-    response = requests.request(method, url, headers=headers, **kwargs)
+    response = get_session().request(
+        method, api_url(canvas_course, endpoint),
+        headers=auth_headers(canvas_course), **kwargs)
     response.raise_for_status()
     return response.json()
 
+def page_urls(response):
+    """Return the URLs of the pages after RESPONSE, if Canvas says how many
+    pages there are, or None otherwise (e.g. for bookmark pagination).
+    """
+    if 'next' not in response.links or 'last' not in response.links:
+        return None
+    next_url = urlparse(response.links['next']['url'])
+    last_url = urlparse(response.links['last']['url'])
+    query = parse_qs(last_url.query)
+    try:
+        first = int(parse_qs(next_url.query)['page'][0])
+        last = int(query['page'][0])
+    except (KeyError, ValueError):
+        return None
+    return [last_url._replace(query=urlencode(dict(query, page=[page]),
+                                              doseq=True)).geturl()
+            for page in range(first, last + 1)]
+
 def canvas_api_get_list(canvas_course, endpoint, **kwargs):
-    url = 'https://' + canvas_course.api_domain + '/api/v1' + endpoint
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': 'Bearer ' + canvas_course.access_token,
-    }
+    """Get every page of a list endpoint. If the number of pages is known,
+    the rest of the pages are fetched in parallel, otherwise the next links
+    are followed one at a time.
+    """
+    session = get_session()
+    headers = auth_headers(canvas_course)
     params = kwargs.pop('params', {})
-    params['per_page'] = 100
-    response = requests.get(url, headers=headers, params=params, **kwargs)
+    params['per_page'] = PAGE_SIZE
+    response = session.get(api_url(canvas_course, endpoint), headers=headers,
+                           params=params, **kwargs)
     response.raise_for_status()
     results = response.json()
+
+    def get_page(url):
+        response = session.get(url, headers=headers, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    urls = page_urls(response)
+    if urls:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for page in executor.map(get_page, urls):
+                results.extend(page)
+        return results
     while 'next' in response.links:
-        response = requests.get(response.links['next']['url'], headers=headers)
+        response = session.get(response.links['next']['url'], headers=headers,
+                               **kwargs)
         response.raise_for_status()
         results.extend(response.json())
     return results
@@ -106,21 +182,42 @@ def get_scores(canvas_assignment):
     )
     return {score['user_id']: score['score'] for score in results}
 
+def wait_for_progress(canvas_course, progress):
+    """Poll a Canvas Progress object until it has completed. Raise an
+    exception if it fails or does not finish within PROGRESS_TIMEOUT seconds.
+    """
+    # https://bcourses.berkeley.edu/doc/api/progress.html
+    deadline = time.time() + PROGRESS_TIMEOUT
+    while progress['workflow_state'] not in ('completed', 'failed'):
+        if time.time() > deadline:
+            raise TimeoutError('Canvas did not finish updating grades in {} seconds'
+                               .format(PROGRESS_TIMEOUT))
+        time.sleep(PROGRESS_POLL_INTERVAL)
+        progress = canvas_api_request(
+            canvas_course, 'GET', '/progress/{}'.format(progress['id']))
+    if progress['workflow_state'] == 'failed':
+        raise ValueError('Canvas could not update grades: {}'.format(
+            progress.get('message')))
+    return progress
+
 def put_scores(canvas_assignment, grade_data):
-    """Get scores for an assignment. GRADE_DATA should be a dict of
-    (Canvas user ID -> float).
+    """Set scores for an assignment. GRADE_DATA should be a dict of
+    (Canvas user ID -> float). Scores are sent GRADE_BATCH_SIZE at a time,
+    waiting for Canvas to finish each batch.
     """
     # https://bcourses.berkeley.edu/doc/api/submissions.html#method.submissions_api.bulk_update
-    # TODO do something with returned job progress
-    canvas_grade_data = {
-        uid: {'posted_grade': score} for uid, score in grade_data.items()
-    }
-    canvas_api_request(
-        canvas_assignment.canvas_course,
-        'POST',
-        '/courses/{}/assignments/{}/submissions/update_grades'.format(
-            canvas_assignment.canvas_course.external_id,
-            canvas_assignment.external_id,
-        ),
-        json={'grade_data': canvas_grade_data},
-    )
+    canvas_course = canvas_assignment.canvas_course
+    for batch in utils.batches(sorted(grade_data), GRADE_BATCH_SIZE):
+        canvas_grade_data = {
+            uid: {'posted_grade': grade_data[uid]} for uid in batch
+        }
+        progress = canvas_api_request(
+            canvas_course,
+            'POST',
+            '/courses/{}/assignments/{}/submissions/update_grades'.format(
+                canvas_course.external_id,
+                canvas_assignment.external_id,
+            ),
+            json={'grade_data': canvas_grade_data},
+        )
+        wait_for_progress(canvas_course, progress)
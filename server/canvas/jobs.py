@@ -4,10 +4,11 @@ import requests.exceptions
 
 from server import constants, jobs
 from server.canvas import api
-from server.models import CanvasAssignment, CanvasCourse, Enrollment
+from server.models import (CanvasAssignment, CanvasCourse, CanvasGrade,
+                           Enrollment, Score, User, db)
 from server.utils import encode_id
 
-@jobs.background_job
+@jobs.background_job(singleton=True)
 def upload_scores(canvas_assignment_id):
     logger = jobs.get_job_logger()
     canvas_assignment = CanvasAssignment.query.get(canvas_assignment_id)
@@ -20,35 +21,61 @@ def upload_scores(canvas_assignment_id):
     logger.info('OK assignment: {}'.format(assignment.display_name))
     logger.info('Scores: {}'.format(', '.join(canvas_assignment.score_kinds)))
 
-    students = api.get_students(canvas_course)
-    old_scores = api.get_scores(canvas_assignment)
+    kinds = [kind for kind in canvas_assignment.score_kinds
+             if kind in assignment.published_scores]
+    # Scores created after this may not be seen by this upload
+    started = db.session.query(db.func.now()).scalar()
+    grades = {grade.sid: grade for grade in canvas_assignment.grades}
+    if grades:
+        # Only look at students whose scores changed since the last upload
+        sids = CanvasGrade.changed_sids(canvas_assignment, kinds)
+        logger.info('{} students have new or archived scores since the last upload'
+                    .format(len(sids)))
+        students = [{'id': grades[sid].canvas_user_id, 'sis_user_id': sid}
+                    for sid in sorted(sids)
+                    if sid in grades and grades[sid].canvas_user_id is not None]
+        # Students who were not on the roster last time are looked for again
+        # along with the new ones
+        missing = {sid for sid in sids if sid not in grades or
+                   grades[sid].canvas_user_id is None}
+        if missing:
+            students.extend(student for student in api.get_students(canvas_course)
+                            if student['sis_user_id'] in missing)
+        old_scores = {grade.canvas_user_id: grade.score for grade in grades.values()
+                      if grade.canvas_user_id is not None}
+        best_scores = Score.best_by_sid(assignment, kinds, sids)
+    else:
+        students = api.get_students(canvas_course)
+        old_scores = api.get_scores(canvas_assignment)
+        best_scores = Score.best_by_sid(assignment, kinds)
     new_scores = {}
     stats = collections.Counter()
 
+    emails_by_sid = collections.defaultdict(list)
+    enrollments = (db.session.query(Enrollment.sid, User.email)
+                   .join(User, User.id == Enrollment.user_id)
+                   .filter(Enrollment.course_id == canvas_course.course_id,
+                           Enrollment.role == constants.STUDENT_ROLE))
+    for sid, email in enrollments:
+        emails_by_sid[sid].append(email)
+
     row_format = '{!s:>10}  {!s:<55}  {!s:<6}  {!s:>9}  {!s:>9}'
     logger.info(row_format.format('STUDENT ID', 'EMAIL', 'BACKUP', 'OLD SCORE', 'NEW SCORE'))
 
+    synced = []
     for student in students:
         canvas_user_id = student['id']
         sid = student['sis_user_id']
-        enrollments = Enrollment.query.filter_by(
-            course_id=canvas_course.course_id,
-            sid=sid,
-            role=constants.STUDENT_ROLE,
-        ).all()
-        emails = ','.join(enrollment.user.email for enrollment in enrollments) or 'None'
-        scores = []
-        for enrollment in enrollments:
-            user_ids = assignment.active_user_ids(enrollment.user_id)
-            scores.extend(assignment.scores(user_ids))
-        scores = [s for s in scores if s.kind in canvas_assignment.score_kinds]
+        emails = ','.join(emails_by_sid.get(sid, [])) or 'None'
+        max_score = best_scores.get(sid)
         old_score = old_scores.get(canvas_user_id)
-        if not scores:
+        if not max_score:
             new_score = None
             backup_id = None
             stats['no_scores'] += 1
+            if sid in grades:
+                synced.append((canvas_user_id, sid, old_score, None))
         else:
-            max_score = max(scores, key=lambda score: score.score)
             new_score = max_score.score
             backup_id = encode_id(max_score.backup_id)
             if old_score != new_score:
@@ -56,17 +83,38 @@ def upload_scores(canvas_assignment_id):
                 stats['updated'] += 1
             else:
                 stats['not_changed'] += 1
+            synced.append((canvas_user_id, sid, new_score, max_score.id))
         logger.info(row_format.format(sid, emails, backup_id, old_score, new_score))
 
+    # Remember students with scores who are not on the roster, so that the
+    # next upload does not fetch the roster again just for them
+    on_roster = {student['sis_user_id'] for student in students}
+    not_on_roster = sorted(set(best_scores) - on_roster)
+    if not_on_roster:
+        logger.info('Not on the bCourses roster: {}'.format(', '.join(not_on_roster)))
+    synced.extend((None, sid, None, None) for sid in not_on_roster)
+
     if new_scores:
         api.put_scores(canvas_assignment, new_scores)
 
+    for canvas_user_id, sid, score, score_id in synced:
+        grade = grades.get(sid)
+        if not grade:
+            grade = CanvasGrade(canvas_assignment=canvas_assignment, sid=sid)
+            db.session.add(grade)
+        grade.canvas_user_id = canvas_user_id
+        grade.score = score
+        grade.score_id = score_id
+        grade.synced = started
+    canvas_assignment.synced = started
+    db.session.commit()
+
     stats = ('{updated} updated, {not_changed} not changed, '
              '{no_scores} no scores'.format(**stats))
     logger.info(stats)
     return stats
 
-@jobs.background_job
+@jobs.background_job(singleton=True)
 def enroll_students(canvas_course_id):
     logger = jobs.get_job_logger()
     row_format = '{email!s:<35} {name!s:<35} {sid!s:<11}'
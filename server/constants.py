@@ -47,7 +47,32 @@ FORBIDDEN_ROUTE_NAMES = [
 ]
 FORBIDDEN_ASSIGNMENT_NAMES = []
 
+# Maximum number of values in the IN (...) clause of a bulk query
+IN_QUERY_BATCH_SIZE = 500
+
+# How long (in seconds) the list of final submissions for a paginated export
+# is kept between page requests
+EXPORT_SNAPSHOT_TIMEOUT = 60 * 60  # 1 hour
+
 # Maximum file size to show in browser, in characters
 DIFF_SIZE_LIMIT = 64 * 1024  # 64KB
 SOURCE_SIZE_LIMIT = 2 * 1024 * 1024 # 2MB
+
+# Number of highlighted files kept in memory by each process, and how long
+# (in seconds) they are kept in the shared cache
+HIGHLIGHT_CACHE_SIZE = 256
+HIGHLIGHT_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # 1 week
+
+# Fingerprints in more backups than this are treated as common code when
+# looking for similar submissions (see models.Fingerprint.top_matches)
+FINGERPRINT_MAX_SHARED = 50
+
+# Memoized values kept in each process (see server/caching.py)
+LOCAL_CACHE_SIZE = 1024  # entries per memoized function
+LOCAL_CACHE_TIMEOUT = 5  # seconds
+CACHE_STATS_FLUSH_INTERVAL = 60  # how often hit counts are saved, in seconds
+# Memoized functions with single_flight=True
+SINGLE_FLIGHT_LOCK_TIMEOUT = 60  # longest a recomputation can hold the lock, in seconds
+SINGLE_FLIGHT_STALE_TIMEOUT = 10 * 60  # how long a stale value may be served, in seconds
+SINGLE_FLIGHT_BETA = 1.0  # higher values refresh values earlier before they expire
 MAX_UPLOAD_FILE_SIZE = 25 * 1024 * 1024 # 25MB
@@ -1,10 +1,11 @@
 import collections
 import csv
+import itertools
 from functools import wraps
 from io import StringIO
 
 from flask import (Blueprint, render_template, flash, redirect, Response,
-                   url_for, abort, request, stream_with_context)
+                   jsonify, url_for, abort, request, stream_with_context)
 from werkzeug.exceptions import BadRequest
 
 from flask_login import current_user, login_required
@@ -17,7 +18,7 @@ from server import autograder
 import server.controllers.api as ok_api
 from server.models import (User, Course, Assignment, Enrollment, Version,
                            GradingTask, Backup, Score, Group, Client, Job,
-                           Message, CanvasCourse, CanvasAssignment, db)
+                           Message, CanvasCourse, CanvasAssignment, Fingerprint, db)
 from server.constants import (INSTRUCTOR_ROLE, STAFF_ROLES, STUDENT_ROLE,
                               LAB_ASSISTANT_ROLE, SCORE_KINDS)
 
@@ -27,7 +28,9 @@ from server.extensions import cache
 import server.forms as forms
 import server.jobs as jobs
 import server.jobs.example as example
+import server.jobs.export as export
 import server.jobs.moss as moss
+import server.jobs.similarity as similarity
 import server.jobs.github_search as github_search
 
 import server.highlight as highlight
@@ -131,6 +134,11 @@ def grading_view(backup, form=None, is_composition=False):
         files[filename] = ex_file
 
     group = [User.query.get(o) for o in backup.owners()]
+    if current_user.is_admin:
+        course_ids = None
+    else:
+        course_ids = [e.course_id for e in current_user.enrollments(roles=STAFF_ROLES)]
+    similar = Fingerprint.top_matches(backup, course_ids=course_ids)
     task = backup.grading_tasks
     if task:
         # Choose the first grading_task
@@ -138,7 +146,8 @@ def grading_view(backup, form=None, is_composition=False):
 
     return render_template('staff/grading/code.html', courses=courses, assignment=assign,
                            backup=backup, group=group, files=files, diff_type=diff_type,
-                           task=task, form=form, is_composition=is_composition)
+                           task=task, form=form, is_composition=is_composition,
+                           similar=similar)
 
 @admin.route('/grading/<hashid:bid>')
 @is_staff()
@@ -238,7 +247,7 @@ def grade(bid):
     tasks = backup.grading_tasks
     for task in tasks:
         task.score = score
-        cache.delete_memoized(User.num_grading_tasks, task.grader)
+        cache.invalidate_scope('grading-tasks', task.grader_id)
 
     db.session.commit()
 
@@ -281,7 +290,9 @@ def autograde_backup(bid):
     if form.validate_on_submit():
         try:
             token = autograder.create_autograder_token(current_user.id)
-            autograder.autograde_backup(token, backup.assignment, backup.id)
+            autograder.autograde_backup(
+                token, backup.assignment, backup.id,
+                callback_url=url_for('api.autograderresult', _external=True))
             flash('Submitted to the autograder', 'success')
         except ValueError as e:
             flash(str(e), 'error')
@@ -418,7 +429,8 @@ def assignment(cid, aid):
 
     return render_template('staff/course/assignment/assignment.html', assignment=assign,
                            form=form, courses=courses,
-                           current_course=current_course)
+                           current_course=current_course,
+                           archive=export.latest_archive(assign, 'zip'))
 
 @admin.route("/course/<int:cid>/assignments/<int:aid>/stats")
 @is_staff(course_arg='cid')
@@ -431,8 +443,6 @@ def assignment_stats(cid, aid):
 
     stats = Assignment.assignment_stats(assign.id)
 
-    submissions = [d for d in stats.pop('raw_data')]
-
     pie_chart = pygal.Pie(half_pie=True, disable_xml_declaration=True,
                           style=CleanStyle,
                           inner_radius=.5, legend_at_bottom=True)
@@ -443,7 +453,22 @@ def assignment_stats(cid, aid):
 
     return render_template('staff/course/assignment/assignment.stats.html',
                            assignment=assign, subm_chart=pie_chart,
-                           courses=courses, stats=stats, submissions=submissions,
+                           courses=courses, stats=stats,
+                           current_course=current_course)
+
+@admin.route("/course/<int:cid>/assignments/<int:aid>/stats/submissions")
+@is_staff(course_arg='cid')
+def assignment_stats_submissions(cid, aid):
+    """ The table of every student's final submission on the statistics
+    page, loaded separately since it can take a while to build.
+    """
+    courses, current_course = get_courses(cid)
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not Assignment.can(assign, current_user, 'edit'):
+        return abort(401)
+    submissions = Assignment.cached_course_submissions(assign.id)
+    return render_template('staff/course/assignment/assignment.stats.submissions.html',
+                           assignment=assign, submissions=submissions,
                            current_course=current_course)
 
 @admin.route("/course/<int:cid>/assignments/<int:aid>/template",
@@ -514,31 +539,32 @@ def export_scores(cid, aid):
     if not Assignment.can(assign, current_user, 'export'):
         flash('Insufficient permissions', 'error')
         return abort(401)
-    query = (Score.query.options(db.joinedload('backup'))
-                  .filter_by(assignment=assign, archived=False))
+    query = Score.export_query(assign)
 
     custom_items = ('time', 'is_late', 'email', 'group')
     items = custom_items + Enrollment.export_items + Score.export_items
 
     def generate_csv():
         """ Generate csv export of scores for assignment.
-        Num Queries: ~2N queries for N scores.
+        Num Queries: 1, streamed in batches regardless of the number of scores.
         """
         # Yield Column Info as first row
         yield ','.join(items) + '\n'
-        for score in query:
+        for _, rows in itertools.groupby(query, key=lambda row: row.id):
+            rows = list(rows)
             csv_file = StringIO()
             csv_writer = csv.DictWriter(csv_file, fieldnames=items)
-            submitters = score.backup.enrollment_info()
-            group = [s.user.email for s in submitters]
-            time_str = utils.local_time(score.backup.created, current_course)
-            for submitter in submitters:
-                data = {'email': submitter.user.email,
+            group = [row.email for row in rows]
+            backup = rows[0]
+            time_str = utils.local_time(backup.created, current_course)
+            submission_time = backup.custom_submission_time or backup.created
+            for row in rows:
+                data = {'email': row.email,
                         'time': time_str,
-                        'is_late': score.backup.is_late,
+                        'is_late': submission_time > assign.due_date,
                         'group': group}
-                data.update(submitter.export)
-                data.update(score.export)
+                data.update({k: getattr(row, k) for k in items if k not in data})
+                data['backup_id'] = utils.encode_id(row.backup_id)
                 csv_writer.writerow(data)
             yield csv_file.getvalue()
 
@@ -550,6 +576,43 @@ def export_scores(cid, aid):
     return Response(stream_with_context(generate_csv()), mimetype='text/csv',
                     headers={'Content-Disposition': disposition})
 
+@admin.route("/course/<int:cid>/assignments/<int:aid>/submissions.<any(zip, tgz):kind>")
+@is_staff(course_arg='cid')
+def export_submissions(cid, aid, kind):
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not Assignment.can(assign, current_user, 'export'):
+        flash('Insufficient permissions', 'error')
+        return abort(401)
+
+    archive = export.latest_archive(assign, kind)
+    if not archive:
+        flash('Submissions have not been exported yet', 'warning')
+        return redirect(url_for('.assignment', cid=cid, aid=aid))
+    return redirect(archive.download_link)
+
+@admin.route("/course/<int:cid>/assignments/<int:aid>"
+             "/submissions.<any(zip, tgz):kind>/job",
+             methods=["POST"])
+@is_staff(course_arg='cid')
+def start_export_job(cid, aid, kind):
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not Assignment.can(assign, current_user, 'export'):
+        flash('Insufficient permissions', 'error')
+        return abort(401)
+    form = forms.CSRFForm()
+    if form.validate_on_submit():
+        job = jobs.enqueue_job(
+            export.export_final_submissions,
+            description='Export submissions for {}'.format(assign.display_name),
+            timeout=2 * 60 * 60,  # 2 hours
+            course_id=cid,
+            user_id=current_user.id,
+            assignment_id=assign.id,
+            kind=kind,
+            result_kind='html')
+        return redirect(url_for('.course_job', cid=cid, job_id=job.id))
+    return redirect(url_for('.assignment', cid=cid, aid=aid))
+
 @admin.route("/course/<int:cid>/assignments/<int:aid>/queues")
 @is_staff(course_arg='cid')
 def assignment_queues(cid, aid):
@@ -682,7 +745,9 @@ def autograde(cid, aid):
             timeout=2 * 60 * 60,  # 2 hours
             course_id=cid,
             user_id=current_user.id,
-            assignment_id=assign.id)
+            assignment_id=assign.id,
+            # Jobs have no request to build the URL from
+            callback_url=url_for('api.autograderresult', _external=True))
         return redirect(url_for('.course_job', cid=cid, job_id=job.id))
     return redirect(url_for('.assignment', cid=cid, aid=aid))
 
@@ -719,6 +784,55 @@ def start_moss_job(cid, aid):
             form=form,
         )
 
+@admin.route("/course/<int:cid>/assignments/<int:aid>/similarity",
+             methods=["GET", "POST"])
+@is_staff(course_arg='cid')
+def start_similarity_job(cid, aid):
+    courses, current_course = get_courses(cid)
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not assign or not Assignment.can(assign, current_user, 'grade'):
+        flash('Cannot access assignment', 'error')
+        return abort(404)
+
+    form = forms.SimilarityForm()
+    if form.validate_on_submit():
+        job = jobs.enqueue_job(
+            similarity.check_similarity,
+            description='Similarity check for {}'.format(assign.display_name),
+            timeout=600,
+            course_id=cid,
+            user_id=current_user.id,
+            assignment_id=assign.id,
+            file_regex=form.file_regex.data or '.*',
+            language=form.language.data,
+            subtract_template=form.subtract_template.data,
+            report_format=form.report_format.data,
+            max_shared=form.max_shared.data,
+            result_kind='html')
+        return redirect(url_for('.course_job', cid=cid, job_id=job.id))
+    else:
+        return render_template(
+            'staff/jobs/similarity.html',
+            courses=courses,
+            current_course=current_course,
+            assignment=assign,
+            form=form,
+        )
+
+@admin.route("/course/<int:cid>/assignments/<int:aid>/similarity/index",
+             methods=["POST"])
+@is_staff(course_arg='cid')
+def start_index_job(cid, aid):
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not assign or not Assignment.can(assign, current_user, 'grade'):
+        flash('Cannot access assignment', 'error')
+        return abort(404)
+    form = forms.CSRFForm()
+    if form.validate_on_submit():
+        job = similarity.start_index_job(assign, current_user.id)
+        return redirect(url_for('.course_job', cid=cid, job_id=job.id))
+    return redirect(url_for('.start_similarity_job', cid=cid, aid=aid))
+
 @admin.route("/course/<int:cid>/assignments/<int:aid>/github",
              methods=["GET", "POST"])
 @is_staff(course_arg='cid')
@@ -904,11 +1018,10 @@ def student_view(cid, email):
     if not enrollment:
         flash("This email is not enrolled", 'warning')
 
+    statuses = current_course.user_statuses(student, assignments, staff_view=True)
     assignments = {
-        'active': [a.user_status(student, staff_view=True) for a in assignments
-                   if a.active],
-        'inactive': [a.user_status(student, staff_view=True) for a in assignments
-                     if not a.active]
+        'active': [s for s in statuses if s.assignment.active],
+        'inactive': [s for s in statuses if not s.assignment.active]
     }
 
     return render_template('staff/student/overview.html',
@@ -1155,13 +1268,41 @@ def course_job(cid, job_id):
     job = Job.query.get_or_404(job_id)
     if job.course_id != cid:
         abort(404)
+    jobs.check_children(job)
+    log, offset = job.read_log()
     return render_template(
         'staff/jobs/job.html',
         courses=courses,
         current_course=current_course,
         job=job,
+        log=log,
+        offset=offset,
+        poll_interval=jobs.EVENT_POLL_INTERVAL,
     )
 
+@admin.route('/course/<int:cid>/jobs/<int:job_id>/log')
+@is_staff(course_arg='cid')
+def course_job_log(cid, job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.course_id != cid:
+        abort(404)
+    jobs.check_children(job)
+    log, offset = job.read_log(request.args.get('offset', 0, type=int))
+    return jsonify({
+        'log': log,
+        'offset': offset,
+        'status': job.status,
+    })
+
+@admin.route('/course/<int:cid>/jobs/<int:job_id>/events')
+@is_staff(course_arg='cid')
+def course_job_events(cid, job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.course_id != cid:
+        abort(404)
+    jobs.check_children(job)
+    return jsonify(jobs.job_events(job, request.args.get('offset', 0, type=int)))
+
 @admin.route('/course/<int:cid>/jobs/test/', methods=['GET', 'POST'])
 @is_staff(course_arg='cid')
 def start_test_job(cid):
@@ -22,12 +22,14 @@ from flask_login import current_user
 import flask_restful as restful
 from flask_restful import reqparse, fields, marshal_with
 from flask_restful.representations.json import output_json
+from oauthlib.common import generate_token
 
 from server.extensions import cache
 from server.utils import encode_id, decode_id
 import server.models as models
-from server.autograder import submit_continous
-from server.constants import STAFF_ROLES, VALID_ROLES
+from server.autograder import record_job_result, submit_continous
+from server.jobs.similarity import queue_index
+from server.constants import EXPORT_SNAPSHOT_TIMEOUT, STAFF_ROLES, VALID_ROLES
 
 endpoints = Blueprint('api', __name__)
 endpoints.config = {}
@@ -147,6 +149,8 @@ def make_backup(user, assignment_id, messages, submit):
                        for k, m in messages.items()]
     models.db.session.add(backup)
     models.db.session.commit()
+    if submit:
+        queue_index(backup)
     return backup
 
 
@@ -323,7 +327,8 @@ class BackupSchema(APISchema):
         'count': fields.Integer,
         'limit': fields.Integer,
         'offset': fields.Integer,
-        'has_more': fields.Boolean
+        'has_more': fields.Boolean,
+        'cursor': fields.String,
     }
 
     post_fields = {
@@ -406,6 +411,35 @@ class ScoreSchema(APISchema):
             return {'success': True, 'message': 'OK'}
         return {'success': False, 'message': "Permission error"}
 
+class AutograderResultSchema(APISchema):
+
+    post_fields = {
+        'success': fields.Boolean,
+    }
+
+    def __init__(self):
+        APISchema.__init__(self)
+        self.parser.add_argument('bid', type=str, required=True,
+                                 help='ID of submission')
+        self.parser.add_argument('job_id', type=str, required=True,
+                                 help='ID of autograder job')
+        self.parser.add_argument('status', type=str, required=True,
+                                 help='Status of autograder job')
+
+    def record_result(self, user):
+        args = self.parse_args()
+        try:
+            bid = decode_id(args['bid'])
+        except (ValueError, TypeError):
+            restful.abort(404)
+        backup = models.Backup.query.get(bid)
+        if not backup:
+            restful.abort(404)
+        if not models.Backup.can(backup, user, 'grade'):
+            restful.abort(403)
+        record_job_result(backup.assignment_id, args['job_id'], args['status'])
+        return {'success': True}
+
 class CommentSchema(APISchema):
     post_fields = {}
 
@@ -636,24 +670,49 @@ class ExportFinal(Resource):
 
         limit = request.args.get('limit', 150, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')
 
         if not self.model.can(assign, user, 'export'):
             return restful.abort(403)
 
-        subms = assign.course_submissions(include_empty=False)
+        # The set of final submissions is computed once per export and kept
+        # in the cache, so that later pages are cheap and consistent with
+        # the first one. The cursor names the snapshot and the last backup
+        # that was returned.
+        if cursor:
+            snapshot_id, _, last_hashid = cursor.partition('.')
+            backup_ids = cache.get(export_snapshot_key(assign.id, snapshot_id))
+            try:
+                last_id = decode_id(last_hashid)
+            except ValueError:
+                last_id = None
+            if backup_ids is None or last_id not in backup_ids:
+                return restful.abort(400, message='Invalid or expired cursor')
+            offset = backup_ids.index(last_id) + 1
+        else:
+            subms = assign.course_submissions(include_empty=False)
+            subm_keys = set(s['backup']['id'] for s in subms)
+            ordered = (models.db.session.query(models.Backup.id)
+                            .filter(models.Backup.id.in_(subm_keys))
+                            .order_by(models.Backup.created.desc(),
+                                      models.Backup.id.desc()))
+            backup_ids = [backup_id for backup_id, in ordered]
+            snapshot_id = generate_token()
+            cache.set(export_snapshot_key(assign.id, snapshot_id), backup_ids,
+                      timeout=EXPORT_SNAPSHOT_TIMEOUT)
+
+        page_ids = backup_ids[offset:offset + limit]
+        has_more = offset + len(page_ids) < len(backup_ids)
 
-        output = []
-        subm_keys = set(s['backup']['id'] for s in subms)
         joined = models.db.joinedload
         base_query = (models.Backup.query.options(joined('assignment'),
                                                   joined('submitter'),
                                                   joined('messages'))
-                            .filter(models.Backup.id.in_(subm_keys))
-                            .order_by(models.Backup.created.desc()))
-
-        num_subms = len(subm_keys)
-        output = base_query.limit(limit).offset(offset)
-        has_more = ((num_subms - offset) - limit) > 0
+                            .filter(models.Backup.id.in_(page_ids)))
+        backups = {backup.id: backup for backup in base_query}
+        # Backups that were deleted since the snapshot are skipped
+        output = [backups[bid] for bid in page_ids if bid in backups]
+        models.FileBlob.resolve_messages([m for b in output for m in b.messages])
 
         results = []
         for backup in output:
@@ -667,11 +726,19 @@ class ExportFinal(Resource):
             })
             results.append(data)
 
+        next_cursor = None
+        if has_more:
+            next_cursor = '{}.{}'.format(snapshot_id, encode_id(page_ids[-1]))
+
         return {'backups': results,
                 'limit': limit,
                 'offset': offset,
-                'count': num_subms,
-                'has_more': has_more}
+                'count': len(backup_ids),
+                'has_more': has_more,
+                'cursor': next_cursor}
+
+def export_snapshot_key(assignment_id, snapshot_id):
+    return 'export-final/{}/{}'.format(assignment_id, snapshot_id)
 
 class Enrollment(Resource):
     """ View what courses an email is enrolled in.
@@ -754,6 +821,19 @@ class Score(Resource):
         }
 
 
+class AutograderResult(Resource):
+    """ Autograder job status changes, so that running autograding jobs do
+        not have to poll the autograder.
+        Authenticated. Permissions: >= Staff
+        Used by: Autograder.
+    """
+    schema = AutograderResultSchema()
+
+    @marshal_with(schema.post_fields)
+    def post(self, user):
+        return self.schema.record_result(user)
+
+
 class Version(PublicResource):
     """ Current version of a client
     Permissions: World Readable
@@ -766,7 +846,7 @@ class Version(PublicResource):
     }
 
     @marshal_with(schema.get_fields)
-    @cache.memoize(600)
+    @cache.memoize(600, single_flight=True)
     def get(self, name=None):
         if name:
             versions = self.model.query.filter_by(name=name).all()
@@ -910,5 +990,6 @@ api.add_resource(CourseAssignment, COURSE_BASE + '/assignments')
 # Other
 api.add_resource(Enrollment, '/v3/enrollment/<string:email>/')
 api.add_resource(Score, '/v3/score/')
+api.add_resource(AutograderResult, '/v3/autograder/results/')
 api.add_resource(User, '/v3/user/', '/v3/user/<string:email>')
 api.add_resource(Version, '/v3/version/', '/v3/version/<string:name>')
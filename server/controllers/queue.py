@@ -1,4 +1,6 @@
-from flask import abort, current_app
+import hmac
+
+from flask import abort, current_app, jsonify, request
 from flask_login import current_user
 import rq_dashboard
 
@@ -6,9 +8,27 @@ from server import jobs
 
 queue = rq_dashboard.blueprint
 
+def has_stats_token():
+    """ Whether the request carries the QUEUE_STATS_TOKEN, as sent by
+    services like the worker autoscaler that cannot log in.
+    """
+    token = current_app.config.get('QUEUE_STATS_TOKEN')
+    header = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(header, 'Bearer ' + token)
+
 @queue.before_request
 def authenticate(*args, **kwargs):
+    if request.endpoint == 'rq_dashboard.queue_stats' and has_stats_token():
+        return
     if not current_user.is_authenticated:
         return current_app.login_manager.unauthorized()
     if not current_user.is_admin:
         abort(403)
+
+@queue.route('/stats.json')
+def queue_stats():
+    """ Depth, oldest wait and worker count of each job queue, for scaling
+    the workers. Admins can read it, and so can services that send
+    "Authorization: Bearer <QUEUE_STATS_TOKEN>".
+    """
+    return jsonify(jobs.queue_stats())
@@ -12,6 +12,7 @@ from server import highlight, models, utils
 from server.autograder import submit_continous
 from server.constants import VALID_ROLES, STAFF_ROLES, STUDENT_ROLE, MAX_UPLOAD_FILE_SIZE
 from server.forms import CSRFForm, UploadSubmissionForm
+from server.jobs.similarity import queue_index
 from server.models import User, Course, Assignment, Group, Backup, Message, ExternalFile, db
 from server.utils import (is_safe_redirect_url, group_action_email,
                           invite_email, send_email)
@@ -72,11 +73,11 @@ def index():
 @login_required
 def course(offering):
     course = get_course(offering)
+    statuses = course.user_statuses(
+        current_user, [a for a in course.assignments if a.visible])
     assignments = {
-        'active': [a.user_status(current_user) for a in course.assignments
-                   if a.active and a.visible],
-        'inactive': [a.user_status(current_user) for a in course.assignments
-                     if not a.active and a.visible]
+        'active': [s for s in statuses if s.assignment.active],
+        'inactive': [s for s in statuses if not s.assignment.active]
     }
     return render_template('student/course/index.html', course=course,
                            **assignments)
@@ -192,6 +193,7 @@ def submit_assignment(name):
 
         db.session.add(backup)
         db.session.commit()
+        queue_index(backup)
         return jsonify({
             'backup': backup.hashid,
             'url': url_for('.code', name=assign.name, submit=backup.submit,
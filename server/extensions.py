@@ -1,14 +1,14 @@
-from flask_caching import Cache
 from flask_wtf.csrf import CsrfProtect
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_assets import Environment
 from flask_oauthlib.provider import OAuth2Provider
 from raven.contrib.flask import Sentry
 
+from server.caching import TwoTierCache
 from server.storage import Storage
 
-# Setup flask cache
-cache = Cache()
+# Setup flask cache, with an in-process tier for memoized functions
+cache = TwoTierCache()
 
 csrf = CsrfProtect()
 
@@ -460,6 +460,19 @@ class MossSubmissionForm(BaseForm):
     subtract_template = BooleanField('Subtract Template', default=False,
                                      description="Only send the changes from the template to MOSS")
 
+class SimilarityForm(BaseForm):
+    file_regex = StringField('Regex for submitted files', default='.*',
+                             validators=[validators.required()])
+    language = SelectField('Language', choices=[(pl, pl) for pl in COMMON_LANGUAGES])
+    subtract_template = BooleanField(
+        'Subtract Template', default=False,
+        description="Only compare the changes from the template")
+    max_shared = IntegerField('Ignore code shared by more than this many submissions',
+                              default=10,
+                              validators=[validators.NumberRange(min=2)])
+    report_format = SelectField('Report',
+                                choices=[('html', 'HTML'), ('json', 'JSON file')])
+
 class GithubSearchRecentForm(BaseForm):
     access_token = StringField('Github Access Token',
                                description="Get a token at https://github.com/settings/tokens",
@@ -1,12 +1,18 @@
 import os
 import difflib
+import hashlib
 import itertools
 
 import pygments
 import pygments.lexers
 import pygments.formatters
 
-from server.constants import DIFF_SIZE_LIMIT, SOURCE_SIZE_LIMIT
+from server.caching import LRUCache
+from server.constants import (DIFF_SIZE_LIMIT, SOURCE_SIZE_LIMIT,
+                              HIGHLIGHT_CACHE_SIZE, HIGHLIGHT_CACHE_TIMEOUT)
+from server.extensions import cache
+
+FORMATTER_OPTIONS = {'nowrap': True}
 
 class File:
     def __init__(self, name, lines=(), source='', too_big=False):
@@ -26,18 +32,54 @@ class Line:
         self.contents = contents
         self.comments = comments
 
+local_cache = LRUCache(HIGHLIGHT_CACHE_SIZE)
+
+def _cached(key, compute):
+    """Look up KEY in the in-process cache and then in the shared (Redis)
+    cache. On a miss in both, store and return the result of COMPUTE().
+    """
+    value = local_cache.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, timeout=HIGHLIGHT_CACHE_TIMEOUT)
+        local_cache.set(key, value)
+    return value
+
+def guess_lexer(filename, source, digest):
+    """Return a lexer for a file. DIGEST is the SHA-256 hash of SOURCE, used
+    to remember the guess for files that have been seen before.
+    """
+    def guess():
+        try:
+            lexer = pygments.lexers.guess_lexer_for_filename(filename, source)
+        except pygments.util.ClassNotFound:
+            lexer = pygments.lexers.TextLexer()
+        return lexer.name
+
+    name = _cached('highlight-lexer/{}/{}'.format(digest, filename), guess)
+    return pygments.lexers.find_lexer_class(name)(stripnl=False)
+
 def highlight(filename, source):
-    """Highlights an input string into a list of HTML strings, one per line."""
+    """Highlights an input string into a list of HTML strings, one per line.
+    Results are cached by the hash of SOURCE, the lexer and the formatter
+    options, so files shared by many backups (like the assignment template)
+    are only highlighted once.
+    """
     if not source:
         return []  # pygments does not play nice with empty files
-    try:
-        lexer = pygments.lexers.guess_lexer_for_filename(filename, source, stripnl=False)
-    except pygments.util.ClassNotFound:
-        lexer = pygments.lexers.TextLexer(stripnl=False)
-
-    highlighted = pygments.highlight(source, lexer,
-                                     pygments.formatters.HtmlFormatter(nowrap=True))
-    return highlighted.splitlines(keepends=True)
+    digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    lexer = guess_lexer(filename, source, digest)
+    options = ','.join('{}={}'.format(k, v)
+                       for k, v in sorted(FORMATTER_OPTIONS.items()))
+
+    def highlight_lines():
+        formatter = pygments.formatters.HtmlFormatter(**FORMATTER_OPTIONS)
+        return pygments.highlight(source, lexer, formatter).splitlines(keepends=True)
+
+    key = 'highlight/{}/{}/{}'.format(digest, lexer.name, options)
+    return list(_cached(key, highlight_lines))
 
 def highlight_file(filename, source):
     """Given a source file, generate a sequence of (line index, HTML) pairs."""
@@ -1,30 +1,118 @@
+import datetime
 import functools
+import hashlib
 import io
+import json
 import logging
+import threading
 
 from flask_login import current_user
 from flask_rq import get_connection, get_queue
 import redis.exceptions
 import rq
+import sqlalchemy.exc
 
-from server.models import db, Job
+from server.models import db, Job, JobLogChunk
+
+# Queues that jobs are sent to, so that quick jobs do not wait behind long
+# ones. Each queue has its own workers (see worker.py).
+QUEUES = [
+    'interactive',  # quick jobs that staff wait for
+    'bulk',         # jobs over a whole class, like autograding or MOSS
+    'maintenance',  # housekeeping, like indexing new submissions
+]
+DEFAULT_QUEUE = 'interactive'
+# Queues that no job is sent to any more, but that workers keep draining for
+# one release: 'default' holds jobs queued before the queues were split.
+# Remove it afterwards.
+RETIRED_QUEUES = ['default']
+WORKER_QUEUES = QUEUES + RETIRED_QUEUES
+
+LOG_FLUSH_INTERVAL = 2  # maximum time between writes of a job's log, in seconds
+# maximum number of characters of a log to hold before writing them
+LOG_FLUSH_SIZE = 64 * 1024
+# how long to wait for the shards of a fan_out, in seconds
+SHARD_KEY_TTL = 7 * 24 * 60 * 60
+# how long the last progress report of a job is kept, in seconds
+EVENT_TTL = 24 * 60 * 60
+EVENT_POLL_INTERVAL = 2  # how often a live job page asks for news, in seconds
+# How long a singleton job holds its lock while queued, and while running
+# without a heartbeat, in seconds
+LOCK_QUEUED_LEASE = 24 * 60 * 60
+LOCK_LEASE = 60
+LOCK_HEARTBEAT_INTERVAL = 15  # how often a running singleton job renews its lock
+
+# Only change (or delete) a lock if it is still held by the given job
+RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
 class JobLogHandler(logging.StreamHandler):
-    """Stream log contents to buffer and to DB. """
-    def __init__(self, stream, job, log_every=10):
+    """Stream log contents to buffer, and append them to the DB in chunks.
+    A chunk is written once FLUSH_SIZE characters are waiting, and by a
+    background thread (see start) every FLUSH_INTERVAL seconds, so a long log
+    is written to the DB only once. Chunks are written on their own
+    connection, so that logging never commits (or depends on) the job's
+    session.
+    """
+    def __init__(self, stream, job, flush_interval=LOG_FLUSH_INTERVAL,
+                 flush_size=LOG_FLUSH_SIZE):
         super().__init__(stream)
         self.stream = stream
-        self.job = job
-        self.counter = 0
-        self.log_every = log_every
+        self.job_id = job.id
+        self.engine = db.engine
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.flushed = 0  # number of characters already written to the DB
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically,
+                                        daemon=True)
+
+    def start(self):
+        """Start writing the log every FLUSH_INTERVAL seconds."""
+        self.flusher.start()
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.append_chunk()
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        super().close()
 
     def handle(self, record):
-        self.counter += 1
         super().handle(record)
         print(record.message)
-        if (self.counter % self.log_every) == 0:
-            self.job.log = self.contents
-            db.session.commit()
+        if self.stream.tell() - self.flushed >= self.flush_size:
+            self.append_chunk()
+
+    def append_chunk(self):
+        """Write any log contents that are not in the DB yet. If the write
+        fails, the contents are kept and written with the next chunk.
+        """
+        with self.lock:
+            contents = self.contents[self.flushed:]
+            if not contents:
+                return
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(JobLogChunk.__table__.insert().values(
+                        job_id=self.job_id, start=self.flushed,
+                        end=self.flushed + len(contents), contents=contents))
+            except sqlalchemy.exc.SQLAlchemyError:
+                return
+            self.flushed += len(contents)
 
     @property
     def contents(self):
@@ -37,7 +125,45 @@ def get_current_job():
 def get_job_logger():
     return logging.getLogger('{}.job_{}'.format(__name__, get_current_job().id))
 
-def background_job(f):
+class LockHeartbeat(threading.Thread):
+    """Renew the lock of a running singleton job until it is stopped. If the
+    worker dies, the lock expires after LOCK_LEASE seconds and the job can be
+    started again.
+    """
+    def __init__(self, connection, key, job_id):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.key = key
+        self.job_id = job_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.connection.eval(RENEW_LOCK_SCRIPT, 1, self.key,
+                                     self.job_id, LOCK_LEASE)
+            except redis.exceptions.ConnectionError:
+                pass
+            if self.stopped.wait(LOCK_HEARTBEAT_INTERVAL):
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def background_job(f=None, queue=DEFAULT_QUEUE, singleton=False):
+    """ Decorator for functions that run as background jobs. QUEUE is the
+    name of the queue (in QUEUES) that the job is sent to, e.g.
+    @background_job(queue='bulk'). With SINGLETON, only one job with the same
+    arguments can be queued or running at a time; enqueue_job returns the
+    existing job instead of starting another.
+    """
+    if f is None:
+        return functools.partial(background_job, queue=queue,
+                                 singleton=singleton)
+    if queue not in QUEUES:
+        raise ValueError('Unknown queue {}'.format(queue))
+
     @functools.wraps(f)
     def job_handler(*args, **kwargs):
         job = get_current_job()
@@ -45,30 +171,109 @@ def background_job(f):
         db.session.commit()
 
         stream = io.StringIO()
+        stream.write(children_log(job))
         handler = JobLogHandler(stream, job)
+        handler.start()
         logger = get_job_logger()
 
         logger.setLevel(logging.INFO)
         logger.addHandler(handler)
         return_value = None
 
+        if singleton:
+            connection = get_connection()
+            key = job_lock_key(f.__name__, args, kwargs)
+            heartbeat = LockHeartbeat(connection, key, job.id)
+            heartbeat.start()
         try:
             return_value = f(*args, **kwargs)
         except:
+            # The session may be unusable after a DB error
+            db.session.rollback()
             job.failed = True
             logger.exception('Job failed')
+        finally:
+            if singleton:
+                heartbeat.stop()
+                release_lock(connection, key, job.id)
 
+        logger.removeHandler(handler)
+        handler.close()
         job.status = 'finished'
         job.result = return_value
         job.log = handler.contents
         stream.close()
+        JobLogChunk.query.filter_by(job_id=job.id).delete()
         db.session.commit()
 
+        if job.parent_id:
+            shard_finished(job)
+
+    job_handler.queue = queue
+    job_handler.singleton = singleton
     return job_handler
 
-def enqueue_job(func, *args,
-                description=None, course_id=None, user_id=None, timeout=300,
-                result_kind='string', **kwargs):
+def queue_stats():
+    """ Return, for each queue, the number of jobs waiting, how long the
+    oldest one has waited (in seconds) and the number of workers, e.g. to
+    decide how many workers to run.
+    """
+    connection = get_connection()
+    workers = rq.Worker.all(connection=connection)
+    now = datetime.datetime.utcnow()
+    stats = {}
+    for name in WORKER_QUEUES:
+        queue = get_queue(name)
+        wait = 0
+        oldest = queue.get_job_ids(0, 1)
+        if oldest:
+            job = queue.fetch_job(oldest[0])
+            if job and job.enqueued_at:
+                wait = (now - job.enqueued_at).total_seconds()
+        stats[name] = {
+            'depth': queue.count,
+            'oldest_wait': wait,
+            'workers': len([w for w in workers if name in w.queue_names()]),
+        }
+    return stats
+
+def job_progress_key(job_id):
+    return 'jobs:{}:progress'.format(job_id)
+
+def report_progress(done, total):
+    """ Report that the current job has done DONE out of TOTAL units of work.
+    The estimated time remaining assumes the rest takes as long per unit.
+    """
+    connection = get_connection()
+    rq_job = rq.get_current_job(connection=connection)
+    progress = {'type': 'progress', 'done': done, 'total': total, 'eta': None}
+    if rq_job.started_at and done:
+        elapsed = (datetime.datetime.utcnow() - rq_job.started_at).total_seconds()
+        progress['eta'] = round(elapsed * (total - done) / done)
+    connection.set(job_progress_key(rq_job.id), json.dumps(progress),
+                   ex=EVENT_TTL)
+
+def job_events(job, offset=0):
+    """ Return news about JOB for the live job page without waiting: its log
+    output after OFFSET, the offset to pass next time, its status and its
+    latest progress report. The page asks again every EVENT_POLL_INTERVAL
+    seconds until the job finishes.
+    """
+    log, offset = job.read_log(offset)
+    try:
+        progress = get_connection().get(job_progress_key(job.id))
+    except redis.exceptions.ConnectionError:
+        progress = None
+    return {
+        'log': log,
+        'offset': offset,
+        'status': job.status,
+        'failed': job.failed,
+        'progress': json.loads(progress.decode('utf-8')) if progress else None,
+    }
+
+def create_job(func, description=None, course_id=None, user_id=None,
+               result_kind='string', parent=None):
     if not description:
         raise ValueError('Description required to start background job')
     if not course_id:
@@ -81,13 +286,90 @@ def enqueue_job(func, *args,
         user_id=user_id,
         name=func.__name__,
         description=description,
-        result_kind=result_kind
+        result_kind=result_kind,
+        parent=parent,
     )
     db.session.add(job)
     db.session.commit()
+    return job
+
+def connection_failed(job, error):
+    job.failed = True
+    job.status = 'finished'
+    job.log = 'Could not connect to Redis: ' + str(error)
+    db.session.add(job)
+    db.session.commit()
+
+def job_lock_key(name, args, kwargs):
+    arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return 'jobs:lock:{}:{}'.format(
+        name, hashlib.sha1(arguments.encode('utf-8')).hexdigest())
+
+def release_lock(connection, key, job_id):
+    try:
+        connection.eval(RELEASE_LOCK_SCRIPT, 1, key, job_id)
+    except redis.exceptions.ConnectionError:
+        pass
+
+def locked_job(connection, key):
+    """ Return the unfinished Job holding the lock KEY, or None if the lock is
+    free or stale. A stale lock is deleted. A lock is stale if its job has
+    finished without releasing it, or if the job is still marked as queued
+    but is no longer waiting in its queue (e.g. because the queue was
+    emptied), in which case the job is marked as failed.
+    """
+    job_id = connection.get(key)
+    if job_id is None:
+        return None
+    job = Job.query.get(int(job_id))
+    if job and job.status == 'running':
+        # Running jobs renew their lock; it expires if the worker dies
+        return job
+    if job and job.status == 'queued':
+        try:
+            status = rq.job.Job.fetch(str(job.id), connection=connection).get_status()
+        except rq.exceptions.NoSuchJobError:
+            status = None
+        if status in (rq.job.JobStatus.QUEUED, rq.job.JobStatus.STARTED,
+                      rq.job.JobStatus.DEFERRED):
+            return job
+        job.failed = True
+        job.status = 'finished'
+        job.log = 'The job was lost from its queue\n'
+        db.session.commit()
+    release_lock(connection, key, job_id)
+    return None
+
+def enqueue_job(func, *args,
+                description=None, course_id=None, user_id=None, timeout=300,
+                result_kind='string', parent=None, **kwargs):
+    """ Start FUNC(*args, **kwargs) as a background job and return its Job.
+    If FUNC is a singleton job and the same job is already queued or
+    running, return that job instead.
+    """
+    if func.singleton:
+        connection = get_connection()
+        key = job_lock_key(func.__name__, args, kwargs)
+        try:
+            existing = locked_job(connection, key)
+        except redis.exceptions.ConnectionError:
+            existing = None
+        if existing:
+            return existing
 
+    job = create_job(func, description=description, course_id=course_id,
+                     user_id=user_id, result_kind=result_kind, parent=parent)
     try:
-        get_queue().enqueue_call(
+        if func.singleton and not connection.set(key, job.id, nx=True,
+                                                 ex=LOCK_QUEUED_LEASE):
+            # Another request took the lock since we checked
+            existing = locked_job(connection, key)
+            if existing:
+                db.session.delete(job)
+                db.session.commit()
+                return existing
+            connection.set(key, job.id, ex=LOCK_QUEUED_LEASE)
+        get_queue(func.queue).enqueue_call(
             func=func,
             args=args,
             kwargs=kwargs,
@@ -95,10 +377,139 @@ def enqueue_job(func, *args,
             timeout=timeout
         )
     except redis.exceptions.ConnectionError as e:
-        job.failed = True
-        job.status = 'finished'
-        job.log = 'Could not connect to Redis: ' + str(e)
-        db.session.add(job)
-        db.session.commit()
+        connection_failed(job, e)
 
     return job
+
+def pending_shards_key(job_id):
+    return 'jobs:{}:pending'.format(job_id)
+
+def fan_out(func, shards, reducer, *args,
+            description=None, course_id=None, user_id=None, timeout=300,
+            result_kind='string', **kwargs):
+    """ Split a job into one child job per shard, so that it can use several
+    workers. FUNC is called as FUNC(shard, *args, **kwargs) in each child.
+    Once every child has finished, REDUCER(*args, **kwargs) runs as the
+    parent job and can use gather() to get the children's results. All three
+    must be background jobs. Returns the parent Job, whose log collects the
+    logs of its children. If a child fails, the parent fails without
+    running the reducer.
+    The IDs of the children are stored in a Redis set before any of them is
+    queued, and each child removes its own ID when it finishes, so that a
+    child that could not be queued or is reported twice is counted once.
+    """
+    shards = list(shards)
+    parent = create_job(reducer, description=description, course_id=course_id,
+                        user_id=user_id, result_kind=result_kind)
+    children = [
+        create_job(func, course_id=course_id, user_id=parent.user_id,
+                   description='{} (shard {} of {})'.format(
+                       description, i + 1, len(shards)),
+                   parent=parent)
+        for i in range(len(shards))
+    ]
+    try:
+        connection = get_connection()
+        rq_job = rq.job.Job.create(reducer, args=args, kwargs=kwargs,
+                                   connection=connection, id=str(parent.id),
+                                   timeout=timeout, origin=reducer.queue)
+        rq_job.save()
+        if not shards:
+            get_queue(reducer.queue).enqueue_job(rq_job)
+            return parent
+        pipe = connection.pipeline()
+        pipe.sadd(pending_shards_key(parent.id), *[child.id for child in children])
+        pipe.expire(pending_shards_key(parent.id), SHARD_KEY_TTL)
+        pipe.execute()
+    except redis.exceptions.ConnectionError as e:
+        for job in [parent] + children:
+            connection_failed(job, e)
+        return parent
+
+    parent.status = 'running'
+    db.session.commit()
+    for child, shard in zip(children, shards):
+        try:
+            get_queue(func.queue).enqueue_call(
+                func=func,
+                args=(shard,) + args,
+                kwargs=kwargs,
+                job_id=str(child.id),
+                timeout=timeout
+            )
+        except redis.exceptions.ConnectionError as e:
+            connection_failed(child, e)
+            child_failed(child)
+    return parent
+
+def shard_finished(job):
+    """ Called when the child JOB of a fan_out finishes. The last child to
+    finish starts the reducer, or fails the parent if any child failed.
+    Calling this again for the same child has no effect.
+    """
+    connection = get_connection()
+    pipe = connection.pipeline()
+    pipe.srem(pending_shards_key(job.parent_id), job.id)
+    pipe.scard(pending_shards_key(job.parent_id))
+    removed, remaining = pipe.execute()
+    if not removed or remaining:
+        # Already counted, or other children are not finished yet
+        return
+    parent = job.parent
+    failed = [child for child in parent.children if child.failed]
+    if failed:
+        parent.failed = True
+        parent.status = 'finished'
+        parent.log = children_log(parent) + '{} of {} shards failed\n'.format(
+            len(failed), len(parent.children))
+        db.session.commit()
+    else:
+        rq_job = rq.job.Job.fetch(str(parent.id), connection=connection)
+        get_queue(rq_job.origin).enqueue_job(rq_job)
+
+def child_failed(child):
+    """ Count a failed CHILD of a fan_out as finished, if Redis is reachable.
+    Otherwise check_children counts it the next time staff look at its parent.
+    """
+    try:
+        shard_finished(child)
+    except redis.exceptions.ConnectionError:
+        pass
+
+def check_children(job):
+    """ Fail the unfinished children of JOB whose RQ job has failed or
+    disappeared, e.g. because their worker was killed, so that JOB does not
+    wait for them forever. Children that failed before they could be counted
+    are counted again. Called whenever staff look at JOB.
+    """
+    if job.status == 'finished':
+        return
+    connection = get_connection()
+    for child in job.children:
+        if child.status == 'finished':
+            if child.failed:
+                child_failed(child)
+            continue
+        try:
+            status = rq.job.Job.fetch(str(child.id), connection=connection).get_status()
+        except rq.exceptions.NoSuchJobError:
+            status = None
+        except redis.exceptions.ConnectionError:
+            return
+        if status not in (None, rq.job.JobStatus.FAILED):
+            continue
+        child.failed = True
+        child.status = 'finished'
+        child.log = (child.log or '') + 'The worker running this shard died\n'
+        db.session.commit()
+        shard_finished(child)
+
+def gather():
+    """ Return the results of the children of the current job, in the order
+    of the shards passed to fan_out.
+    """
+    return [child.result for child in get_current_job().children]
+
+def children_log(job):
+    return ''.join('[{}]\n{}'.format(child.description, child.log or '')
+                   for child in job.children)
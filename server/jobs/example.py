@@ -1,7 +1,7 @@
 import time
 
 from server import jobs
-from server.models import ExternalFile
+from server.models import ExternalFile, Job, db
 from server.utils import encode_id
 
 def data(duration):
@@ -27,3 +27,34 @@ def test_job(duration=0, should_fail=False, make_file=False):
         msg = "Waited for <b>{}</b> seconds!".format(duration)
     logger.info('Finished!')
     return msg
+
+@jobs.background_job
+def test_db_error_job():
+    logger = jobs.get_job_logger()
+
+    logger.info('Starting...')
+    db.session.add(Job(status='queued'))  # missing required columns
+    db.session.flush()
+
+@jobs.background_job
+def test_shard(numbers, should_fail=False):
+    logger = jobs.get_job_logger()
+    logger.info('Adding {} numbers'.format(len(numbers)))
+    if should_fail and not numbers:
+        1/0
+    return str(sum(numbers))
+
+@jobs.background_job
+def test_gather(should_fail=False):
+    logger = jobs.get_job_logger()
+    total = sum(int(result) for result in jobs.gather())
+    logger.info('Total: {}'.format(total))
+    return str(total)
+
+@jobs.background_job(singleton=True)
+def test_singleton_job(duration=0):
+    logger = jobs.get_job_logger()
+
+    logger.info('Starting...')
+    time.sleep(duration)
+    logger.info('Finished!')
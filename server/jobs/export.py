@@ -0,0 +1,170 @@
+""" Export the final submissions of an assignment as a single zip or tar
+archive, laid out as <backup hashid>/<filename> plus a manifest.csv.
+"""
+import csv
+import io
+import itertools
+import posixpath
+import tarfile
+import time
+import zipfile
+
+from server import jobs, utils
+from server.constants import IN_QUERY_BATCH_SIZE
+from server.models import Assignment, Backup, ExternalFile, FileBlob, Message, db
+
+ARCHIVE_KINDS = {
+    # kind: (file extension, mimetype)
+    'zip': ('zip', 'application/zip'),
+    'tgz': ('tar.gz', 'application/gzip'),
+}
+
+MESSAGE_BATCH_SIZE = 100  # number of file_contents messages loaded at a time
+
+class ArchiveBuffer(io.RawIOBase):
+    """ A write-only, unseekable file that holds what was written to it until
+    it is drained, so that an archive can be sent while it is being built.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def final_files(backup_ids):
+    """ Yield (message, filename, contents) for the files in every backup in
+    BACKUP_IDS. Messages are read with yield_per and resolved a batch at a
+    time, so memory use does not depend on the number of backups.
+    """
+    for batch in utils.batches(sorted(backup_ids), IN_QUERY_BATCH_SIZE):
+        query = (Message.query.options(db.joinedload('backup'))
+                        .filter(Message.backup_id.in_(batch),
+                                Message.kind == 'file_contents')
+                        .order_by(Message.backup_id)
+                        .yield_per(MESSAGE_BATCH_SIZE))
+        messages = iter(query)
+        while True:
+            chunk = list(itertools.islice(messages, MESSAGE_BATCH_SIZE))
+            if not chunk:
+                break
+            FileBlob.resolve_messages(chunk)
+            for message in chunk:
+                for filename, contents in sorted(message.contents.items()):
+                    if filename == 'submit':  # ignore fake file from ok-client
+                        continue
+                    yield message, filename, contents
+
+def archive_path(hashid, filename):
+    """ Return the path of FILENAME in the archive, or None if the filename
+    would escape the backup's directory.
+    """
+    path = posixpath.normpath(filename).lstrip('/')
+    if path.startswith('..'):
+        return None
+    return posixpath.join(hashid, path)
+
+def final_submissions_archive(assign, kind='zip'):
+    """ Generate the archive of all final submissions for ASSIGN in chunks of
+    bytes. KIND is one of ARCHIVE_KINDS.
+    """
+    if kind not in ARCHIVE_KINDS:
+        raise ValueError('Unknown archive kind {}'.format(kind))
+    owners = assign.final_submission_owners()
+    buffer = ArchiveBuffer()
+    now = time.time()
+
+    if kind == 'zip':
+        archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+
+        def add(name, data):
+            archive.writestr(name, data)
+    else:
+        archive = tarfile.open(fileobj=buffer, mode='w|gz')
+
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = now
+            archive.addfile(info, io.BytesIO(data))
+
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(['backup_id', 'emails', 'created', 'is_late', 'files'])
+
+    def write_row(backup, names):
+        writer.writerow([backup.hashid, ', '.join(owners[backup.id]),
+                         backup.created.isoformat(), backup.is_late,
+                         ' '.join(names)])
+
+    exported = set()
+    for message, files in itertools.groupby(final_files(owners),
+                                            key=lambda f: f[0]):
+        backup = message.backup
+        names = []
+        for _, filename, contents in files:
+            path = archive_path(backup.hashid, filename)
+            if path is None:
+                continue
+            add(path, contents.encode('utf-8'))
+            names.append(filename)
+            data = buffer.drain()
+            if data:
+                yield data
+        write_row(backup, names)
+        exported.add(backup.id)
+
+    # Backups without any file contents still get a row in the manifest
+    missing = sorted(set(owners) - exported)
+    for batch in utils.batches(missing, IN_QUERY_BATCH_SIZE):
+        for backup in Backup.query.filter(Backup.id.in_(batch)).order_by(Backup.id):
+            write_row(backup, [])
+
+    add('manifest.csv', manifest.getvalue().encode('utf-8'))
+    archive.close()
+    yield buffer.drain()
+
+def archive_name(assign, kind):
+    extension, _ = ARCHIVE_KINDS[kind]
+    return '{}-submissions.{}'.format(assign.name.replace('/', '-'), extension)
+
+def latest_archive(assign, kind):
+    """ Return the ExternalFile of the most recent export of ASSIGN as KIND,
+    or None if there is none. Only staff files are considered, so a student
+    upload with the same name is never served as the export.
+    """
+    return (ExternalFile.query
+                        .filter_by(assignment_id=assign.id, deleted=False,
+                                   staff_file=True,
+                                   filename=archive_name(assign, kind))
+                        .order_by(ExternalFile.id.desc())
+                        .first())
+
+@jobs.background_job(queue='bulk', singleton=True)
+def export_final_submissions(assignment_id, kind='zip'):
+    logger = jobs.get_job_logger()
+    logger.info('Starting export of final submissions...')
+
+    assign = Assignment.query.get(assignment_id)
+    if not assign:
+        logger.info("Could not find assignment")
+        return
+
+    name = archive_name(assign, kind)
+    upload = ExternalFile.upload(final_submissions_archive(assign, kind),
+                                 user_id=jobs.get_current_job().user_id,
+                                 course_id=assign.course_id,
+                                 assignment_id=assign.id,
+                                 name=name, prefix='jobs/export/',
+                                 staff_file=True)
+    logger.info("Saved as: {}".format(upload.object_name))
+    logger.info('Finished!')
+    return "<a href='{0}'>{1}</a>".format(upload.download_link, name)
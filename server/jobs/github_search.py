@@ -227,7 +227,7 @@ def get_online_repos(source, logger, language, access_token,
             repos[repo['html_url']] = repo
     return repos
 
-@jobs.background_job
+@jobs.background_job(queue='bulk')
 def search_similar_repos(access_token=None, assignment_id=None,
                          language='python', template_name=None,
                          keyword='def ', weeks_past=12,
@@ -6,11 +6,11 @@ import tempfile
 import re
 import difflib
 
-from server.models import Assignment, Backup, db
+from server.models import Assignment, Backup, FileBlob, db
 from server.utils import encode_id
 from server import jobs
 
-@jobs.background_job
+@jobs.background_job(queue='bulk', singleton=True)
 def submit_to_moss(moss_id=None, file_regex=".*", assignment_id=None, language=None,
                    subtract_template=False):
     logger = jobs.get_job_logger()
@@ -21,28 +21,17 @@ def submit_to_moss(moss_id=None, file_regex=".*", assignment_id=None, language=N
         logger.info("Could not find assignment")
         return
 
-    subms = assign.course_submissions(include_empty=False)
-
-    subm_keys = set()
-    for subm in subms:
-        if subm['backup']['id'] in subm_keys:
-            continue
-        else:
-            subm_keys.add(subm['backup']['id'])
-
-        if subm['group']:
-            group_members = subm['group']['group_member_emails'] or []
-            group_members.append(subm['user']['email'])
-            logger.info("{} -> {}".format(encode_id(subm['backup']['id']),
-                                          ', '.join(group_members)))
-        else:
-            logger.info("{} -> {}".format(encode_id(subm['backup']['id']),
-                                          subm['user']['email']))
+    owners = assign.final_submission_owners()
+    for backup_id, emails in owners.items():
+        logger.info("{} -> {}".format(encode_id(backup_id), ', '.join(emails)))
+    subm_keys = set(owners)
 
     backup_query = (Backup.query.options(db.joinedload('messages'))
                           .filter(Backup.id.in_(subm_keys))
                           .order_by(Backup.created.desc())
                           .all())
+    FileBlob.resolve_messages([m for b in backup_query for m in b.messages
+                               if m.kind == 'file_contents'])
 
     logger.info("Retreived {} final submissions".format(len(subm_keys)))
     # TODO: Customize the location of the tmp writing (especially useful during dev)
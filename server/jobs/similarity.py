@@ -0,0 +1,368 @@
+""" An in-process alternative to MOSS.
+
+Each submission is tokenized, hashed into k-grams of tokens and winnowed
+into a set of fingerprints (Schleimer, Wilkerson and Aiken, "Winnowing:
+Local Algorithms for Document Fingerprinting"). An inverted index from
+fingerprint to submissions is then used to score only the pairs of
+submissions that actually share fingerprints.
+"""
+import collections
+import difflib
+import itertools
+import json
+import logging
+import re
+import zlib
+
+from flask import escape
+from flask_rq import get_queue
+import pygments.lexers
+from pygments.token import Token
+from pygments.util import ClassNotFound
+import redis.exceptions
+from sqlalchemy.exc import IntegrityError
+
+from server import jobs, utils
+from server.constants import SOURCE_SIZE_LIMIT
+from server.jobs.export import final_files
+from server.models import (Assignment, Backup, ExternalFile, FileBlob,
+                           Fingerprint, FingerprintCount, db)
+from server.utils import encode_id
+
+logger = logging.getLogger(__name__)
+
+K = 5          # number of tokens in a k-gram; shorter matches are ignored
+# Winnowing window; matches of at least K + WINDOW - 1 tokens are always found
+WINDOW = 4
+MAX_SHARED = 10   # ignore fingerprints shared by more than this many submissions
+NUM_RESULTS = 250  # number of pairs to include in a report
+INDEX_BATCH_SIZE = 50  # number of backups loaded at a time by index_submissions
+INDEX_SHARD_SIZE = 500  # number of backups indexed by each shard of start_index_job
+INDEX_RETRIES = 3  # attempts to save a backup's fingerprints
+
+# Languages (from COMMON_LANGUAGES) whose Pygments lexer has a different name
+LEXER_NAMES = {
+    'python': 'python3',
+}
+
+def get_lexer(language):
+    try:
+        return pygments.lexers.get_lexer_by_name(
+            LEXER_NAMES.get(language, language), stripnl=False)
+    except ClassNotFound:
+        raise ValueError('Unknown language {}'.format(language))
+
+def language_for(filename):
+    """ Return the language of FILENAME, or None if it is not source code. """
+    try:
+        lexer = pygments.lexers.find_lexer_class_for_filename(filename)
+    except ClassNotFound:
+        return None
+    if lexer is None or lexer.name == 'Text only':
+        return None
+    return lexer.aliases[0]
+
+def tokenize(source, language):
+    """ Return a list of (token, line number) pairs for SOURCE. Comments and
+    whitespace are dropped and names, strings and numbers are replaced by
+    placeholders, so that renaming variables does not hide copied code.
+    """
+    tokens = []
+    line = 1
+    for ttype, value in get_lexer(language).get_tokens(source):
+        if ttype in Token.Comment or ttype in Token.Literal.String.Doc:
+            pass
+        elif ttype in Token.Name:
+            tokens.append(('V', line))
+        elif ttype in Token.Literal.String:
+            tokens.append(('S', line))
+        elif ttype in Token.Literal.Number:
+            tokens.append(('N', line))
+        elif value.strip():
+            tokens.append((value.strip(), line))
+        line += value.count('\n')
+    return tokens
+
+def fingerprints(tokens, k=K, window=WINDOW):
+    """ Winnow the k-grams of TOKENS, returning a dict that maps each selected
+    hash to the line on which its k-gram starts. Hashes are 31-bit CRC32s, so
+    they are stable across processes and fit in a Fingerprint row.
+    """
+    hashes = [(zlib.crc32(' '.join(t for t, _ in tokens[i:i + k]).encode('utf-8')) &
+               0x7fffffff, tokens[i][1])
+              for i in range(len(tokens) - k + 1)]
+    selected = {}
+    last = None
+    for start in range(max(len(hashes) - window + 1, 1)):
+        positions = range(start, min(start + window, len(hashes)))
+        if not positions:
+            break
+        # Select the rightmost minimum, as in the paper
+        position = min(positions, key=lambda i: (hashes[i][0], -i))
+        if position != last:
+            value, line = hashes[position]
+            selected.setdefault(value, line)
+            last = position
+    return selected
+
+def added_source(template, source):
+    """ Blank out the lines of SOURCE that also appear in TEMPLATE, keeping
+    line numbers intact.
+    """
+    d = difflib.Differ(linejunk=difflib.IS_LINE_JUNK,
+                       charjunk=difflib.IS_CHARACTER_JUNK)
+    diff = d.compare(template.splitlines(keepends=True),
+                     source.splitlines(keepends=True))
+    lines = []
+    for line in diff:
+        if line[0] == '+':
+            lines.append(line[2:])
+        elif line[0] == ' ':
+            lines.append('\n')
+    return ''.join(lines)
+
+def submission_fingerprints(assign, backup_ids, language, file_regex='.*',
+                            subtract_template=False):
+    """ Return an OrderedDict mapping each of BACKUP_IDS to a dict of its
+    fingerprints -> (filename, line). Fingerprints of the assignment
+    templates are always ignored, like MOSS base files. With
+    SUBTRACT_TEMPLATE, lines copied from the template are dropped first.
+    """
+    match_pattern = re.compile(file_regex)
+    templates = {name: source for name, source in (assign.files or {}).items()
+                 if match_pattern.match(name)}
+    ignored = set()
+    for source in templates.values():
+        ignored.update(fingerprints(tokenize(source, language)))
+
+    documents = collections.OrderedDict()
+    for message, filename, source in final_files(backup_ids):
+        if not match_pattern.match(filename):
+            continue
+        if subtract_template and filename in templates:
+            source = added_source(templates[filename], source)
+        document = documents.setdefault(message.backup_id, {})
+        for value, line in fingerprints(tokenize(source, language)).items():
+            if value not in ignored:
+                document.setdefault(value, (filename, line))
+    return documents
+
+def compare(documents, max_shared=MAX_SHARED, num_results=NUM_RESULTS):
+    """ Score every pair of DOCUMENTS (as returned by submission_fingerprints)
+    that share a fingerprint. Return up to NUM_RESULTS matches, most similar
+    first, as dicts with the two keys, the fraction of each document that is
+    shared, and the matching (filename, line) locations in each.
+    Like MOSS's -m option, fingerprints in more than MAX_SHARED documents are
+    treated as common code, so the number of pairs stays linear in the number
+    of documents.
+    """
+    index = collections.defaultdict(list)
+    for key, document in documents.items():
+        for value in document:
+            index[value].append(key)
+
+    common = {value for value, keys in index.items() if len(keys) > max_shared}
+    shared = collections.Counter()
+    for value, keys in index.items():
+        if 1 < len(keys) <= max_shared:
+            shared.update(itertools.combinations(keys, 2))
+
+    def fraction(key, count):
+        return count / len(documents[key])
+
+    ranked = sorted(shared.items(), reverse=True,
+                    key=lambda item: max(fraction(item[0][0], item[1]),
+                                         fraction(item[0][1], item[1])))
+    matches = []
+    for (a, b), count in ranked[:num_results]:
+        values = (set(documents[a]) & set(documents[b])) - common
+        matches.append({
+            'a': a,
+            'b': b,
+            'shared': count,
+            'a_fraction': fraction(a, count),
+            'b_fraction': fraction(b, count),
+            'a_lines': sorted(documents[a][v] for v in values),
+            'b_lines': sorted(documents[b][v] for v in values),
+        })
+    return matches
+
+def index_backup(backup):
+    """ Add the fingerprints of a submitted BACKUP to the Fingerprint index.
+    The language of each file is guessed from its name, and fingerprints
+    that also occur in the assignment templates are left out.
+    """
+    files = {}
+    for message in backup.messages:
+        if message.kind == 'file_contents':
+            files = message.contents
+    templates = backup.assignment.files or {}
+
+    rows = {}
+    for filename, source in sorted(files.items()):
+        language = language_for(filename)
+        if (not language or not isinstance(source, str) or
+                len(source) > SOURCE_SIZE_LIMIT):
+            continue
+        found = fingerprints(tokenize(source, language))
+        if isinstance(templates.get(filename), str):
+            for value in fingerprints(tokenize(templates[filename], language)):
+                found.pop(value, None)
+        for value, line in found.items():
+            rows.setdefault(value, {'backup_id': backup.id, 'value': value,
+                                    'filename': filename[:255], 'line': line})
+    save_fingerprints(list(rows.values()))
+
+def save_fingerprints(rows):
+    """ Insert the Fingerprint ROWS of a backup and count them in
+    FingerprintCount. Retried if another indexer adds one of the same new
+    values at the same time.
+    """
+    for attempt in range(INDEX_RETRIES):
+        try:
+            db.session.bulk_insert_mappings(Fingerprint, rows)
+            FingerprintCount.add([row['value'] for row in rows])
+            db.session.commit()
+            return
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == INDEX_RETRIES - 1:
+                raise
+
+def unindexed_submissions(assignment_id=None):
+    """ Return the IDs of submissions (of ASSIGNMENT_ID, if given) that have
+    not been indexed yet.
+    """
+    indexed = db.session.query(Fingerprint.backup_id).filter(
+        Fingerprint.backup_id == Backup.id)
+    query = db.session.query(Backup.id).filter(Backup.submit == True,
+                                               ~indexed.exists())
+    if assignment_id is not None:
+        query = query.filter(Backup.assignment_id == assignment_id)
+    return [backup_id for backup_id, in query]
+
+def index_submissions(assignment_id=None):
+    """ Index every submission (of ASSIGNMENT_ID, if given) that has not been
+    indexed yet. Used to backfill the index; new submissions are indexed as
+    they are made. Returns the number of backups indexed.
+    """
+    return index_backups(unindexed_submissions(assignment_id))
+
+def index_backups(backup_ids):
+    """ Index the backups in BACKUP_IDS that are not indexed yet, loading
+    INDEX_BATCH_SIZE at a time. Returns the number of backups indexed.
+    """
+    indexed = db.session.query(Fingerprint.backup_id).filter(
+        Fingerprint.backup_id == Backup.id)
+    count = 0
+    for batch in utils.batches(backup_ids, INDEX_BATCH_SIZE):
+        backups = (Backup.query.options(db.joinedload('messages'),
+                                        db.joinedload('assignment'))
+                               .filter(Backup.id.in_(batch), ~indexed.exists())
+                               .all())
+        FileBlob.resolve_messages([m for b in backups for m in b.messages
+                                   if m.kind == 'file_contents'])
+        for backup in backups:
+            index_backup(backup)
+        count += len(backups)
+    return count
+
+def index_submission(backup_id):
+    """ Index the submission BACKUP_ID, unless it is already indexed. Runs
+    on a maintenance worker (see queue_index).
+    """
+    index_backups([backup_id])
+
+@jobs.background_job(queue='bulk')
+def index_shard(backup_ids, assignment_id):
+    logger = jobs.get_job_logger()
+    count = index_backups(backup_ids)
+    logger.info('Indexed {} of {} submissions'.format(count, len(backup_ids)))
+    return str(count)
+
+@jobs.background_job(queue='bulk')
+def finish_index(assignment_id):
+    logger = jobs.get_job_logger()
+    total = sum(int(result) for result in jobs.gather())
+    logger.info('Indexed {} submissions in total'.format(total))
+    return str(total)
+
+def start_index_job(assign, user_id):
+    """ Index the submissions of ASSIGN that are not indexed yet, with one
+    shard of up to INDEX_SHARD_SIZE submissions per bulk worker job.
+    Returns the parent Job.
+    """
+    shards = utils.batches(unindexed_submissions(assign.id), INDEX_SHARD_SIZE)
+    description = 'Index submissions for {}'.format(assign.display_name)
+    return jobs.fan_out(index_shard, shards, finish_index, assign.id,
+                        description=description,
+                        course_id=assign.course_id, user_id=user_id,
+                        timeout=60 * 60)
+
+def queue_index(backup):
+    """ Index a new submission in the background, so that submitting does
+    not wait for it. If Redis is down, the submission is indexed by the next
+    index_submissions backfill instead.
+    """
+    try:
+        get_queue('maintenance').enqueue(index_submission, backup.id)
+    except redis.exceptions.ConnectionError:
+        logger.warning('Could not queue indexing of backup %s', backup.id,
+                       exc_info=True)
+
+def json_report(matches, owners):
+    return json.dumps([dict(match,
+                            a=encode_id(match['a']), b=encode_id(match['b']),
+                            a_emails=owners[match['a']],
+                            b_emails=owners[match['b']])
+                       for match in matches], indent=2)
+
+def html_report(matches, owners):
+    def submission(backup_id, fraction):
+        return "<a href='/admin/grading/{0}'>{0}</a> {1} ({2:.0%})".format(
+            encode_id(backup_id), escape(', '.join(owners[backup_id])), fraction)
+
+    rows = ['<tr><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+                submission(match['a'], match['a_fraction']),
+                submission(match['b'], match['b_fraction']),
+                match['shared'])
+            for match in matches]
+    return ('<table class="table"><tr><th>Submission</th><th>Submission</th>'
+            '<th>Shared Fingerprints</th></tr>{}</table>'.format(''.join(rows)))
+
+@jobs.background_job(queue='bulk', singleton=True)
+def check_similarity(assignment_id=None, language=None, file_regex='.*',
+                     subtract_template=False, report_format='html',
+                     max_shared=MAX_SHARED, num_results=NUM_RESULTS):
+    logger = jobs.get_job_logger()
+    logger.info('Starting similarity check...')
+
+    assign = Assignment.query.get(assignment_id)
+    if not assign:
+        logger.info("Could not find assignment")
+        return
+
+    owners = assign.final_submission_owners()
+    logger.info("Retreived {} final submissions".format(len(owners)))
+    documents = submission_fingerprints(assign, owners, language,
+                                        file_regex=file_regex,
+                                        subtract_template=subtract_template)
+    empty = [backup_id for backup_id in owners if not documents.get(backup_id)]
+    if empty:
+        logger.info("{} submissions had no matching files".format(len(empty)))
+    if not documents:
+        raise Exception("Did not match any files")
+
+    matches = compare(documents, max_shared=max_shared, num_results=num_results)
+    logger.info("Found {} similar pairs".format(len(matches)))
+
+    if report_format == 'json':
+        name = '{}-similarity.json'.format(assign.name.replace('/', '-'))
+        upload = ExternalFile.upload([json_report(matches, owners).encode('utf-8')],
+                                     user_id=jobs.get_current_job().user_id,
+                                     course_id=assign.course_id,
+                                     assignment_id=assign.id,
+                                     name=name, prefix='jobs/similarity/')
+        logger.info("Saved as: {}".format(upload.object_name))
+        return "<a href='{0}'>{1}</a>".format(upload.download_link, name)
+    return html_report(matches, owners)
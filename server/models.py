@@ -1,26 +1,29 @@
 # TODO: Split models into distinct .py files
 from werkzeug.exceptions import BadRequest
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_login import UserMixin
 
 from sqlalchemy import PrimaryKeyConstraint, MetaData, types
 from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import aliased, backref
-from sqlalchemy.sql import text
 
 from markdown import markdown
 import pytz
 
 import functools
 
+import collections
 from collections import namedtuple, Counter
 
 import contextlib
 import csv
 from datetime import datetime as dt
+import hashlib
+import itertools
 import json
 import logging
 import shlex
@@ -28,11 +31,12 @@ import urllib.parse
 import mimetypes
 
 from server.constants import (VALID_ROLES, STUDENT_ROLE, STAFF_ROLES, TIMEZONE,
-                              SCORE_KINDS, OAUTH_OUT_OF_BAND_URI)
+                              SCORE_KINDS, OAUTH_OUT_OF_BAND_URI,
+                              IN_QUERY_BATCH_SIZE, FINGERPRINT_MAX_SHARED)
 
 from server.extensions import cache, storage
-from server.utils import (encode_id, chunks, generate_number_table,
-                          humanize_name)
+from server.utils import (encode_id, chunks, batches,
+                          humanize_name, request_cache, clear_request_cache)
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +65,18 @@ def transaction(f):
     return wrapper
 
 
+def has_window_functions(engine):
+    """ Return whether the database of ENGINE supports window functions like
+    ROW_NUMBER(): PostgreSQL, SQLite 3.25+ and MySQL 8. MySQL 5.7 does not.
+    """
+    version = engine.dialect.server_version_info or ()
+    if engine.name == 'sqlite':
+        return version >= (3, 25)
+    if engine.name == 'mysql':
+        return version >= (8,)
+    return engine.name == 'postgresql'
+
+
 class Json(types.TypeDecorator):
     impl = types.Text
 
@@ -70,6 +86,8 @@ class Json(types.TypeDecorator):
 
     def process_result_value(self, value, dialect):
         # SQL -> Python
+        if value is None:
+            return None
         return json.loads(value)
 
 
@@ -203,7 +221,8 @@ class User(Model, UserMixin):
                            .order_by(Course.created.desc()))
         return query.all()
 
-    @cache.memoize(120)
+    @cache.memoize(120, scope=lambda self, course_id, roles=VALID_ROLES:
+                   ('enrollment', self.id, course_id))
     def is_enrolled(self, course_id, roles=VALID_ROLES):
         for enroll in self.participations:
             if enroll.course_id == course_id and enroll.role in roles:
@@ -214,7 +233,7 @@ class User(Model, UserMixin):
     def identifier(self):
         return humanize_name(self.name) or self.email
 
-    @cache.memoize(3600)
+    @cache.memoize(3600, scope=lambda self: ('grading-tasks', self.id))
     def num_grading_tasks(self):
         # TODO: Pass in assignment_id (Useful for course dashboard)
         return GradingTask.query.filter_by(grader=self, score_id=None).count()
@@ -289,6 +308,73 @@ class Course(Model):
                             .all()
                             )]
 
+    def user_statuses(self, user, assignments, staff_view=False):
+        """ Return Assignment.user_status(USER, STAFF_VIEW) for each of
+        ASSIGNMENTS in this course, in order. Groups, final submissions (from
+        FinalSubmission) and scores are each read for all of the assignments
+        at once, instead of with several queries per assignment.
+        """
+        assignment_ids = [a.id for a in assignments]
+        if not assignment_ids:
+            return []
+
+        groups = {}
+        memberships = (GroupMember.query
+                                  .options(db.joinedload(GroupMember.group))
+                                  .filter(GroupMember.user_id == user.id,
+                                          GroupMember.assignment_id.in_(assignment_ids)))
+        for member in memberships:
+            groups[member.assignment_id] = member.group
+
+        user_member = aliased(GroupMember)
+        members = (db.session.query(GroupMember.assignment_id, GroupMember.user_id)
+                     .join(user_member, GroupMember.group_id == user_member.group_id)
+                     .filter(user_member.user_id == user.id,
+                             user_member.assignment_id.in_(assignment_ids),
+                             user_member.status == 'active',
+                             GroupMember.status == 'active'))
+        user_ids = {aid: {user.id} for aid in assignment_ids}
+        for assignment_id, user_id in members:
+            user_ids[assignment_id].add(user_id)
+        cached_groups = request_cache('groups')
+        for assignment_id, group_ids in user_ids.items():
+            for member_id in group_ids:
+                cached_groups[assignment_id, member_id] = frozenset(group_ids)
+
+        finals = {}
+        final_submissions = (
+            FinalSubmission.query
+                           .options(db.joinedload(FinalSubmission.backup)
+                                      .joinedload(Backup.scores))
+                           .filter(FinalSubmission.user_id == user.id,
+                                   FinalSubmission.assignment_id.in_(assignment_ids)))
+        for final in final_submissions:
+            # The final backup is only a submission if the group has one
+            if final.backup.submit:
+                finals[final.assignment_id] = final.backup
+
+        scores = collections.defaultdict(list)
+        for score in (Score.query
+                           .filter(Score.user_id.in_(set().union(*user_ids.values())),
+                                   Score.assignment_id.in_(assignment_ids),
+                                   Score.archived == False)
+                           .order_by(Score.score.desc(), Score.created.desc())):
+            if score.user_id in user_ids[score.assignment_id]:
+                scores[score.assignment_id].append(score)
+
+        statuses = []
+        for assignment in assignments:
+            final_submission = finals.get(assignment.id)
+            statuses.append(Assignment.user_assignment(
+                assignment=assignment,
+                subm_time=final_submission and final_submission.created,
+                group=groups.get(assignment.id),
+                final_subm=final_submission,
+                scores=assignment.max_scores(scores[assignment.id],
+                                             only_published=not staff_view),
+            ))
+        return statuses
+
 
 class Assignment(Model):
     """ Assignments are particular to courses and have unique names.
@@ -345,48 +431,37 @@ class Assignment(Model):
         return is_staff
 
     @staticmethod
-    @cache.memoize(180)
-    def assignment_stats(assign_id, detailed=True):
+    def assignment_stats(assign_id):
+        """ Return the statistics of an assignment, from its AssignmentStats
+        counters. Every student's final submission is loaded separately, by
+        cached_course_submissions.
+        """
         assignment = Assignment.query.get(assign_id)
-        base_query = Backup.query.filter_by(assignment=assignment)
-        stats = {
-            'submissions': base_query.filter_by(submit=True).count(),
-            'backups': base_query.count(),
-            'groups': Group.query.filter_by(assignment=assignment).count(),
+        counts = AssignmentStats.lookup(assign_id)
+        total_students = Enrollment.query.filter_by(course_id=assignment.course_id,
+                                                    role=STUDENT_ROLE).count()
+        started, finished = counts['students_started'], counts['students_finished']
+        return {
+            'submissions': counts['submissions'],
+            'backups': counts['backups'],
+            'groups': counts['groups'],
+            'unique_submissions': counts['unique_submissions'],
+            'students_with_subm': finished,
+            'students_with_backup': started - finished,
+            'students_no_backup': max(total_students - started, 0),
+            'percent_started': (started / (total_students or 1)) * 100,
+            'percent_finished': (finished / (total_students or 1)) * 100,
+            'active_groups': counts['active_groups'],
+            'percent_groups_active': counts['active_groups'] / (counts['groups'] or 1),
         }
-        data = assignment.course_submissions()
-        submissions = [fs['backup'] for fs in data if fs['backup']]
-        submissions_id = set(fs['id'] for fs in submissions)
-
-        students_with_subms = set(s['user']['id'] for s in data
-                                  if s['backup'] and s['backup']['submit'])
-        students_with_backup = set(s['user']['id'] for s in data
-                                   if s['backup'] and not s['backup']['submit'])
-        students_without_subms = set(s['user']['id'] for s in data
-                                     if not s['backup'])
-        groups = [g['group'] for g in data if g['group']]
-        total_students = len(data)
-        percent_started = ((len(students_with_subms) + len(students_with_backup)) /
-                           (total_students or 1)) * 100
-        percent_finished = (len(students_with_subms) / (total_students or 1)) * 100
-        active_groups = len({g['group_id'] for g in groups if ',' in g['group_member']})
-
-        stats.update({
-            'unique_submissions': len(submissions_id),
-            'students_with_subm': len(students_with_subms),
-            'students_with_backup': len(students_with_backup),
-            'students_no_backup': len(students_without_subms),
-            'percent_started': percent_started,
-            'percent_finished': percent_finished,
-            'active_groups': active_groups,
-            'percent_groups_active': active_groups/(stats['groups'] or 1)
-        })
-
-        if detailed:
-            stats.update({
-                'raw_data': data
-            })
-        return stats
+
+    @staticmethod
+    @cache.memoize(180, local=False, single_flight=True)
+    def cached_course_submissions(assign_id):
+        """ course_submissions for the statistics page, which can be up to a
+        few minutes old.
+        """
+        return Assignment.query.get(assign_id).course_submissions()
 
     @staticmethod
     @cache.memoize(1000)
@@ -522,84 +597,119 @@ class Assignment(Model):
         """ Return data on all course submissions for all enrolled users
         List of dictionaries with user, group, backup dictionaries.
         Sample [ {'user': {}, 'group': {}, 'backup': {} }]
+        Final submissions are read from the FinalSubmission table, so this
+        takes the same two queries no matter how many students there are.
         """
-        current_db = db.engine.name
-        if current_db != 'mysql':
-            return self.course_submissions_slow(include_empty=include_empty)
+        finals = db.select([FinalSubmission.user_id, FinalSubmission.backup_id]).where(
+            FinalSubmission.assignment_id == self.id).alias('finals')
+        return self._course_submissions(finals, include_empty)
 
-        # Can only run the fast query on MySQL
-        submissions = []
+    def final_submission_owners(self):
+        """ Return an OrderedDict mapping the ID of every final submission of
+        enrolled students to the emails of the students it counts for.
+        """
+        owners = collections.OrderedDict()
+        for subm in self.course_submissions(include_empty=False):
+            owners.setdefault(subm['backup']['id'], []).append(subm['user']['email'])
+        return owners
+
+    def course_submissions_window(self, include_empty=True):
+        """ Return the same data as course_submissions, but compute final
+        submissions from the backup and group_member tables directly (see
+        final_submissions_query) instead of reading FinalSubmission. On a
+        database without window functions, use course_submissions_slow.
+        """
+        if not has_window_functions(db.engine):
+            return self.course_submissions_slow(include_empty)
+        finals = self.final_submissions_query().alias('finals')
+        return self._course_submissions(finals, include_empty)
+
+    def final_submissions_query(self):
+        """ Return a select of (user_id, backup_id) for every user with a
+        backup for this assignment. Backups are ranked per group (or per user
+        for users not in a group) with ROW_NUMBER(), so this needs a database
+        with window functions (see has_window_functions).
+        """
+        members = db.select([GroupMember.user_id, GroupMember.group_id]).where(
+            db.and_(GroupMember.assignment_id == self.id,
+                    GroupMember.status == 'active')).cte('members')
+        ranked = db.select([
+            Backup.id.label('backup_id'),
+            Backup.submitter_id,
+            members.c.group_id,
+            db.func.row_number().over(
+                partition_by=[members.c.group_id,
+                              db.case([(members.c.group_id == None,
+                                        Backup.submitter_id)])],
+                order_by=[Backup.flagged.desc(), Backup.submit.desc(),
+                          Backup.created.desc(), Backup.id.desc()]
+            ).label('position'),
+        ]).select_from(
+            Backup.__table__.outerjoin(
+                members, members.c.user_id == Backup.submitter_id)
+        ).where(Backup.assignment_id == self.id).cte('ranked')
+        best = db.select([ranked]).where(ranked.c.position == 1).cte('best')
+
+        grouped = db.select([members.c.user_id, best.c.backup_id]).select_from(
+            members.join(best, best.c.group_id == members.c.group_id))
+        solo = db.select([best.c.submitter_id.label('user_id'),
+                          best.c.backup_id]).where(best.c.group_id == None)
+        return db.union_all(grouped, solo)
+
+    def _course_submissions(self, finals, include_empty):
+        """ Build course_submissions from FINALS, a selectable of
+        (user_id, backup_id) for this assignment.
+        """
+        students = (db.session.query(User.id, User.name, User.email, Backup)
+                    .select_from(Enrollment)
+                    .join(User, User.id == Enrollment.user_id)
+                    .outerjoin(finals, finals.c.user_id == Enrollment.user_id)
+                    .outerjoin(Backup, Backup.id == finals.c.backup_id)
+                    .filter(Enrollment.course_id == self.course_id,
+                            Enrollment.role == STUDENT_ROLE)
+                    .order_by(Enrollment.user_id)
+                    .all())
+        members = (db.session.query(GroupMember.group_id, User.id, User.name,
+                                    User.email)
+                   .join(User, User.id == GroupMember.user_id)
+                   .filter(GroupMember.assignment_id == self.id,
+                           GroupMember.status == 'active')
+                   .order_by(GroupMember.group_id, User.id)
+                   .all())
+        groups, group_ids = {}, {}
+        for group_id, *user_info in members:
+            groups.setdefault(group_id, []).append(user_info)
+            group_ids[user_info[0]] = group_id
 
-        stats = self.mysql_course_submissions_query()
-        keys = stats.keys()
-        for r in stats:
-            user_info = {k: v for k, v in zip(keys[:3], r[:3])}
-            group_info = {k: v for k, v in zip(keys[3:6], r[3:6])}
-            if group_info['group_member_emails']:
-                group_info['group_member_emails'] = group_info['group_member_emails'].split(',')
-            backup_info = {k: v for k, v in zip(keys[6:], r[6:])}
-            if not include_empty and backup_info['id'] is None:
+        seen = set()
+        submissions = []
+        for user_id, name, email, backup in students:
+            if user_id in seen:
+                continue
+            group_id = group_ids.get(user_id)
+            group_members = groups[group_id] if group_id else [(user_id, name, email)]
+            member_ids = [member_id for member_id, _, _ in group_members]
+            seen.update(member_ids)
+            if not backup and not include_empty:
                 continue
-            data = {'user': user_info,
-                    'group': group_info if group_info.get('group_id') else None,
-                    'backup': backup_info if backup_info.get('id') else None}
-            submissions.append(data)
+            group_info = {
+                'group_id': group_id,
+                'group_member': ','.join(str(u_id) for u_id in member_ids),
+                'group_member_emails': [e for _, _, e in group_members]
+            } if group_id else None
+            backup_info = backup.as_dict() if backup else None
+            for member_id, member_name, member_email in group_members:
+                submissions.append({
+                    'user': {
+                        'id': member_id,
+                        'name': member_name,
+                        'email': member_email,
+                    },
+                    'group': dict(group_info) if group_info else None,
+                    'backup': dict(backup_info) if backup_info else None,
+                })
         return submissions
 
-    def mysql_course_submissions_query(self):
-        """ For MySQL Clients only. Returns a SQLAlchemy result proxy object
-        Contains all of the following fields.
-
-        id  email   name                  group_id group_member group_member_emails
-        5   dschmidt1@gmail.com 'david s' 3   5,15 dschmidt1@gmail.com, foo@bar.com
-
-        created id  id submitter_id assignment_id submit  flagged
-        2016-09-07 20:22:04 4790    15  1   1   1
-        """
-        giant_query = """SELECT * FROM
-              (SELECT u.id,
-                      u.email,
-                      u.name,
-                      gm.group_id,
-                      GROUP_CONCAT(IFNULL(gm2.user_id, u.id)) AS group_member,
-                      GROUP_CONCAT((SELECT partners.email from user as partners
-                                    where id = gm2.user_id AND partners.id != u.id)) AS group_member_emails
-               FROM
-                 (SELECT u.id,
-                         u.email,
-                         u.name
-                  FROM user AS u,
-                               enrollment AS e
-                  WHERE e.course_id = :course_id
-                    AND e.user_id = u.id
-                    AND e.role='student') AS u
-               LEFT JOIN
-                 (SELECT *
-                  FROM group_member
-                  WHERE status = 'active'
-                    AND assignment_id = :assign_id) AS gm ON u.id = gm.user_id
-               LEFT JOIN group_member AS gm2 ON gm2.group_id = gm.group_id
-               AND gm2.status = 'active'
-               GROUP BY u.id) AS members
-            LEFT JOIN backup AS b2 ON b2.id=
-              (SELECT id
-               FROM backup AS b3,
-                 ({group_number_table}) AS member_index_counter
-               WHERE assignment_id=:assign_id
-                 AND b3.submitter_id = CAST(NULLIF(SUBSTRING_INDEX(members.group_member, ',', -pos),
-                                                   SUBSTRING_INDEX(members.group_member, ',', 1 - pos))
-                                            AS UNSIGNED)
-               ORDER BY flagged DESC, submit DESC, created DESC LIMIT 1)
-               ORDER BY group_id DESC;
-        """.format(group_number_table=generate_number_table(self.max_group_size))
-
-        giant_query = text(giant_query)
-        giant_query = giant_query.bindparams(db.bindparam("course_id", db.Integer),
-                                             db.bindparam("assign_id", db.Integer))
-        result = db.session.execute(giant_query, {'course_id': self.course.id,
-                                                  'assign_id': self.id})
-        return result
-
     def course_submissions_slow(self, include_empty=True):
         """ Return course submissions info with a slow set of queries."""
         seen = set()
@@ -610,11 +720,12 @@ class Assignment(Model):
                 group_ids = self.active_user_ids(student.user_id)
                 group_obj = Group.lookup(student_user, self)
                 if group_obj:
-                    group_members = [m.user for m in group_obj.members]
+                    group_members = [m.user for m in sorted(group_obj.members,
+                                                            key=lambda m: m.user_id)]
                 else:
                     group_members = [student_user]
                 group_emails = [u.email for u in group_members]
-                group_member_ids = ','.join([str(u_id) for u_id in group_ids])
+                group_member_ids = ','.join([str(u_id) for u_id in sorted(group_ids)])
 
                 fs = self.final_submission(group_ids)
                 if not fs:
@@ -644,20 +755,24 @@ class Assignment(Model):
         """ Return a set of the ids of all users that are active in the same group
         that our user is active in. If the user is not in a group, return just
         that user's id (i.e. as if they were in a 1-person group).
+        The group is looked up once per request, for all of its members.
         """
-        user_member = aliased(GroupMember)
-        members = GroupMember.query.join(
-            user_member, GroupMember.group_id == user_member.group_id
-        ).filter(
-            user_member.user_id == user_id,
-            user_member.assignment_id == self.id,
-            user_member.status == 'active',
-            GroupMember.status == 'active'
-        ).all()
-        if not members:
-            return {user_id}
-        else:
-            return {member.user_id for member in members}
+        groups = request_cache('groups')
+        if (self.id, user_id) not in groups:
+            user_member = aliased(GroupMember)
+            members = GroupMember.query.join(
+                user_member, GroupMember.group_id == user_member.group_id
+            ).filter(
+                user_member.user_id == user_id,
+                user_member.assignment_id == self.id,
+                user_member.status == 'active',
+                GroupMember.status == 'active'
+            ).all()
+            user_ids = (frozenset(member.user_id for member in members) or
+                        frozenset([user_id]))
+            for member_id in user_ids:
+                groups[self.id, member_id] = user_ids
+        return set(groups[self.id, user_id])
 
     def backups(self, user_ids):
         """ Return a query for the backups that the list of users has for this
@@ -712,7 +827,12 @@ class Assignment(Model):
             Score.assignment_id == self.id,
             Score.archived == False,
         ).order_by(Score.score.desc(), Score.created.desc()).all()
+        return self.max_scores(scores, only_published)
 
+    def max_scores(self, scores, only_published=True):
+        """Return the first of SCORES, which are sorted from best to worst,
+        for each kind.
+        """
         scores_by_kind = {}
         # keep only first score for each kind
         for score in scores:
@@ -832,7 +952,8 @@ class Enrollment(Model):
 
     @transaction
     def unenroll(self):
-        cache.delete_memoized(User.is_enrolled)
+        cache.invalidate_scope('enrollment', self.user_id, self.course_id)
+        AssignmentStats.mark_stale(self.course_id)
         db.session.delete(self)
 
     @staticmethod
@@ -859,44 +980,194 @@ class Enrollment(Model):
         'email', 'name', 'sid', 'class_account', and 'section'.
         Returns two integers, the number of enrollments created and the number
         of enrollments updated.
+        Existing users and enrollments are loaded for the whole batch at once,
+        and new or changed rows are written with bulk inserts and updates.
+        Emails are matched case-insensitively, like the MySQL collation does.
         """
-        created = 0
-        updated = 0
+        info_by_email = collections.OrderedDict()
         for info in enrollment_info:
-            email, name = info['email'], info['name']
-            user = User.lookup(email)
-            if user:
-                user.name = name
-            else:
-                user = User(name=name, email=email)
-                db.session.add(user)
-            record = Enrollment.query.filter_by(user_id=user.id,
-                                                course_id=cid).one_or_none()
+            info_by_email[info['email'].lower()] = info
+        emails = [info['email'] for info in info_by_email.values()]
+
+        users = Enrollment._users_by_email(emails)
+        new_users = [{'email': info['email'], 'name': info['name']}
+                     for email, info in info_by_email.items()
+                     if email not in users]
+        if new_users:
+            db.session.bulk_insert_mappings(User, new_users)
+            users = Enrollment._users_by_email(emails)
+        renamed_users = [users[email] for email, info in info_by_email.items()
+                         if users[email].name != info['name']]
+        db.session.bulk_update_mappings(User, [
+            {'id': user.id, 'name': info_by_email[user.email.lower()]['name']}
+            for user in renamed_users
+        ])
+
+        records = Enrollment._records_by_user(
+            cid, [user.id for user in users.values()])
+
+        new_records, changed_records, changed_users = [], [], []
+        for email, info in info_by_email.items():
+            user = users[email]
+            values = {
+                'user_id': user.id,
+                'course_id': cid,
+                'role': role,
+                'sid': info['sid'],
+                'class_account': info['class_account'],
+                'section': info['section'],
+            }
+            record = records.get(user.id)
             if not record:
-                record = Enrollment(course_id=cid, user_id=user.id)
-                created += 1
-            else:
-                updated += 1
-            record.role = role
-            record.sid = info['sid']
-            record.class_account = info['class_account']
-            record.section = info['section']
-            db.session.add(record)
-        cache.delete_memoized(User.is_enrolled)
-        return created, updated
+                new_records.append(values)
+                changed_users.append(user)
+            elif any(getattr(record, k) != v for k, v in values.items()):
+                changed_records.append(values)
+                changed_users.append(user)
+        db.session.bulk_insert_mappings(Enrollment, new_records)
+        db.session.bulk_update_mappings(Enrollment, changed_records)
+
+        # Bulk operations bypass the identity map, so reload anything
+        # already in the session from the updated rows
+        for user in renamed_users:
+            db.session.expire(user, ['name'])
+        for values in changed_records:
+            db.session.expire(records[values['user_id']])
+        for user in changed_users:
+            db.session.expire(user, ['participations'])
+            cache.invalidate_scope('enrollment', user.id, cid)
+        if changed_users:
+            AssignmentStats.mark_stale(cid)
+        return len(new_records), len(info_by_email) - len(new_records)
+
+    @staticmethod
+    def _users_by_email(emails):
+        """ Return a dict of the users with EMAILS, by lowercase email."""
+        users = {}
+        for batch in batches(emails, IN_QUERY_BATCH_SIZE):
+            for user in User.query.filter(User.email.in_(batch)):
+                users[user.email.lower()] = user
+        return users
+
+    @staticmethod
+    def _records_by_user(cid, user_ids):
+        """ Return a dict of the enrollments of USER_IDS in CID, by user ID."""
+        records = {}
+        for batch in batches(user_ids, IN_QUERY_BATCH_SIZE):
+            for record in Enrollment.query.filter(Enrollment.course_id == cid,
+                                                  Enrollment.user_id.in_(batch)):
+                records[record.user_id] = record
+        return records
+
+class FileBlob(Model):
+    """ Content-addressed storage for submitted files. Each distinct file is
+    stored once, keyed by the SHA-256 digest of its contents, and referenced
+    from Message.digests.
+    """
+    __tablename__ = 'file_blob'
+    __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+
+    digest = db.Column(db.String(64), primary_key=True)
+    contents = db.Column(mysql.MEDIUMBLOB, nullable=False)
+
+    @staticmethod
+    def digest_of(source):
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def store(files):
+        """ Store FILES, a dictionary of filenames to contents, and return a
+        dictionary of filenames to digests. Only contents that have not been
+        seen before are inserted.
+        """
+        digests = {name: FileBlob.digest_of(source)
+                   for name, source in files.items()}
+        sources = {digests[name]: source for name, source in files.items()}
+        if not sources:
+            return digests
+        existing = {digest for digest, in (db.session.query(FileBlob.digest)
+                                             .filter(FileBlob.digest.in_(sources))
+                                             .all())}
+        missing = [{'digest': digest, 'contents': source.encode('utf-8')}
+                   for digest, source in sources.items() if digest not in existing]
+        if missing:
+            # A concurrent request may insert the same blob first
+            insert = (FileBlob.__table__.insert()
+                                        .prefix_with('IGNORE', dialect='mysql')
+                                        .prefix_with('OR IGNORE', dialect='sqlite'))
+            db.session.execute(insert, missing)
+        return digests
+
+    @staticmethod
+    def lookup(digests):
+        """ Return a dictionary of digests to contents for DIGESTS."""
+        digests = set(digests)
+        if not digests:
+            return {}
+        blobs = (db.session.query(FileBlob.digest, FileBlob.contents)
+                           .filter(FileBlob.digest.in_(digests))
+                           .all())
+        return {digest: contents.decode('utf-8') for digest, contents in blobs}
+
+    @staticmethod
+    def resolve_messages(messages):
+        """ Load the file contents of all deduplicated MESSAGES in one query,
+        instead of one query per message.
+        """
+        pending = [m for m in messages
+                   if m.digests is not None and m._files is None]
+        sources = FileBlob.lookup(d for m in pending for d in m.digests.values())
+        for message in pending:
+            message._files = {name: sources[digest]
+                              for name, digest in message.digests.items()}
+
 
 class Message(Model):
+    """ Backup contents sent by the client, one row per kind of message.
+    File contents are deduplicated into FileBlob rows and referenced through
+    DIGESTS (filename -> digest); CONTENTS resolves them transparently.
+    """
     __tablename__ = 'message'
     __table_args__ = {'mysql_row_format': 'COMPRESSED'}
 
     id = db.Column(db.Integer, primary_key=True)
     backup_id = db.Column(db.ForeignKey("backup.id"), nullable=False,
                           index=True)
-    contents = db.Column(JsonBlob, nullable=False)
+    _contents = db.Column('contents', JsonBlob, nullable=False)
+    digests = db.Column(Json)
     kind = db.Column(db.String(255), nullable=False, index=True)
 
     backup = db.relationship("Backup")
 
+    _files = None  # Resolved file contents of a deduplicated message
+
+    def __init__(self, kind=None, contents=None, **kwargs):
+        # Set the kind first, since it decides how the contents are stored
+        super().__init__(kind=kind, **kwargs)
+        if contents is not None:
+            self.contents = contents
+
+    @property
+    def contents(self):
+        if self.digests is None:
+            return self._contents
+        if self._files is None:
+            FileBlob.resolve_messages([self])
+        return self._files
+
+    @contents.setter
+    def contents(self, value):
+        is_files = (self.kind == 'file_contents' and isinstance(value, dict) and
+                    all(isinstance(v, str) for v in value.values()))
+        if is_files:
+            self.digests = FileBlob.store(value)
+            self._contents = {}
+            self._files = dict(value)
+        else:
+            self.digests = None
+            self._contents = value
+            self._files = None
+
 
 class Backup(Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1230,6 +1501,7 @@ class Group(Model):
         after = self.serialize()
         action = GroupAction(
             action_type=action_type,
+            assignment_id=self.assignment_id,
             user_id=user_id,
             target_id=target_id,
             group_before=before,
@@ -1237,12 +1509,555 @@ class Group(Model):
         db.session.add(action)
 
 
+class FinalSubmission(Model):
+    """ The backup that will be graded for a student on an assignment.
+    Every active member of a group shares the same row contents. Rows are
+    recomputed whenever a backup is created, flagged or unflagged, or a group
+    membership changes (see `_refresh_final_submissions`), so course-wide
+    views can read final submissions without a query per student.
+    """
+    __tablename__ = 'final_submission'
+    __table_args__ = (
+        PrimaryKeyConstraint('assignment_id', 'user_id'),
+    )
+
+    assignment_id = db.Column(db.ForeignKey("assignment.id"), nullable=False)
+    user_id = db.Column(db.ForeignKey("user.id"), nullable=False, index=True)
+    backup_id = db.Column(db.ForeignKey("backup.id"), nullable=False, index=True)
+
+    backup = db.relationship("Backup")
+
+    @staticmethod
+    def refresh(connection, assignment_id, user_ids, group_ids=(), submitted=None):
+        """ Recompute the final submission of USER_IDS for an assignment, as
+        well as of everyone active in a group with them or in GROUP_IDS.
+        Uses CONNECTION directly so that it can run in the middle of a flush.
+        Returns the change in the counts of AssignmentStats.final_counts.
+        SUBMITTED maps the IDs of backups changed by the flush to whether they
+        were submissions before it.
+        """
+        members = GroupMember.__table__
+        backups = Backup.__table__
+        table = FinalSubmission.__table__
+        user_ids, group_ids = set(user_ids), set(group_ids)
+
+        active = db.and_(members.c.assignment_id == assignment_id,
+                         members.c.status == 'active')
+        if user_ids:
+            group_ids.update(group_id for group_id, in connection.execute(
+                db.select([members.c.group_id]).where(
+                    db.and_(active, members.c.user_id.in_(user_ids)))))
+        groups = {}
+        if group_ids:
+            for group_id, user_id in connection.execute(
+                    db.select([members.c.group_id, members.c.user_id]).where(
+                        db.and_(active, members.c.group_id.in_(group_ids)))):
+                groups.setdefault(group_id, set()).add(user_id)
+        grouped_ids = set().union(*groups.values())
+        owners = list(groups.values()) + [{u} for u in user_ids - grouped_ids]
+        if not owners:
+            return {}
+
+        rows = []
+        for owner_ids in owners:
+            backup_id = connection.execute(
+                db.select([backups.c.id]).where(db.and_(
+                    backups.c.assignment_id == assignment_id,
+                    backups.c.submitter_id.in_(owner_ids)
+                )).order_by(backups.c.flagged.desc(), backups.c.submit.desc(),
+                            backups.c.created.desc(), backups.c.id.desc())
+                  .limit(1)).scalar()
+            if backup_id is not None:
+                rows.extend({'assignment_id': assignment_id, 'user_id': user_id,
+                             'backup_id': backup_id} for user_id in owner_ids)
+
+        refreshed_ids = user_ids | grouped_ids
+        before = AssignmentStats.final_counts(connection, assignment_id,
+                                              refreshed_ids, submitted)
+        connection.execute(table.delete().where(db.and_(
+            table.c.assignment_id == assignment_id,
+            table.c.user_id.in_(refreshed_ids))))
+        if rows:
+            connection.execute(table.insert(), rows)
+        after = AssignmentStats.final_counts(connection, assignment_id, refreshed_ids)
+        return {name: after[name] - before[name] for name in after}
+
+
+class AssignmentStats(Model):
+    """ Counts shown on the statistics page of an assignment. Changes to the
+    counts as backups are made and flagged are saved as AssignmentStatsChange
+    rows after each commit (see `_refresh_final_submissions`), so that
+    submissions do not wait on a lock on this row. Enrollment changes mark
+    the counts as stale instead. `./manage.py reconcile_stats` applies the
+    pending changes, recomputes stale counters and corrects any drift.
+    """
+    __tablename__ = 'assignment_stats'
+    counters = ('backups', 'submissions', 'students_started', 'students_finished',
+                'unique_submissions', 'groups', 'active_groups')
+
+    assignment_id = db.Column(db.ForeignKey("assignment.id"), primary_key=True)
+    backups = db.Column(db.Integer, nullable=False, default=0)
+    submissions = db.Column(db.Integer, nullable=False, default=0)
+    # Enrolled students whose final backup exists, or is a submission
+    students_started = db.Column(db.Integer, nullable=False, default=0)
+    students_finished = db.Column(db.Integer, nullable=False, default=0)
+    # Distinct final backups of enrolled students
+    unique_submissions = db.Column(db.Integer, nullable=False, default=0)
+    groups = db.Column(db.Integer, nullable=False, default=0)
+    # Groups with at least two active members
+    active_groups = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime(timezone=True), onupdate=db.func.now())
+
+    @staticmethod
+    def lookup(assignment_id):
+        """ Return a dict of the counters of an assignment, including the
+        changes not applied yet. Stale counters are returned as they are until
+        `reconcile_stats` recomputes them. Counters that have never been
+        computed are counted without being stored.
+        """
+        stats = AssignmentStats.query.get(assignment_id)
+        if not stats:
+            return AssignmentStats.count(db.session.connection(), assignment_id)
+        pending = AssignmentStatsChange.pending(assignment_id)
+        return {name: getattr(stats, name) + pending[name]
+                for name in AssignmentStats.counters}
+
+    @staticmethod
+    @transaction
+    def reconcile(assignment_id):
+        """ Recompute every counter of an assignment from its backups, final
+        submissions and groups, replacing its pending changes.
+        """
+        connection = db.session.connection()
+        changes = AssignmentStatsChange.__table__
+        for_assignment = changes.c.assignment_id == assignment_id
+        applied = connection.execute(
+            db.select([db.func.max(changes.c.id)]).where(for_assignment)).scalar()
+        stats = AssignmentStats.query.get(assignment_id)
+        if not stats:
+            stats = AssignmentStats(assignment_id=assignment_id)
+            db.session.add(stats)
+        for name, value in AssignmentStats.count(connection, assignment_id).items():
+            setattr(stats, name, value)
+        if applied is not None:
+            connection.execute(changes.delete().where(
+                db.and_(for_assignment, changes.c.id <= applied)))
+        return stats
+
+    @staticmethod
+    def count(connection, assignment_id):
+        """ Count every counter of an assignment from its backups, final
+        submissions and groups.
+        """
+        backups = Backup.__table__
+        total, submissions = connection.execute(
+            db.select([db.func.count(),
+                       db.func.sum(db.case([(backups.c.submit == True, 1)],
+                                           else_=0))])
+              .where(backups.c.assignment_id == assignment_id)).first()
+        counts = {'backups': total, 'submissions': submissions or 0}
+        counts.update(AssignmentStats.final_counts(connection, assignment_id))
+        counts.update(AssignmentStats.group_counts(connection, assignment_id))
+        return counts
+
+    @staticmethod
+    @transaction
+    def apply_changes():
+        """ Add the pending changes to the counters of every assignment.
+        Returns the IDs of the assignments with stale counters, whose changes
+        are left for `reconcile`.
+        """
+        connection = db.session.connection()
+        changes = AssignmentStatsChange.__table__
+        applied = connection.execute(db.select([db.func.max(changes.c.id)])).scalar()
+        if applied is None:
+            return []
+        stale_ids = []
+        for assignment_id, stale, *counts in connection.execute(
+                AssignmentStatsChange.totals().where(changes.c.id <= applied)):
+            if stale:
+                stale_ids.append(assignment_id)
+                continue
+            AssignmentStats.add(connection, assignment_id,
+                                **dict(zip(AssignmentStatsChange.counters, counts)))
+        condition = changes.c.id <= applied
+        if stale_ids:
+            condition = db.and_(condition, changes.c.assignment_id.notin_(stale_ids))
+        connection.execute(changes.delete().where(condition))
+        return stale_ids
+
+    @staticmethod
+    def pending_changes(session):
+        """ Return the changes to the counters noted in SESSION since its
+        last commit, as a dict of assignment IDs to Counters.
+        """
+        return session.info.setdefault('assignment_stats',
+                                       collections.defaultdict(Counter))
+
+    @staticmethod
+    def mark_stale(course_id):
+        """ Have the counters of every assignment in a course recomputed by the
+        next `reconcile_stats`, e.g. because its students changed.
+        """
+        changes = AssignmentStats.pending_changes(db.session)
+        for assignment_id, in db.session.query(Assignment.id).filter_by(
+                course_id=course_id):
+            changes[assignment_id]['stale'] = 1
+
+    @staticmethod
+    def final_counts(connection, assignment_id, user_ids=None, submitted=None):
+        """ Return students_started, students_finished and unique_submissions,
+        counting only USER_IDS if given. SUBMITTED maps the IDs of backups
+        whose row has changed (or been deleted) to whether it was a submission.
+        """
+        finals = FinalSubmission.__table__
+        backups = Backup.__table__
+        enrollments = Enrollment.__table__
+        course_id = db.select([Assignment.__table__.c.course_id]).where(
+            Assignment.__table__.c.id == assignment_id).as_scalar()
+        condition = db.and_(finals.c.assignment_id == assignment_id,
+                            enrollments.c.course_id == course_id,
+                            enrollments.c.role == STUDENT_ROLE)
+        if user_ids is not None:
+            condition = db.and_(condition, finals.c.user_id.in_(user_ids))
+        rows = connection.execute(
+            db.select([finals.c.backup_id, backups.c.submit])
+              .select_from(
+                  finals.outerjoin(backups, backups.c.id == finals.c.backup_id)
+                        .join(enrollments, enrollments.c.user_id == finals.c.user_id))
+              .where(condition)).fetchall()
+        submitted = submitted or {}
+        return {
+            'students_started': len(rows),
+            'students_finished': len([backup_id for backup_id, submit in rows
+                                      if submitted.get(backup_id, submit)]),
+            'unique_submissions': len({backup_id for backup_id, _ in rows}),
+        }
+
+    @staticmethod
+    def group_counts(connection, assignment_id, group_ids=None):
+        """ Return groups and active_groups, counting only GROUP_IDS if given.
+        """
+        members = GroupMember.__table__
+        groups = Group.__table__
+        group_condition = groups.c.assignment_id == assignment_id
+        member_condition = db.and_(members.c.assignment_id == assignment_id,
+                                   members.c.status == 'active')
+        if group_ids is not None:
+            group_condition = db.and_(group_condition, groups.c.id.in_(group_ids))
+            member_condition = db.and_(member_condition,
+                                       members.c.group_id.in_(group_ids))
+        total = connection.execute(
+            db.select([db.func.count()]).where(group_condition)).scalar()
+        active = db.select([members.c.group_id]).where(
+            member_condition
+        ).group_by(members.c.group_id).having(db.func.count() > 1).alias('active')
+        return {
+            'groups': total,
+            'active_groups': connection.execute(
+                db.select([db.func.count()]).select_from(active)).scalar(),
+        }
+
+    @staticmethod
+    def add(connection, assignment_id, **deltas):
+        """ Add DELTAS to the counters of an assignment. Nothing is stored if
+        the counters have not been computed yet; `lookup` counts them.
+        """
+        table = AssignmentStats.__table__
+        deltas = {name: table.c[name] + delta for name, delta in deltas.items() if delta}
+        if deltas:
+            connection.execute(table.update().where(
+                table.c.assignment_id == assignment_id).values(**deltas))
+
+
+class AssignmentStatsChange(Model):
+    """ A change to the AssignmentStats counters of an assignment, saved
+    after the commit that made it. A stale change means that the counters
+    must be recomputed.
+    """
+    __tablename__ = 'assignment_stats_change'
+    counters = AssignmentStats.counters
+
+    id = db.Column(db.Integer, primary_key=True)
+    assignment_id = db.Column(db.ForeignKey("assignment.id"), index=True,
+                              nullable=False)
+    backups = db.Column(db.Integer, nullable=False, default=0)
+    submissions = db.Column(db.Integer, nullable=False, default=0)
+    students_started = db.Column(db.Integer, nullable=False, default=0)
+    students_finished = db.Column(db.Integer, nullable=False, default=0)
+    unique_submissions = db.Column(db.Integer, nullable=False, default=0)
+    groups = db.Column(db.Integer, nullable=False, default=0)
+    active_groups = db.Column(db.Integer, nullable=False, default=0)
+    stale = db.Column(db.Boolean, nullable=False, default=False)
+
+    @staticmethod
+    def totals():
+        """ Select the number of stale changes and the sum of each counter,
+        by assignment.
+        """
+        table = AssignmentStatsChange.__table__
+        return db.select(
+            [table.c.assignment_id,
+             db.func.sum(db.case([(table.c.stale == True, 1)], else_=0))] +
+            [db.func.sum(table.c[name]) for name in AssignmentStatsChange.counters]
+        ).group_by(table.c.assignment_id)
+
+    @staticmethod
+    def pending(assignment_id):
+        """ Return a Counter of the changes to each counter of an assignment
+        that have not been applied, and the number of stale changes.
+        """
+        table = AssignmentStatsChange.__table__
+        row = db.session.execute(AssignmentStatsChange.totals().where(
+            table.c.assignment_id == assignment_id)).first()
+        if not row:
+            return Counter()
+        _, stale, *counts = row
+        return Counter(dict(zip(AssignmentStatsChange.counters, map(int, counts)),
+                            stale=int(stale)))
+
+    @staticmethod
+    def save(connection, changes):
+        """ Insert CHANGES, a dict of assignment IDs to Counters of the
+        changes to their counters.
+        """
+        rows = [dict({name: counts[name] for name in AssignmentStatsChange.counters},
+                     assignment_id=assignment_id, stale=bool(counts['stale']))
+                for assignment_id, counts in changes.items() if any(counts.values())]
+        if rows:
+            connection.execute(AssignmentStatsChange.__table__.insert(), rows)
+
+
+@db.event.listens_for(SignallingSession, 'after_flush')
+def _refresh_final_submissions(session, flush_context):
+    """ Keep FinalSubmission up to date with the backups and group memberships
+    written by this flush, note the changes to AssignmentStats counters, and
+    forget the groups looked up in this request.
+    """
+    changes = AssignmentStats.pending_changes(session)
+    user_ids, group_ids = {}, {}
+    submitted = {}  # backup id -> whether it was a submission before the flush
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Backup):
+            _count_backup(session, obj, changes[obj.assignment_id], submitted)
+            if _changes_final_submission(session, obj):
+                user_ids.setdefault(obj.assignment_id, set()).add(obj.submitter_id)
+        elif isinstance(obj, GroupMember):
+            user_ids.setdefault(obj.assignment_id, set()).add(obj.user_id)
+            group_ids.setdefault(obj.assignment_id, set()).add(obj.group_id)
+    connection = session.connection()
+    _count_groups(session, connection, changes)
+    if not user_ids:
+        return
+    if group_ids:
+        clear_request_cache('groups')
+    for assignment_id, changed_ids in user_ids.items():
+        changes[assignment_id].update(FinalSubmission.refresh(
+            connection, assignment_id, changed_ids,
+            group_ids.get(assignment_id, ()), submitted))
+
+@db.event.listens_for(SignallingSession, 'before_flush')
+def _count_groups_before_flush(session, flush_context, instances):
+    """ Count the groups that the next flush writes to before it does, so
+    that `_count_groups` can tell how the counts changed.
+    """
+    group_ids = _changed_group_ids(session)
+    if not group_ids:
+        session.info.pop('group_counts', None)
+        return
+    connection = session.connection()
+    session.info['group_counts'] = {
+        assignment_id: (ids, AssignmentStats.group_counts(connection,
+                                                          assignment_id, ids))
+        for assignment_id, ids in group_ids.items()
+    }
+
+def _count_groups(session, connection, changes):
+    """ Add the change in the number of groups and active groups made by the
+    flush to CHANGES.
+    """
+    before = session.info.pop('group_counts', {})
+    group_ids = _changed_group_ids(session)
+    for assignment_id, (ids, _) in before.items():
+        group_ids.setdefault(assignment_id, set()).update(ids)
+    for assignment_id, ids in group_ids.items():
+        after = AssignmentStats.group_counts(connection, assignment_id, ids)
+        counts = before.get(assignment_id, (None, {}))[1]
+        for name, value in after.items():
+            changes[assignment_id][name] += value - counts.get(name, 0)
+
+def _changed_group_ids(session):
+    """ Return the IDs of the groups with pending changes in SESSION, by
+    assignment ID. Groups that are not in the database yet are left out.
+    """
+    group_ids = {}
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Group):
+            ids = {obj.id}
+        elif isinstance(obj, GroupMember):
+            ids = {obj.group_id}
+            ids.update(db.inspect(obj).attrs['group_id'].history.deleted or ())
+        else:
+            continue
+        ids.discard(None)
+        if ids:
+            group_ids.setdefault(obj.assignment_id, set()).update(ids)
+    return group_ids
+
+def _count_backup(session, backup, counts, submitted):
+    """ Add the change in the number of backups and submissions made by
+    writing BACKUP to COUNTS. If it was a submission before this flush and
+    that changed, record so in SUBMITTED.
+    """
+    if backup in session.new:
+        counts['backups'] += 1
+        counts['submissions'] += bool(backup.submit)
+    elif backup in session.deleted:
+        counts['backups'] -= 1
+        counts['submissions'] -= bool(backup.submit)
+        submitted[backup.id] = bool(backup.submit)
+    else:
+        submit = db.inspect(backup).attrs['submit'].history
+        if submit.has_changes():
+            was_submitted = bool(submit.deleted and submit.deleted[0])
+            counts['submissions'] += bool(backup.submit) - was_submitted
+            submitted[backup.id] = was_submitted
+
+def _changes_final_submission(session, backup):
+    if backup not in session.dirty:
+        return True
+    return any(db.inspect(backup).attrs[field].history.has_changes()
+               for field in ('submit', 'flagged', 'created', 'submitter_id'))
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def _save_assignment_stats_changes(session):
+    """ Save the changes to AssignmentStats counters made by the committed
+    transaction, in a transaction of their own.
+    """
+    changes = session.info.pop('assignment_stats', None)
+    if not changes:
+        return
+    try:
+        with session.get_bind().begin() as connection:
+            AssignmentStatsChange.save(connection, changes)
+    except SQLAlchemyError:
+        # The next reconcile_stats corrects the counters
+        logger.exception('Could not save assignment statistics changes')
+
+@db.event.listens_for(SignallingSession, 'after_rollback')
+def _discard_assignment_stats_changes(session):
+    session.info.pop('assignment_stats', None)
+
+
+class Fingerprint(Model):
+    """ A winnowed k-gram hash of a submission (see server/jobs/similarity.py).
+    Submissions are indexed as they are made, so that staff can find the
+    submissions with the most code in common with a backup, across
+    assignments and semesters, without re-reading every submission.
+    """
+    __tablename__ = 'fingerprint'
+    __table_args__ = (
+        PrimaryKeyConstraint('backup_id', 'value'),
+    )
+
+    backup_id = db.Column(db.ForeignKey("backup.id"), nullable=False)
+    value = db.Column(db.Integer, nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    line = db.Column(db.Integer, nullable=False)
+
+    backup = db.relationship("Backup")
+
+    @staticmethod
+    def top_matches(backup, course_ids=None, limit=10,
+                    max_shared=FINGERPRINT_MAX_SHARED):
+        """ Return up to LIMIT (backup, shared fingerprints) pairs for the
+        submissions of other students that share the most fingerprints with
+        BACKUP, most similar first. Only the closest submission of each
+        student is included. If COURSE_IDS is given, only submissions to
+        those courses are considered.
+        """
+        best = Fingerprint.top_match_ids(backup.id, course_ids, limit, max_shared)
+        backups = (Backup.query.options(db.joinedload('submitter'),
+                                        db.joinedload('assignment'))
+                               .filter(Backup.id.in_([b for b, _ in best])))
+        backups = {b.id: b for b in backups}
+        return [(backups[backup_id], count) for backup_id, count in best]
+
+    @staticmethod
+    @cache.memoize(600)
+    def top_match_ids(backup_id, course_ids, limit, max_shared):
+        """ Return the (backup ID, shared fingerprints) pairs of top_matches.
+        Fingerprints in more than MAX_SHARED backups are skipped by looking
+        up their FingerprintCount, so the number of rows joined is at most
+        MAX_SHARED per fingerprint of the backup.
+        """
+        backup = Backup.query.get(backup_id)
+        rare = (db.session.query(Fingerprint.value)
+                          .join(FingerprintCount,
+                                FingerprintCount.value == Fingerprint.value)
+                          .filter(Fingerprint.backup_id == backup_id,
+                                  FingerprintCount.backups.between(2, max_shared))
+                          .subquery())
+        theirs = aliased(Fingerprint)
+        shared = db.func.count().label('shared')
+        query = (db.session.query(theirs.backup_id, Backup.submitter_id, shared)
+                           .join(Backup, Backup.id == theirs.backup_id)
+                           .filter(theirs.value.in_(rare),
+                                   theirs.backup_id != backup_id,
+                                   Backup.submitter_id.notin_(backup.owners())))
+        if course_ids is not None:
+            query = (query.join(Assignment, Assignment.id == Backup.assignment_id)
+                          .filter(Assignment.course_id.in_(course_ids)))
+        query = (query.group_by(theirs.backup_id, Backup.submitter_id)
+                      .order_by(shared.desc(), theirs.backup_id.desc())
+                      .limit(limit * 10))
+
+        best = collections.OrderedDict()
+        for other_id, submitter_id, count in query:
+            if submitter_id not in best:
+                best[submitter_id] = (other_id, count)
+        return list(best.values())[:limit]
+
+
+class FingerprintCount(Model):
+    """ The number of indexed backups with each fingerprint value, kept up to
+    date as submissions are indexed, so that common values can be skipped
+    without counting them in the Fingerprint table.
+    """
+    __tablename__ = 'fingerprint_count'
+
+    value = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    backups = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def add(values):
+        """ Count one more backup for each of VALUES. A concurrent insert of a
+        new value raises an IntegrityError, after which the transaction should
+        be rolled back and retried.
+        """
+        existing = set()
+        for batch in batches(sorted(set(values)), IN_QUERY_BATCH_SIZE):
+            found = FingerprintCount.query.filter(FingerprintCount.value.in_(batch))
+            existing.update(count.value for count in found)
+            found.update({'backups': FingerprintCount.backups + 1},
+                         synchronize_session=False)
+        db.session.bulk_insert_mappings(FingerprintCount, [
+            {'value': value, 'backups': 1}
+            for value in set(values) - existing
+        ])
+
+
 class GroupAction(Model):
     """ A group event, for auditing purposes. All group activity is logged."""
+    __table_args__ = (
+        db.Index('ix_group_action_assignment_id_created', 'assignment_id', 'created'),
+    )
     action_types = ['invite', 'accept', 'decline', 'remove']
 
     id = db.Column(db.Integer, primary_key=True)
     action_type = db.Column(db.Enum(*action_types, name='action_type'), nullable=False)
+    # The assignment of the group, also found in group_before
+    assignment_id = db.Column(db.ForeignKey("assignment.id"))
     # user who initiated request
     user_id = db.Column(db.ForeignKey("user.id"), nullable=False)
     # user whose status was affected
@@ -1259,7 +2074,7 @@ class Version(Model):
     download_link = db.Column(db.Text())
 
     @staticmethod
-    @cache.memoize(1800)
+    @cache.memoize(1800, single_flight=True)
     def get_current_version(name):
         version = Version.query.filter_by(name=name).one_or_none()
         if version:
@@ -1335,6 +2150,98 @@ class Score(Model):
         data['grader'] = User.email_by_id(self.grader_id)
         return {k: v for k, v in data.items() if k in self.export_items}
 
+    @staticmethod
+    def export_query(assignment, batch_size=1000):
+        """ Return a query for exporting the active scores of ASSIGNMENT, with
+        one row per score and enrolled member of the group that owns its
+        backup. Columns are named after Enrollment.export_items and
+        Score.export_items. Rows are ordered by score and are fetched from the
+        database BATCH_SIZE at a time.
+        """
+        submitter_member = aliased(GroupMember)
+        member = aliased(GroupMember)
+        grader = aliased(User)
+        owner_id = db.func.coalesce(member.user_id, Backup.submitter_id)
+        return (db.session.query(
+                    Score.id, Score.assignment_id, Score.kind, Score.score,
+                    Score.message, Score.backup_id, grader.email.label('grader'),
+                    Backup.created, Backup.custom_submission_time,
+                    User.email, Enrollment.sid, Enrollment.class_account,
+                    Enrollment.section)
+                .select_from(Score)
+                .join(Backup, Backup.id == Score.backup_id)
+                .outerjoin(submitter_member, db.and_(
+                    submitter_member.user_id == Backup.submitter_id,
+                    submitter_member.assignment_id == Backup.assignment_id,
+                    submitter_member.status == 'active'))
+                .outerjoin(member, db.and_(
+                    member.group_id == submitter_member.group_id,
+                    member.status == 'active'))
+                .join(Enrollment, db.and_(
+                    Enrollment.user_id == owner_id,
+                    Enrollment.course_id == assignment.course_id))
+                .join(User, User.id == Enrollment.user_id)
+                .outerjoin(grader, grader.id == Score.grader_id)
+                .filter(Score.assignment_id == assignment.id,
+                        Score.archived == False)
+                .order_by(Score.id, User.id)
+                .yield_per(batch_size))
+
+    @staticmethod
+    def student_owners(assignment, *columns):
+        """ Return a query of COLUMNS over the active scores of ASSIGNMENT,
+        joined to the Enrollment of each student with an SID that a score
+        counts for, either directly or through their group.
+        """
+        submitter_member = aliased(GroupMember)
+        member = aliased(GroupMember)
+        owner_id = db.func.coalesce(member.user_id, Score.user_id)
+        return (db.session.query(*columns)
+                .select_from(Score)
+                .outerjoin(submitter_member, db.and_(
+                    submitter_member.user_id == Score.user_id,
+                    submitter_member.assignment_id == Score.assignment_id,
+                    submitter_member.status == 'active'))
+                .outerjoin(member, db.and_(
+                    member.group_id == submitter_member.group_id,
+                    member.status == 'active'))
+                .join(Enrollment, db.and_(
+                    Enrollment.user_id == owner_id,
+                    Enrollment.course_id == assignment.course_id,
+                    Enrollment.role == STUDENT_ROLE))
+                .filter(Score.assignment_id == assignment.id,
+                        Score.archived == False,
+                        Enrollment.sid != None))
+
+    @staticmethod
+    def best_by_sid(assignment, kinds, sids=None):
+        """ Return a dict mapping SIDs of enrolled students (or only those in
+        SIDS) to the highest active Score of one of KINDS that counts for
+        them. Ties go to the more recent score. Only the IDs and values of the
+        candidate scores are read, and the best one for each SID is picked
+        here rather than with a window function, which MySQL 5.7 lacks.
+        """
+        if not kinds or sids is not None and not sids:
+            return {}
+        query = Score.student_owners(
+            assignment, Enrollment.sid, Score.score, Score.created, Score.id
+        ).filter(Score.kind.in_(kinds))
+        if sids is None:
+            queries = [query]
+        else:
+            queries = [query.filter(Enrollment.sid.in_(batch))
+                       for batch in batches(sids, IN_QUERY_BATCH_SIZE)]
+        best_keys = {}
+        for sid, *key in itertools.chain.from_iterable(queries):
+            if sid not in best_keys or key > best_keys[sid]:
+                best_keys[sid] = key
+        scores = {}
+        for batch in batches([key[-1] for key in best_keys.values()],
+                             IN_QUERY_BATCH_SIZE):
+            scores.update((score.id, score)
+                          for score in Score.query.filter(Score.id.in_(batch)))
+        return {sid: scores[key[-1]] for sid, key in best_keys.items()}
+
     @hybrid_property
     def students(self):
         """ The users to which this score applies."""
@@ -1346,7 +2253,7 @@ class Score(Model):
             return True
         course = obj.assignment.course
         if action == "get":
-            return obj.backup.can_view(user, course)
+            return Backup.can(obj.backup, user, "view")
         return user.is_enrolled(course.id, STAFF_ROLES)
 
     def archive(self, commit=True):
@@ -1464,7 +2371,7 @@ class GradingTask(Model):
                 task = cls(kind=kind, backup_id=backup_id, course_id=course_id,
                            assignment_id=assignment_id, grader=grader)
                 tasks.append(task)
-                cache.delete_memoized(User.num_grading_tasks, grader)
+            cache.invalidate_scope('grading-tasks', grader.id)
         db.session.add_all(tasks)
         return tasks
 
@@ -1588,6 +2495,40 @@ class Job(Model):
     result_kind = db.Column(db.Enum(*result_kinds, name='result_kind'), default='string')
     result = db.Column(mysql.MEDIUMTEXT)  # Final output, if the job did not crash
 
+    # The job that started this one with jobs.fan_out, if any
+    parent_id = db.Column(db.ForeignKey("job.id"), index=True)
+    parent = db.relationship('Job', remote_side=[id],
+                             backref=backref('children', order_by='Job.id'))
+
+    def read_log(self, offset=0):
+        """ Return the log output after the first OFFSET characters, and the
+        offset to pass next time to read only newer output. While the job is
+        running, this reads only the chunks that have not been seen yet.
+        """
+        if self.status == 'finished':
+            log = self.log or ''
+            return log[offset:], max(offset, len(log))
+        chunks = (JobLogChunk.query.filter(JobLogChunk.job_id == self.id,
+                                           JobLogChunk.end > offset)
+                                   .order_by(JobLogChunk.start).all())
+        if not chunks:
+            return '', offset
+        log = ''.join(chunk.contents for chunk in chunks)
+        return log[max(offset - chunks[0].start, 0):], chunks[-1].end
+
+
+class JobLogChunk(Model):
+    """ Part of the log of a running job. Chunks are appended as the job logs
+    (see jobs.JobLogHandler) and deleted once the whole log is saved in
+    Job.log, so a long log is not rewritten every time it grows.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.ForeignKey("job.id"), nullable=False, index=True)
+    # Offsets of the chunk in the log, in characters
+    start = db.Column(db.Integer, nullable=False)
+    end = db.Column(db.Integer, nullable=False)
+    contents = db.Column(mysql.MEDIUMTEXT, nullable=False)
+
 ##########
 # Canvas #
 ##########
@@ -1636,10 +2577,93 @@ class CanvasAssignment(Model):
     )
     assignment = db.relationship('Assignment')
 
+    # When the last upload started: group changes before this time have been
+    # taken into account
+    synced = db.Column(db.DateTime(timezone=True))
+
     @property
     def url(self):
         return '{}/assignments/{}'.format(self.canvas_course.url, self.external_id)
 
+class CanvasGrade(Model):
+    """ The score last uploaded to Canvas for a student, so that an upload
+    only needs to look at scores created or archived since then. Students
+    with scores who are not on the Canvas roster have a row too, without a
+    Canvas user ID, so that they are not looked up on every upload.
+    """
+    canvas_assignment_id = db.Column(
+        db.Integer, db.ForeignKey('canvas_assignment.id'), primary_key=True,
+    )
+    canvas_assignment = db.relationship(
+        'CanvasAssignment',
+        backref=db.backref('grades', cascade='all, delete-orphan'),
+    )
+    sid = db.Column(db.String(255), primary_key=True)
+    # The ID of the student for the Canvas API, or None if they are not on
+    # the roster
+    canvas_user_id = db.Column(db.Integer)
+    # The score in Canvas, and the OK score it came from (if any)
+    score = db.Column(db.Float)
+    score_id = db.Column(db.ForeignKey('score.id'))
+    # Scores created before this time have been taken into account
+    synced = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    @staticmethod
+    def changed_sids(canvas_assignment, kinds):
+        """ Return the set of SIDs whose best score for CANVAS_ASSIGNMENT may
+        have changed since it was last synced: students with a score of one of
+        KINDS created since then (or never synced), students whose synced
+        score has been archived, and students who joined or left a group for
+        the assignment since the last upload.
+        """
+        assignment = canvas_assignment.assignment
+        if not kinds:
+            return set()
+        new = (Score.student_owners(assignment, Enrollment.sid)
+               .outerjoin(CanvasGrade, db.and_(
+                   CanvasGrade.canvas_assignment_id == canvas_assignment.id,
+                   CanvasGrade.sid == Enrollment.sid))
+               .filter(Score.kind.in_(kinds),
+                       db.or_(CanvasGrade.synced == None,
+                              Score.created >= CanvasGrade.synced))
+               .distinct())
+        archived = (db.session.query(CanvasGrade.sid)
+                    .join(Score, Score.id == CanvasGrade.score_id)
+                    .filter(CanvasGrade.canvas_assignment_id == canvas_assignment.id,
+                            Score.archived == True))
+        return ({sid for sid, in new} | {sid for sid, in archived} |
+                CanvasGrade.regrouped_sids(canvas_assignment))
+
+    @staticmethod
+    def regrouped_sids(canvas_assignment):
+        """ Return the SIDs of students whose group for CANVAS_ASSIGNMENT
+        changed since the last upload started, since the scores of their
+        group count for them.
+        """
+        assignment = canvas_assignment.assignment
+        if canvas_assignment.synced is None:
+            return set()
+        user_ids = set()
+        actions = GroupAction.query.filter(
+            GroupAction.assignment_id == assignment.id,
+            GroupAction.created >= canvas_assignment.synced)
+        for action in actions:
+            before, after = [
+                {member['user_id'] for member in group.get('members', [])
+                 if member['status'] == 'active'}
+                for group in (action.group_before, action.group_after)
+            ]
+            if before != after:
+                user_ids |= before | after
+        sids = set()
+        for batch in batches(user_ids, IN_QUERY_BATCH_SIZE):
+            sids.update(sid for sid, in db.session.query(Enrollment.sid).filter(
+                Enrollment.user_id.in_(batch),
+                Enrollment.course_id == assignment.course_id,
+                Enrollment.role == STUDENT_ROLE,
+                Enrollment.sid != None))
+        return sids
+
 #########
 # Files #
 #########
@@ -1681,6 +2705,8 @@ class ExternalFile(Model):
     @property
     def mimetype(self):
         guess = mimetypes.guess_type(self.filename)
+        if guess[1] == 'gzip':
+            return 'application/gzip'
         if not guess[0]:
             return 'application/octet-stream'
         return guess[0]
@@ -1695,7 +2721,7 @@ class ExternalFile(Model):
         db.session.commit()
 
     @staticmethod
-    def upload(iterable, user_id, name, staff_file=True, course_id=None,
+    def upload(iterable, user_id, name, staff_file=False, course_id=None,
                assignment_id=None, backup=None, **kwargs):
         object = storage.upload(iterable, name=name, **kwargs)
         external_file = ExternalFile(
@@ -1706,7 +2732,7 @@ class ExternalFile(Model):
             assignment_id=assignment_id,
             user_id=user_id,
             backup=backup,
-            staff_file=False)
+            staff_file=staff_file)
         db.session.add(external_file)
         db.session.commit()
         return external_file
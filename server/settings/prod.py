@@ -47,6 +47,8 @@ RQ_DEFAULT_HOST = REDIS_HOST = CACHE_REDIS_HOST = \
     os.getenv('REDIS_HOST', 'redis-master')
 REDIS_PORT = 6379
 RQ_POLL_INTERVAL = 2000
+# Lets services like the worker autoscaler read /rq/stats.json
+QUEUE_STATS_TOKEN = os.getenv('QUEUE_STATS_TOKEN')
 
 STORAGE_PROVIDER = os.environ.get('STORAGE_PROVIDER',  'GOOGLE_STORAGE')
 STORAGE_SERVER = False
@@ -25,6 +25,8 @@ RQ_DEFAULT_HOST = REDIS_HOST = CACHE_REDIS_HOST = \
     os.getenv('REDIS_HOST', 'redis-master')
 REDIS_PORT = 6379
 RQ_POLL_INTERVAL = 2000
+# Lets services like the worker autoscaler read /rq/stats.json
+QUEUE_STATS_TOKEN = os.getenv('QUEUE_STATS_TOKEN')
 OAUTH2_PROVIDER_TOKEN_EXPIRES_IN = 28800
 
 db_url = os.getenv('DATABASE_URL')
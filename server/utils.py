@@ -8,7 +8,7 @@ import re
 from urllib.parse import urlparse, urljoin
 
 import bleach
-from flask import render_template, url_for, Markup
+from flask import render_template, url_for, Markup, has_request_context, request
 from hashids import Hashids
 import humanize
 from oauthlib.common import generate_token
@@ -202,6 +202,35 @@ def chunks(l, n):
         yield l[prev_index:index]
         prev_index = index
 
+def batches(l, size):
+    """ Splits L into lists of at most SIZE elements, in order. Used to keep
+    IN (...) clauses of bulk queries to a reasonable size.
+
+    >>> [len(x) for x in batches(range(45), 20)]
+    [20, 20, 5]
+    >>> list(batches([], 20))
+    []
+    """
+    l = list(l)
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+def request_cache(name):
+    """ Return a dict named NAME that lasts until the end of the current
+    request, for lookups that the permission checks in a request repeat.
+    Outside of a request, return a new dict each time, so nothing is kept.
+    """
+    if not has_request_context():
+        return {}
+    caches = getattr(request, 'ok_caches', None)
+    if caches is None:
+        caches = request.ok_caches = {}
+    return caches.setdefault(name, {})
+
+def clear_request_cache(name):
+    if has_request_context():
+        getattr(request, 'ok_caches', {}).pop(name, None)
+
 
 def generate_csv(query, items, selector_fn):
     """ Generate csv export of scores for assignment.
@@ -244,10 +273,3 @@ def pluralize(number, singular='', plural='s'):
 def generate_secret_key(length=31):
     """ Generates a random secret, as a string."""
     return generate_token(length=length)
-
-
-def generate_number_table(num):
-    """ Generate a table of number with column name pos.
-    Used in models.Assignment.mysql_course_submissions_query
-    """
-    return ' UNION '.join('SELECT {} as pos'.format(i) for i in range(1, num + 1))
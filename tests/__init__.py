@@ -1,10 +1,12 @@
+import contextlib
 import datetime as dt
 import os
 
 from flask_rq import get_worker
 from flask_testing import TestCase
+import sqlalchemy
 
-from server import create_app
+from server import create_app, jobs
 from server.models import db, Assignment, Course, Enrollment, User
 from server import constants
 
@@ -33,6 +35,19 @@ class OkTestCase(TestCase):
         self.assert_200(response)
         self.assert_template_used('index.html')
 
+    @contextlib.contextmanager
+    def record_queries(self):
+        """Record the SQL statements run in the block, in the yielded list."""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+
     def make_student(self, n):
         user = User(email='student{0}@aol.com'.format(n))
         participant = Enrollment(user=user, course=self.course)
@@ -122,5 +137,5 @@ class OkTestCase(TestCase):
         db.session.commit()
 
     def run_jobs(self):
-        get_worker().work(burst=True)
+        get_worker(*jobs.WORKER_QUEUES).work(burst=True)
         db.session.expire_all()
@@ -4,6 +4,7 @@ import random
 
 from server.models import (db, Assignment, Backup, Course, User,
                            Version, Group)
+from server import autograder
 from server.utils import encode_id
 
 from tests import OkTestCase
@@ -148,6 +149,22 @@ class TestAuth(OkTestCase):
             ],
         }
 
+    def test_get_backup_queries(self):
+        self.setup_course()
+        Group.invite(self.user1, self.user2, self.assignment)
+        Group.lookup(self.user1, self.assignment).accept(self.user2)
+        backup = Backup(submitter=self.user1, assignment=self.assignment, submit=True)
+        db.session.add(backup)
+        db.session.commit()
+        self.login(self.user2.email)
+
+        with self.record_queries() as queries:
+            response = self.client.get('/api/v3/backups/{}/'.format(backup.hashid))
+        self.assert_200(response)
+        # The group is looked up once for the permission check and the owners
+        self.assertEqual(sum('group_member' in q for q in queries), 1)
+        self.assertLessEqual(len(queries), 8)
+
     def test_bad_hashid(self):
         self.setup_course()
 
@@ -284,6 +301,44 @@ class TestAuth(OkTestCase):
         self.assertEquals(response.json['data']['has_more'], False)
         self.assertEquals(response.json['data']['offset'], 1)
 
+    def test_export_final_cursor(self):
+        self.setup_course()
+        students = [self.user1, self.user2, self.user3, self.user4, self.user5]
+        for i, student in enumerate(students):
+            backup = Backup(submitter=student, assignment=self.assignment,
+                            submit=True)
+            backup.created = self.assignment.due_date - dt.timedelta(hours=i)
+            db.session.add(backup)
+        db.session.commit()
+        expected = [b.id for b in Backup.query.order_by(Backup.created.desc())]
+
+        self.login(self.staff1.email)
+        endpoint = '/api/v3/assignment/{0}/submissions/'.format(self.assignment.name)
+        response = self.client.get(endpoint + '?limit=2')
+        self.assert_200(response)
+        data = response.json['data']
+        self.assertEquals(data['count'], 5)
+        self.assertEquals(data['has_more'], True)
+
+        # Later pages come from the snapshot, so new submissions do not shift them
+        backup = Backup(submitter=self.user1, assignment=self.assignment,
+                        submit=True)
+        db.session.add(backup)
+        db.session.commit()
+
+        seen = [b['id'] for b in data['backups']]
+        while data['has_more']:
+            response = self.client.get(endpoint + '?limit=2&cursor=' + data['cursor'])
+            self.assert_200(response)
+            data = response.json['data']
+            self.assertEquals(data['count'], 5)
+            seen.extend(b['id'] for b in data['backups'])
+        self.assertEquals(seen, [encode_id(bid) for bid in expected])
+        self.assertEquals(data['cursor'], None)
+
+        response = self.client.get(endpoint + '?cursor=bogus.cursor')
+        self.assert_400(response)
+
     def test_assignment_api(self):
         self._test_backup(True)
         student = User.lookup(self.user1.email)
@@ -397,6 +452,29 @@ class TestAuth(OkTestCase):
         assert response.json['code'] == 200
 
 
+    def test_autograder_result_student(self):
+        self._test_backup(False)
+        backup = Backup.query.filter(Backup.submitter_id == self.user1.id).first()
+
+        self.login(self.user1.email)
+        data = {'bid': encode_id(backup.id), 'job_id': 'abc', 'status': 'finished'}
+        response = self.client.post('/api/v3/autograder/results/', data=data)
+        self.assert_403(response)
+
+    def test_autograder_result_staff(self):
+        self._test_backup(False)
+        backup = Backup.query.filter(Backup.submitter_id == self.user1.id).first()
+
+        self.login(self.staff1.email)
+        for status in ('started', 'finished'):
+            data = {'bid': encode_id(backup.id), 'job_id': 'abc', 'status': status}
+            response = self.client.post('/api/v3/autograder/results/', data=data)
+            self.assert_200(response)
+
+        # Only the latest status of each job is kept
+        results = autograder.receive_job_results(backup.assignment_id, 1)
+        assert results == {'abc': {'job_id': 'abc', 'status': 'finished'}}
+
     def test_comment_staff(self):
         self._test_backup(True)
 
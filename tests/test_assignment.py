@@ -1,6 +1,6 @@
 import datetime
 import json
-from server.models import db, Assignment, Backup, Course, User, Version
+from server.models import db, Assignment, Backup, Course, Group, Score, User, Version
 from server.utils import encode_id
 from server.forms import VersionForm
 
@@ -50,3 +50,49 @@ class TestAssignment(OkTestCase):
         self.assert200(response)
         self.assertTemplateUsed('staff/course/assignment/assignments.html')
 
+    def test_user_statuses(self):
+        Group.invite(self.user1, self.user2, self.assignment)
+        Group.lookup(self.user1, self.assignment).accept(self.user2)
+        Group.invite(self.user1, self.user3, self.assignment2)
+        self.assignment.published_scores = ['total']
+
+        earlier = datetime.datetime.now() - datetime.timedelta(hours=1)
+        submission = Backup(submitter=self.user2, assignment=self.assignment,
+                            submit=True)
+        db.session.add(Backup(submitter=self.user1, assignment=self.assignment,
+                              submit=True, created=earlier))
+        db.session.add(submission)
+        db.session.add(Backup(submitter=self.user1, assignment=self.assignment2))
+        for kind, points in [('total', 2), ('total', 3), ('composition', 1)]:
+            db.session.add(Score(backup=submission, kind=kind, score=points,
+                                 assignment=self.assignment, user_id=self.user2.id,
+                                 grader=self.staff1))
+        db.session.commit()
+
+        assignments = [self.assignment, self.assignment2]
+        for staff_view in (False, True):
+            statuses = self.course.user_statuses(self.user1, assignments, staff_view)
+            self.assertEqual(statuses, [a.user_status(self.user1, staff_view)
+                                        for a in assignments])
+        self.assertEqual(statuses[0].final_subm, submission)
+        self.assertEqual(sorted(s.score for s in statuses[0].scores), [1, 3])
+        self.assertIsNone(statuses[1].final_subm)
+        self.assertEqual(self.course.user_statuses(self.user1, []), [])
+
+    def test_user_statuses_queries(self):
+        self.login(self.user1.email)
+        with self.record_queries() as queries:
+            response = self.client.get('/{}/'.format(self.course.offering))
+        self.assert200(response)
+        few = len(queries)
+
+        for i in range(10):
+            db.session.add(Assignment(
+                name='{}/hw{}'.format(self.course.offering, i), course=self.course,
+                display_name='Homework {}'.format(i), creator_id=self.admin.id,
+                due_date=self.assignment.due_date, lock_date=self.assignment.lock_date))
+        db.session.commit()
+        with self.record_queries() as queries:
+            response = self.client.get('/{}/'.format(self.course.offering))
+        self.assert200(response)
+        self.assertEqual(len(queries), few)
@@ -0,0 +1,184 @@
+import os
+import random
+import time
+from unittest import mock
+
+from flask_caching import Cache
+import redis
+
+from server import caching
+from server.caching import LRUCache, function_name
+from server.constants import STUDENT_ROLE
+from server.extensions import cache
+from server.models import db, User
+from tests import OkTestCase
+
+calls = []
+
+@cache.memoize(60)
+def square(n):
+    calls.append(n)
+    return n * n
+
+@cache.memoize(60, single_flight=True)
+def cube(n):
+    calls.append(n)
+    return n ** 3
+
+class Thing:
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return '<Thing {}>'.format(self.id)
+
+    @cache.memoize(60)
+    def times(self, n):
+        calls.append((self.id, n))
+        return self.id * n
+
+    @cache.memoize(60, scope=lambda self, n: ('thing', self.id, n % 2))
+    def plus(self, n):
+        calls.append((self.id, n))
+        return self.id + n
+
+class TestCache(OkTestCase):
+    def setUp(self):
+        super(TestCache, self).setUp()
+        calls.clear()
+
+    def stats(self, f):
+        stats = cache.memoize_stats()[function_name(f)]
+        return stats['local_hits'], stats['shared_hits'], stats['misses']
+
+    def test_two_tiers(self):
+        before = self.stats(square)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3])
+
+        # Served from the shared cache once the local cache is empty
+        cache.clear_local()
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3])
+        self.assertEqual(tuple(a - b for a, b in zip(self.stats(square), before)),
+                         (1, 1, 1))
+
+        cache.delete_memoized(square)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3, 3])
+
+    def test_stats_flushed_to_redis(self):
+        client = redis.StrictRedis(host=self.app.config['REDIS_HOST'],
+                                   port=self.app.config['REDIS_PORT'])
+        client.delete(caching.STATS_KEY)
+        self.addCleanup(client.delete, caching.STATS_KEY)
+        # Without subscribing to invalidations, which would clear the local cache
+        with mock.patch.object(cache, '_client', client), \
+                mock.patch.object(cache, '_listener_pid', os.getpid()), \
+                mock.patch.object(caching, 'CACHE_STATS_FLUSH_INTERVAL', 0):
+            # Every call flushes, so each count lands in a fresh batch
+            for _ in range(3):
+                self.assertEqual(square(4), 16)
+            cache.clear_local()
+            self.assertEqual(square(4), 16)
+            self.assertEqual(self.stats(square), (2, 1, 1))
+
+    def test_local_copies(self):
+        self.setup_course()
+        user_id, course_id = self.user1.id, self.course.id
+        enrollment = self.user1.is_enrolled(course_id)
+        db.session.commit()
+        db.session.remove()
+
+        # The local cache does not hand out the instance that was detached
+        user = User.query.get(user_id)
+        cached = user.is_enrolled(course_id)
+        self.assertIsNot(cached, enrollment)
+        self.assertEqual(cached.role, STUDENT_ROLE)
+        self.assertEqual(user.is_enrolled(course_id).course_id, course_id)
+
+    def test_delete_instance(self):
+        one, two = Thing(1), Thing(2)
+        self.assertEqual(one.times(3), 3)
+        self.assertEqual(two.times(3), 6)
+        cache.delete_memoized(one.times)
+        self.assertEqual(one.times(3), 3)
+        self.assertEqual(two.times(3), 6)
+        self.assertEqual(calls, [(1, 3), (2, 3), (1, 3)])
+
+        cache.delete_memoized(Thing.times)
+        self.assertEqual(two.times(3), 6)
+        self.assertEqual(calls, [(1, 3), (2, 3), (1, 3), (2, 3)])
+
+    def test_lru_timeout(self):
+        lru = LRUCache(2)
+        lru.set('a', 1, timeout=60)
+        lru.set('b', 2, timeout=-1)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 1)
+
+    def test_invalidate_scope(self):
+        one, two = Thing(1), Thing(2)
+        self.assertEqual([one.plus(3), one.plus(4), two.plus(3)], [4, 5, 5])
+        cache.invalidate_scope('thing', 1, 1)
+        self.assertEqual([one.plus(3), one.plus(4), two.plus(3)], [4, 5, 5])
+        self.assertEqual(calls, [(1, 3), (1, 4), (2, 3), (1, 3)])
+
+        # The new version is also used once the local cache is empty
+        cache.clear_local()
+        self.assertEqual(one.plus(3), 4)
+        self.assertEqual(len(calls), 4)
+
+    def test_single_flight(self):
+        self.assertEqual(cube(2), 8)
+        key = cube.make_cache_key(cube.uncached, 2)
+        value, expires, duration = cache.cache.get(key)
+        self.assertEqual(value, 8)
+
+        # Another process is already recomputing the expired value
+        cache.cache.set(key, (-8, time.time() - 1, duration))
+        cache.cache.add(key + '/lock', True)
+        cache.clear_local()
+        self.assertEqual(cube(2), -8)
+        self.assertEqual(calls, [2])
+
+        cache.cache.delete(key + '/lock')
+        cache.clear_local()
+        self.assertEqual(cube(2), 8)
+        self.assertEqual(calls, [2, 2])
+        self.assertIsNone(cache.cache.get(key + '/lock'))
+
+    def test_single_flight_plain_entries(self):
+        # A value memoized before single_flight was turned on
+        plain = Cache.memoize(cache, 60)(cube.uncached)
+        plain_key = plain.make_cache_key(cube.uncached, 4)
+        cache.cache.set(plain_key, (64, 'not an entry'))
+        key = cube.make_cache_key(cube.uncached, 4)
+        self.assertNotEqual(key, plain_key)
+        self.assertEqual(cube(4), 64)
+        self.assertEqual(calls, [4])
+
+        cache.cache.set(key, (64, 'not an entry'))
+        cache.clear_local()
+        self.assertEqual(cube(4), 64)
+        self.assertEqual(calls, [4, 4])
+
+    def test_single_flight_early_refresh(self):
+        self.assertEqual(cube(3), 27)
+        key = cube.make_cache_key(cube.uncached, 3)
+        # Expires in 30 seconds and took 10 seconds to compute
+        cache.cache.set(key, (27, time.time() + 30, 10))
+        with mock.patch.object(random, 'random', return_value=0.5):
+            cache.clear_local()
+            self.assertEqual(cube(3), 27)
+            self.assertEqual(calls, [3])
+        with mock.patch.object(random, 'random', return_value=0.99):
+            cache.clear_local()
+            self.assertEqual(cube(3), 27)
+            self.assertEqual(calls, [3, 3])
+
+    def test_single_flight_timeout(self):
+        with self.assertRaises(ValueError):
+            cache.memoize(single_flight=True)
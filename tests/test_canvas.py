@@ -0,0 +1,275 @@
+import collections
+import datetime as dt
+import http.server
+import json
+import threading
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from server import jobs, models
+from server.canvas import api
+from server.canvas import jobs as canvas_jobs
+from server.models import (Backup, CanvasAssignment, CanvasCourse, CanvasGrade,
+                           Enrollment, Group, GroupAction, Score, db)
+from tests import OkTestCase
+
+class FakeCanvasHandler(http.server.BaseHTTPRequestHandler):
+    """Serve /api/v1/courses/1/users as NUM_STUDENTS students, paginated like
+    Canvas. Pages in FLAKY_PAGES fail with a 503 the first time.
+    """
+    num_students = 250
+    flaky_pages = set()
+    numbered = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        if self.headers['Authorization'] != 'Bearer secret':
+            self.send_error(401)
+            return
+        if url.path.startswith('/api/v1/progress/'):
+            progress_id = int(url.path.rsplit('/', 1)[1])
+            server.polls[progress_id] += 1
+            state = 'completed' if server.polls[progress_id] > 1 else 'running'
+            self.send_json({'id': progress_id, 'workflow_state': state})
+            return
+        if url.path == '/api/v1/courses/1/assignments/2/submissions':
+            self.send_json([])
+            return
+        if url.path != '/api/v1/courses/1/users':
+            self.send_error(404)
+            return
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query['per_page'][0])
+        with server.lock:
+            if page in self.flaky_pages and page not in server.failed:
+                server.failed.add(page)
+                self.send_error(503)
+                return
+        num_pages = (self.num_students + per_page - 1) // per_page
+
+        def link(page):
+            return 'http://{}:{}/api/v1/courses/1/users?page={}&per_page={}'.format(
+                server.server_name, server.server_port, page, per_page)
+        links = ['<{}>; rel="first"'.format(link(1))]
+        if page < num_pages:
+            links.append('<{}>; rel="next"'.format(link(page + 1)))
+        if self.numbered:
+            links.append('<{}>; rel="last"'.format(link(num_pages)))
+        students = [{'id': i, 'sis_user_id': str(i)} for i in
+                    range((page - 1) * per_page,
+                          min(page * per_page, self.num_students))]
+        self.send_json(students, Link=','.join(links))
+
+    def do_POST(self):
+        server = self.server
+        if self.path != '/api/v1/courses/1/assignments/2/submissions/update_grades':
+            self.send_error(404)
+            return
+        length = int(self.headers['Content-Length'])
+        grade_data = json.loads(self.rfile.read(length).decode('utf-8'))['grade_data']
+        with server.lock:
+            server.grades.append(grade_data)
+            progress_id = len(server.grades)
+        self.send_json({'id': progress_id, 'workflow_state': 'queued'})
+
+    def send_json(self, data, **headers):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestCanvas(OkTestCase):
+    def setUp(self):
+        super(TestCanvas, self).setUp()
+        self.server = http.server.HTTPServer(('localhost', 0), FakeCanvasHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failed = set()
+        self.server.grades = []
+        self.server.polls = collections.Counter()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.canvas_course = CanvasCourse(
+            api_domain='localhost:{}'.format(self.server.server_port),
+            external_id=1,
+            access_token='secret',
+        )
+        patches = [
+            mock.patch.object(api, 'API_SCHEME', 'http'),
+            mock.patch.object(api, 'PAGE_SIZE', 10),
+            mock.patch.object(api, 'BACKOFF_FACTOR', 0),
+            mock.patch.object(api, 'PROGRESS_POLL_INTERVAL', 0),
+            mock.patch.object(api, '_session', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestCanvas, self).tearDown()
+
+    def get_students(self):
+        return api.canvas_api_get_list(self.canvas_course, '/courses/1/users')
+
+    def test_get_list(self):
+        students = self.get_students()
+        self.assertEqual([s['id'] for s in students], list(range(250)))
+        self.assertEqual(len(self.server.requests), 25)
+
+    def test_get_list_unnumbered(self):
+        with mock.patch.object(FakeCanvasHandler, 'numbered', False):
+            students = self.get_students()
+        self.assertEqual([s['id'] for s in students], list(range(250)))
+        self.assertEqual(len(self.server.requests), 25)
+
+    def test_get_list_retry(self):
+        with mock.patch.object(FakeCanvasHandler, 'flaky_pages', {1, 7}):
+            students = self.get_students()
+        self.assertEqual([s['id'] for s in students], list(range(250)))
+        self.assertEqual(len(self.server.requests), 27)
+
+    def test_put_scores(self):
+        canvas_assignment = CanvasAssignment(canvas_course=self.canvas_course,
+                                             external_id=2)
+        grade_data = {i: float(i) for i in range(5)}
+        with mock.patch.object(api, 'GRADE_BATCH_SIZE', 2):
+            api.put_scores(canvas_assignment, grade_data)
+        self.assertEqual(self.server.grades, [
+            {'0': {'posted_grade': 0.0}, '1': {'posted_grade': 1.0}},
+            {'2': {'posted_grade': 2.0}, '3': {'posted_grade': 3.0}},
+            {'4': {'posted_grade': 4.0}},
+        ])
+        self.assertEqual(self.server.polls, {1: 2, 2: 2, 3: 2})
+
+    def setup_scores(self):
+        self.setup_course()
+        students = [self.user1, self.user2, self.user3, self.user4, self.user5]
+        for i, user in enumerate(students):
+            Enrollment.query.filter_by(user=user).one().sid = str(i + 1)
+        Group.invite(self.user1, self.user2, self.assignment)
+        Group.lookup(self.user1, self.assignment).accept(self.user2)
+
+        self.score(self.user1, 'total', 5)
+        self.score(self.user2, 'total', 7)
+        self.score(self.user2, 'total', 9, archived=True)
+        self.score(self.user3, 'composition', 2)
+        self.score(self.user3, 'total', 1)
+        self.score(self.user4, 'hidden', 10)
+        db.session.commit()
+
+    def score(self, user, kind, points, archived=False):
+        backup = Backup(submitter=user, assignment=self.assignment, submit=True)
+        score = Score(backup=backup, kind=kind, score=points,
+                      archived=archived, assignment=self.assignment,
+                      user_id=user.id, grader=self.staff1)
+        db.session.add(score)
+        return score
+
+    def test_best_by_sid(self):
+        self.setup_scores()
+
+        best = Score.best_by_sid(self.assignment, ['total', 'composition'])
+        self.assertEqual({sid: s.score for sid, s in best.items()},
+                         {'1': 7, '2': 7, '3': 2})
+        self.assertEqual(best['1'].user_id, self.user2.id)
+        self.assertEqual(Score.best_by_sid(self.assignment, []), {})
+
+        # SIDs are looked up in batches
+        with mock.patch.object(models, 'IN_QUERY_BATCH_SIZE', 1):
+            best = Score.best_by_sid(self.assignment, ['total', 'composition'],
+                                     sids={'1', '3', '4'})
+        self.assertEqual({sid: s.score for sid, s in best.items()},
+                         {'1': 7, '3': 2})
+
+    def test_changed_sids(self):
+        self.setup_scores()
+        kinds = ['total', 'composition']
+        self.canvas_course.course = self.course
+        canvas_assignment = CanvasAssignment(canvas_course=self.canvas_course,
+                                             assignment=self.assignment,
+                                             external_id=2)
+        db.session.add(canvas_assignment)
+        db.session.commit()
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, kinds),
+                         {'1', '2', '3'})
+
+        synced = dt.datetime.now() + dt.timedelta(minutes=1)
+        best = Score.best_by_sid(self.assignment, kinds)
+        for i, sid in enumerate(['1', '2', '3']):
+            db.session.add(CanvasGrade(canvas_assignment=canvas_assignment,
+                                       canvas_user_id=i, sid=sid, synced=synced,
+                                       score=best[sid].score, score_id=best[sid].id))
+        canvas_assignment.synced = synced
+        db.session.commit()
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, kinds), set())
+
+        best['3'].archive()
+        new_score = self.score(self.user5, 'total', 4)
+        new_score.created = synced + dt.timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, kinds),
+                         {'3', '5'})
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, []), set())
+
+        # Group changes for other assignments do not matter
+        Group.invite(self.user1, self.user2, self.assignment2)
+        Group.lookup(self.user1, self.assignment2).accept(self.user2)
+        for action in GroupAction.query.filter_by(assignment_id=self.assignment2.id):
+            action.created = synced + dt.timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, kinds),
+                         {'3', '5'})
+
+        # Leaving a group changes the scores of everyone who was in it
+        Group.lookup(self.user1, self.assignment).remove(self.user1, self.user2)
+        action = GroupAction.query.filter_by(action_type='remove').one()
+        action.created = synced + dt.timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(CanvasGrade.changed_sids(canvas_assignment, kinds),
+                         {'1', '2', '3', '5'})
+
+    def test_upload_scores_off_roster(self):
+        self.setup_scores()
+        self.canvas_course.course = self.course
+        canvas_assignment = CanvasAssignment(canvas_course=self.canvas_course,
+                                             assignment=self.assignment,
+                                             external_id=2,
+                                             score_kinds=['total', 'composition'])
+        self.assignment.published_scores = ['total', 'composition']
+        db.session.add(canvas_assignment)
+        db.session.commit()
+
+        def upload():
+            self.server.requests.clear()
+            jobs.enqueue_job(canvas_jobs.upload_scores, description='Upload',
+                             course_id=self.course.id, user_id=self.staff1.id,
+                             canvas_assignment_id=canvas_assignment.id)
+            self.run_jobs()
+            return [path for path in self.server.requests
+                    if path.startswith('/api/v1/courses/1/users')]
+
+        # Only SIDs 0 through 2 are on the roster
+        with mock.patch.object(FakeCanvasHandler, 'num_students', 3):
+            self.assertTrue(upload())
+            grades = {grade.sid: grade.canvas_user_id
+                      for grade in CanvasGrade.query.filter_by(
+                          canvas_assignment_id=canvas_assignment.id)}
+            self.assertEqual(grades, {'1': 1, '2': 2, '3': None})
+
+            # A changed score for a student on the roster does not fetch it
+            score = self.score(self.user1, 'total', 8)
+            score.created = dt.datetime.now() + dt.timedelta(minutes=1)
+            db.session.commit()
+            self.assertEqual(upload(), [])
@@ -1,6 +1,6 @@
 from tests import OkTestCase
 
-from server.models import db, Enrollment, User
+from server.models import db, Course, Enrollment, User
 from server.forms import EnrollmentForm, BatchEnrollmentForm
 from server.constants import STUDENT_ROLE, LAB_ASSISTANT_ROLE
 
@@ -124,6 +124,94 @@ class TestEnrollment(OkTestCase):
         self.studentB['id'] = user_b.id
         self.enrollment_matches_info(user_b, self.studentB)
 
+    def test_create_bulk(self):
+        self.setup_course()
+
+        user = User(name=self.studentA['name'], email=self.studentA['email'])
+        db.session.add(user)
+        db.session.commit()
+        self.studentA['id'] = user.id
+        Enrollment.create(self.course.id, [self.studentA])
+
+        infos = [dict(self.studentB, email='student{}@example.com'.format(i))
+                 for i in range(30)]
+        created, updated = Enrollment.create(self.course.id,
+                                             [self.studentA] + infos)
+        assert (created, updated) == (30, 1)
+        assert Enrollment.query.filter_by(course=self.course).count() == 39
+
+        created, updated = Enrollment.create(self.course.id, infos[:5])
+        assert (created, updated) == (0, 5)
+        self.enrollment_matches_info(user, self.studentA)
+
+    def test_create_email_case(self):
+        self.setup_course()
+        upper = dict(self.studentA, email=self.studentA['email'].upper(),
+                     section='102')
+        created, updated = Enrollment.create(self.course.id,
+                                             [self.studentA, upper])
+        assert (created, updated) == (1, 0)
+        user = User.query.filter(db.func.lower(User.email) ==
+                                 self.studentA['email']).one()
+        self.enrollment_matches_info(user, dict(upper, id=user.id))
+
+    def test_create_updates_session(self):
+        self.setup_course()
+        enrollment = self.user1.participations[0]
+        assert enrollment.role == STUDENT_ROLE
+
+        # Check the session before the transaction is committed
+        create = Enrollment.create.__wrapped__
+        self.studentA.update(email=self.user1.email, role=LAB_ASSISTANT_ROLE)
+        created, updated = create(self.course.id, [self.studentA],
+                                  LAB_ASSISTANT_ROLE)
+        assert (created, updated) == (0, 1)
+        # Objects loaded before the bulk update see the new values
+        assert enrollment.role == LAB_ASSISTANT_ROLE
+        assert enrollment.sid == self.studentA['sid']
+        assert self.user1.name == self.studentA['name']
+        assert [e.role for e in self.user1.participations] == [LAB_ASSISTANT_ROLE]
+
+    def test_create_invalidates_affected_users(self):
+        self.setup_course()
+        assert self.user1.is_enrolled(self.course.id)
+        assert not self.user1.is_enrolled(self.course.id, [LAB_ASSISTANT_ROLE])
+        assert self.user2.is_enrolled(self.course.id)
+
+        # Bypass the cache invalidation for another user
+        Enrollment.query.filter_by(user_id=self.user2.id).delete()
+        db.session.commit()
+        assert self.user2.is_enrolled(self.course.id)
+
+        self.studentA.update(email=self.user1.email, role=LAB_ASSISTANT_ROLE)
+        Enrollment.create(self.course.id, [self.studentA], LAB_ASSISTANT_ROLE)
+        assert self.user1.is_enrolled(self.course.id, [LAB_ASSISTANT_ROLE])
+        # Only the enrolled user's cache entries are cleared
+        assert self.user2.is_enrolled(self.course.id)
+
+    def test_create_invalidates_affected_course(self):
+        self.setup_course()
+        other = Course(offering='cal/cs61a/fa16', institution='UC Berkeley',
+                       display_name='CS 61A')
+        db.session.add(other)
+        db.session.commit()
+        assert self.user1.is_enrolled(self.course.id)
+        assert not self.user1.is_enrolled(other.id)
+
+        # Bypass the cache invalidation for the user's other course
+        Enrollment.query.filter_by(user_id=self.user1.id).delete()
+        db.session.commit()
+        assert self.user1.is_enrolled(self.course.id)
+
+        self.studentA.update(email=self.user1.email)
+        Enrollment.create(other.id, [self.studentA])
+        assert self.user1.is_enrolled(other.id)
+        # Only entries for the user in that course are cleared
+        assert self.user1.is_enrolled(self.course.id)
+
+        Enrollment.query.filter_by(user_id=self.user1.id).one().unenroll()
+        assert not self.user1.is_enrolled(other.id)
+
     def test_enroll_twice(self):
         self.setup_course()
 
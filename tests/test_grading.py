@@ -2,18 +2,22 @@ import csv
 import datetime
 import random
 from io import StringIO
+from unittest import mock
 
 import werkzeug.datastructures
 from werkzeug.exceptions import BadRequest
 
 from server.constants import SCORE_KINDS
-from server.models import db, Backup, Group, Message, GradingTask, Score
+from server.models import (db, Assignment, AssignmentStats, AssignmentStatsChange,
+                           Backup, Enrollment, Group, Message, GradingTask,
+                           Score, has_window_functions)
 import server.utils as utils
-from server import generate
+from server import autograder, generate
 from server import constants
 
 from tests import OkTestCase
 
+
 class TestGrading(OkTestCase):
     """Tests Grading/Queue Generation."""
     def setUp(self):
@@ -95,32 +99,165 @@ class TestGrading(OkTestCase):
         self.assertEquals(len(slow_submissions), len(course_subms_filtered))
         print("Running with {}".format(db.engine.name))
 
-        if db.engine.name == 'mysql':
-            query = self.assignment.mysql_course_submissions_query()
-            mysql_data = [d for d in query]
-            self.assertEquals(len(course_submissions), len(mysql_data))
-
-            has_submission = sorted(list(fs['user']['id'] for fs in course_submissions
-                                 if fs['backup']))
-            has_submission_slow = sorted(list(fs['user']['id'] for fs in slow_course_subms
-                                      if fs['backup']))
-            self.assertEquals(has_submission, has_submission_slow)
-
-            no_subm = sorted(list(fs['user']['id'] for fs in course_submissions
-                                 if not fs['backup']))
-            no_subm_slow = sorted(list(fs['user']['id'] for fs in slow_course_subms
-                                      if not fs['backup']))
-            self.assertEquals(no_subm, no_subm_slow)
-
-            backup = sorted(list(fs['backup']['id'] for fs in course_submissions
-                                 if fs['backup']))
-            backup_slow = sorted(list(fs['backup']['id'] for fs in slow_course_subms
-                                      if fs['backup']))
-
-            self.assertEquals(backup, backup_slow)
-        else:
-            self.assertEquals(slow_course_subms, course_submissions)
+        self.assertEquals(slow_course_subms, course_submissions)
+
+
+    def test_course_submissions_window(self):
+        if not has_window_functions(db.engine):
+            self.skipTest('{} has no window functions'.format(db.engine.name))
+
+        random.seed(61)
+        students = [self.make_student(n) for n in range(6, 30)]
+        db.session.commit()
+        # Distinct times, since ties between backups have no defined order
+        minutes = iter(random.sample(range(10000), 200))
+        for assign in self.active_assignments:
+            remaining = list(students)
+            random.shuffle(remaining)
+            while len(remaining) > 1 and generate.gen_bool(0.7):
+                sender = remaining.pop()
+                for _ in range(random.randrange(1, assign.max_group_size)):
+                    if remaining:
+                        Group.force_add(self.staff1, sender, remaining.pop(), assign)
+            for student in students:
+                for _ in range(random.randrange(4)):
+                    backup = Backup(submitter=student, assignment=assign,
+                                    submit=generate.gen_bool(0.3))
+                    backup.created = assign.due_date - datetime.timedelta(
+                        minutes=next(minutes))
+                    db.session.add(backup)
+            db.session.commit()
+            for student in students:
+                if generate.gen_bool(0.5):
+                    member_ids = assign.active_user_ids(student.id)
+                    backup = assign.backups(member_ids).first()
+                    if backup:
+                        assign.flag(backup.id, member_ids)
+
+            slow = assign.course_submissions_slow()
+            self.assertEquals(slow, assign.course_submissions_window())
+            self.assertEquals(slow, assign.course_submissions())
+            self.assertEquals(assign.course_submissions_slow(include_empty=False),
+                              assign.course_submissions_window(include_empty=False))
+
+    def test_grading_view_queries(self):
+        backup = Backup.query.filter_by(submitter=self.user1).first()
+        self.login(self.staff1.email)
+        with self.record_queries() as queries:
+            response = self.client.get('/admin/grading/{}'.format(backup.hashid))
+        self.assert_200(response)
+        self.assertEqual(sum('group_member' in q for q in queries), 1)
+
+    def assert_stats_reconciled(self, assignment):
+        incremental = AssignmentStats.lookup(assignment.id)
+        AssignmentStats.reconcile(assignment.id)
+        self.assertEqual(incremental, AssignmentStats.lookup(assignment.id))
+
+    def test_assignment_stats(self):
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual(stats, {
+            'submissions': 15,
+            'backups': 15,
+            'groups': 1,
+            'unique_submissions': 2,
+            'students_with_subm': 3,
+            'students_with_backup': 0,
+            'students_no_backup': 2,
+            'percent_started': 60.0,
+            'percent_finished': 60.0,
+            'active_groups': 1,
+            'percent_groups_active': 1.0,
+        })
+
+        AssignmentStats.reconcile(self.assignment.id)
+        # Submitting only saves a change, without locking the counters' row
+        db.session.add(Backup(submitter=self.user4, assignment=self.assignment))
+        db.session.add(Backup(submitter=self.user5, assignment=self.assignment,
+                              submit=True))
+        with self.record_queries() as queries:
+            db.session.commit()
+        self.assertFalse(any('UPDATE assignment_stats' in q for q in queries))
+        changes = AssignmentStatsChange.query.filter_by(assignment_id=self.assignment.id)
+        self.assertEqual(changes.count(), 1)
+        self.assert_stats_reconciled(self.assignment)
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual((stats['backups'], stats['submissions']), (17, 16))
+        self.assertEqual((stats['students_with_subm'], stats['students_with_backup'],
+                          stats['students_no_backup']), (4, 1, 0))
+
+        backup = Backup.query.filter_by(submitter=self.user4).one()
+        self.assignment.flag(backup.id, [self.user4.id])
+        self.assertEqual(AssignmentStats.apply_changes(), [])
+        self.assertEqual(changes.count(), 0)
+        self.assert_stats_reconciled(self.assignment)
+
+        # Group changes are counted as they are made
+        Group.invite(self.user3, self.user4, self.assignment)
+        Group.lookup(self.user3, self.assignment).accept(self.user4)
+        pending = AssignmentStatsChange.pending(self.assignment.id)
+        self.assertEqual((pending['stale'], pending['groups'],
+                          pending['active_groups']), (0, 1, 1))
+        self.assert_stats_reconciled(self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.remove(self.user1, self.user2)
+        self.assert_stats_reconciled(self.assignment)
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual((stats['groups'], stats['active_groups'],
+                          stats['unique_submissions']), (1, 1, 4))
+
+        # Enrollment changes mark the counters as stale, for reconcile_stats
+        Enrollment.query.filter_by(user_id=self.user5.id,
+                                   course_id=self.course.id).one().unenroll()
+        with self.record_queries() as queries:
+            stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertFalse(any(q.startswith(('INSERT', 'UPDATE', 'DELETE'))
+                             for q in queries))
+        self.assertEqual(stats['students_with_subm'], 5)
+        self.assertIn(self.assignment.id, AssignmentStats.apply_changes())
+        AssignmentStats.reconcile(self.assignment.id)
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual((stats['students_with_subm'], stats['students_no_backup']),
+                         (4, 0))
+        self.assertEqual(changes.count(), 0)
+
+    def test_assignment_stats_view(self):
+        self.login(self.staff1.email)
+        url = '/admin/course/{}/assignments/{}/stats'.format(self.course.id,
+                                                            self.assignment.id)
+        AssignmentStats.reconcile(self.assignment.id)
+        with self.record_queries() as queries:
+            self.assert_200(self.client.get(url))
+        self.assertFalse(any('final_submission' in q for q in queries))
+        response = self.client.get(url + '/submissions')
+        self.assert_200(response)
+        self.assertIn(self.user1.email, response.get_data(as_text=True))
 
+    def test_autograde_backup_callback(self):
+        self.assignment.autograding_key = 'secret'
+        db.session.commit()
+        backup = Backup.query.filter_by(submitter=self.user1).first()
+        self.login(self.staff1.email)
+        with mock.patch.object(autograder, 'send_autograder',
+                               return_value={'jobs': ['abc']}) as send:
+            self.client.post('/admin/grading/{}/autograde'.format(backup.hashid))
+        endpoint, data = send.call_args[0]
+        self.assertEqual(data['callback_url'],
+                         'http://localhost/api/v3/autograder/results/')
+
+    def test_scored_backups(self):
+        backups = self.assignment.submissions(self.active_user_ids).all()
+        start = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        assert autograder.scored_backups([b.id for b in backups], start) == set()
+
+        for backup in backups[:2]:
+            score = Score(backup_id=backup.id, kind="total", score=1.0,
+                          message="Good work", assignment_id=self.assignment.id,
+                          user_id=backup.submitter_id, grader=self.staff1)
+            db.session.add(score)
+        db.session.commit()
+        assert autograder.scored_backups([b.id for b in backups], start) == \
+            {backups[0].id, backups[1].id}
+        assert autograder.scored_backups([], start) == set()
 
     def test_flag(self):
         submission = self.assignment.submissions(self.active_user_ids).all()[10]
@@ -188,6 +325,37 @@ class TestGrading(OkTestCase):
         self.assertEquals(len(backup_creators), len(csv_rows) - 1)
 
 
+    def test_score_export_rows(self):
+        backup = Backup.query.filter_by(submitter_id=self.user1.id, submit=True).first()
+        score = Score(backup_id=backup.id, kind="Composition", score=2.0,
+                      message="Good work", assignment_id=self.assignment.id,
+                      user_id=backup.submitter_id, grader=self.staff1)
+        db.session.add(score)
+        archived = Score(backup_id=backup.id, kind="total", score=1.0,
+                         message="Old", assignment_id=self.assignment.id,
+                         user_id=backup.submitter_id, grader=self.staff1,
+                         archived=True)
+        db.session.add(archived)
+        db.session.commit()
+
+        self.login(self.staff1.email)
+        response = self.client.get('/admin/course/1/assignments/1/scores')
+        self.assert_200(response)
+        rows = list(csv.DictReader(StringIO(str(response.data, 'utf-8'))))
+
+        # One row for each member of the group, all sharing the same score
+        group = [self.user1.email, self.user2.email]
+        self.assertEquals([row['email'] for row in rows], group)
+        for row in rows:
+            self.assertEquals(row['group'], str(group))
+            self.assertEquals(row['kind'], 'Composition')
+            self.assertEquals(row['score'], '2.0')
+            self.assertEquals(row['backup_id'], utils.encode_id(backup.id))
+            self.assertEquals(row['grader'], self.staff1.email)
+            self.assertEquals(row['is_late'], str(backup.is_late))
+            self.assertEquals(row['time'],
+                              utils.local_time(backup.created, self.course))
+
     def test_publish_grades(self):
         scores, users = {}, [self.user1, self.user3]
         for score_kind in ['total', 'composition']:
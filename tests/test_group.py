@@ -172,6 +172,25 @@ class TestGroup(OkTestCase):
         self.assertRaises(BadRequest, group.remove, self.user2, self.user3)
         self.assertRaises(BadRequest, group.remove, self.user3, self.user2)
 
+    def test_active_user_ids(self):
+        assignment = self.assignment
+        Group.invite(self.user1, self.user2, assignment)
+        group = Group.lookup(self.user1, assignment)
+        user1, user2 = self.user1.id, self.user2.id
+        assert assignment.active_user_ids(user1) == {user1}
+
+        group.accept(self.user2)
+        assignment.id  # reload the assignment after the commit
+        with self.record_queries() as queries:
+            assert assignment.active_user_ids(user1) == {user1, user2}
+            # Looked up once for both members in the same request
+            assert assignment.active_user_ids(user2) == {user1, user2}
+        assert len(queries) == 1
+
+        group.remove(self.user1, self.user2)
+        assert assignment.active_user_ids(user1) == {user1}
+        assert assignment.active_user_ids(user2) == {user2}
+
     def test_log(self):
         def latest_action():
             return GroupAction.query.order_by(GroupAction.id.desc()).first()
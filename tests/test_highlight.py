@@ -103,3 +103,29 @@ class TestHighlight(OkTestCase):
             assert source_lines[line.line_after - 1] == striptags(line.contents)
 
         assert source_lines == [line.contents for line in highlighted]
+
+    def test_highlight_cache(self):
+        source = self.files['before.py']
+        highlighted = highlight.highlight('before.py', source)
+
+        # Cached results are served from memory, and then from the shared
+        # cache, without running pygments again
+        pygments_highlight = highlight.pygments.highlight
+        highlight.pygments.highlight = None
+        try:
+            assert highlight.highlight('before.py', source) == highlighted
+            highlight.local_cache.clear()
+            assert highlight.highlight('before.py', source) == highlighted
+        finally:
+            highlight.pygments.highlight = pygments_highlight
+
+    def test_lru_cache(self):
+        lru = highlight.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        assert lru.get('a') == 1
+        lru.set('c', 3)
+        # 'b' was the least recently used
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
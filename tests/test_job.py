@@ -1,8 +1,47 @@
-from server import jobs
-from server.jobs import example
-from server.models import db, Job
+import collections
+import csv
+import io
+import json
+import logging
+import tarfile
+import time
+from unittest import mock
+import zipfile
+
+from flask_rq import get_connection, get_queue
+import redis.exceptions
+import rq
+
+from server import autograder, jobs
+from server.jobs import example, export, similarity
+from server.controllers.api import make_backup
+from server.models import (db, Backup, ExternalFile, Fingerprint,
+                           FingerprintCount, Group, Job, JobLogChunk, Message)
 from tests import OkTestCase
 
+ORIGINAL = (
+    'def hog(dice, goal):\n'
+    '    total = 0\n'
+    '    while total < goal:\n'
+    '        roll = dice()\n'
+    '        if roll == 1:\n'
+    '            return 1\n'
+    '        total += roll\n'
+    '    return total\n')
+COPIED = (
+    '# my own work\n'
+    'def pig(d, limit):\n'
+    '    s = 0\n'
+    '    while s < limit:\n'
+    '        r = d()  # roll\n'
+    '        if r == 1:\n'
+    '            return 1\n'
+    '        s += r\n'
+    '    return s\n')
+DIFFERENT = (
+    'def swine(scores):\n'
+    '    return max(scores) - min(scores) > 10 or [x for x in scores if x]\n')
+
 class TestJob(OkTestCase):
     def setUp(self):
         super(TestJob, self).setUp()
@@ -20,6 +59,24 @@ class TestJob(OkTestCase):
         response = self.client.get('/rq/')
         self.assert_200(response)
 
+    def test_queue_stats_access(self):
+        self.app.config['QUEUE_STATS_TOKEN'] = 'secret'
+        self.addCleanup(self.app.config.pop, 'QUEUE_STATS_TOKEN')
+        response = self.client.get('/rq/stats.json')
+        self.assertRedirects(response, '/login/')
+        response = self.client.get('/rq/stats.json',
+                                   headers={'Authorization': 'Bearer wrong'})
+        self.assertRedirects(response, '/login/')
+
+        # Services send the token instead of logging in
+        response = self.client.get('/rq/stats.json',
+                                   headers={'Authorization': 'Bearer secret'})
+        self.assert_200(response)
+        self.assertEqual(set(response.json), set(jobs.WORKER_QUEUES))
+        # The token only gives access to the stats
+        response = self.client.get('/rq/', headers={'Authorization': 'Bearer secret'})
+        self.assertRedirects(response, '/login/')
+
     def start_test_job(self, should_fail=False):
         job = jobs.enqueue_job(
             example.test_job,
@@ -56,3 +113,472 @@ class TestJob(OkTestCase):
         self.assertIn('Job failed', job.log)
         self.assertIn('Traceback', job.log)
         self.assertIn('ZeroDivisionError', job.log)
+
+    def test_job_queues(self):
+        self.assertEqual(example.test_job.queue, jobs.DEFAULT_QUEUE)
+        self.assertEqual(autograder.autograde_assignment.queue, 'bulk')
+        self.assertEqual(similarity.check_similarity.queue, 'bulk')
+        with self.assertRaises(ValueError):
+            jobs.background_job(queue='nonexistent')(example.test_job)
+        # Retired queues are only drained, not used for new jobs
+        with self.assertRaises(ValueError):
+            jobs.background_job(queue='default')(example.test_job)
+
+        # Jobs queued before the queues were split still run
+        job = jobs.create_job(example.test_job, description='Test Job',
+                              course_id=self.course.id, user_id=self.admin.id)
+        get_queue('default').enqueue_call(func=example.test_job, job_id=str(job.id))
+        self.run_jobs()
+        self.assertEqual(Job.query.get(job.id).status, 'finished')
+
+    def test_singleton_job(self):
+        def start(user, duration=0):
+            return jobs.enqueue_job(example.test_singleton_job,
+                                    description='Test Singleton Job',
+                                    course_id=self.course.id,
+                                    user_id=user.id,
+                                    duration=duration)
+
+        first = start(self.admin)
+        self.assertEqual(start(self.staff1).id, first.id)
+        other = start(self.admin, duration=1)
+        self.assertNotEqual(other.id, first.id)
+
+        self.run_jobs()
+        self.assertEqual(Job.query.get(first.id).status, 'finished')
+        self.assertEqual(Job.query.get(other.id).status, 'finished')
+        self.assertNotEqual(start(self.admin).id, first.id)
+
+        # A lock left behind by a job that finished without releasing it
+        # does not block new jobs
+        stale = start(self.admin, duration=2)
+        stale.status = 'finished'
+        db.session.commit()
+        self.assertNotEqual(start(self.admin, duration=2).id, stale.id)
+
+        # Neither does the lock of a queued job that is no longer in its queue
+        lost = start(self.admin, duration=3)
+        rq.job.Job.fetch(str(lost.id), connection=get_connection()).delete()
+        self.assertNotEqual(start(self.staff1, duration=3).id, lost.id)
+        lost = Job.query.get(lost.id)
+        self.assertEqual(lost.status, 'finished')
+        self.assertTrue(lost.failed)
+
+    def test_db_error_job(self):
+        job = jobs.enqueue_job(example.test_db_error_job, description='Test Job',
+                               course_id=self.course.id, user_id=self.admin.id)
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertTrue(job.failed)
+        self.assertIn('Starting...', job.log)
+        self.assertIn('IntegrityError', job.log)
+        self.assertEqual(JobLogChunk.query.count(), 0)
+
+    def test_job_log_flush_interval(self):
+        job = jobs.create_job(example.test_job, description='Test Job',
+                              course_id=self.course.id, user_id=self.admin.id)
+        stream = io.StringIO()
+        handler = jobs.JobLogHandler(stream, job, flush_interval=0.01)
+        logger = logging.getLogger('tests.job_{}'.format(job.id))
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        handler.start()
+        try:
+            logger.info('first')
+            for _ in range(100):
+                if JobLogChunk.query.count():
+                    break
+                time.sleep(0.01)
+            self.assertEqual(job.read_log(), ('first\n', 6))
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+    def test_job_log_chunks(self):
+        job = jobs.create_job(example.test_job, description='Test Job',
+                              course_id=self.course.id, user_id=self.admin.id)
+        job.status = 'running'
+        db.session.commit()
+        stream = io.StringIO()
+        handler = jobs.JobLogHandler(stream, job, flush_interval=60, flush_size=20)
+        logger = logging.getLogger('tests.job_{}'.format(job.id))
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+
+        logger.info('first')
+        self.assertEqual(JobLogChunk.query.count(), 0)
+        self.assertEqual(job.read_log(), ('', 0))
+        logger.info('second line that is long')
+        self.assertEqual(JobLogChunk.query.count(), 1)
+        log, offset = job.read_log()
+        self.assertEqual(log, 'first\nsecond line that is long\n')
+
+        for i in range(3):
+            logger.info('more output {}'.format(i))
+        self.assertEqual(job.read_log(offset), ('more output 0\nmore output 1\n', 59))
+        self.assertEqual(job.read_log(59), ('', 59))
+        handler.append_chunk()
+        self.assertEqual(job.read_log(59), ('more output 2\n', 73))
+        self.assertEqual(job.read_log(6)[0], 'second line that is long\n' +
+                         ''.join('more output {}\n'.format(i) for i in range(3)))
+
+        self.login(self.staff1.email)
+        response = self.client.get('/admin/course/{}/jobs/{}/log?offset=59'.format(
+            self.course.id, job.id))
+        self.assert_200(response)
+        self.assertEqual(response.json, {'log': 'more output 2\n', 'offset': 73,
+                                         'status': 'running'})
+
+        job.status = 'finished'
+        job.log = handler.contents
+        db.session.commit()
+        self.assertEqual(job.read_log(59), ('more output 2\n', 73))
+        response = self.client.get(
+            '/admin/course/{}/jobs/{}/'.format(self.course.id, job.id))
+        self.assert_200(response)
+        self.assertIn('more output 2', response.data.decode('utf-8'))
+
+    def test_job_events_finished(self):
+        job = jobs.create_job(example.test_job, description='Test Job',
+                              course_id=self.course.id, user_id=self.admin.id)
+        job.status = 'finished'
+        job.log = 'Starting...\nFinished!\n'
+        db.session.commit()
+
+        self.login(self.staff1.email)
+        url = '/admin/course/{}/jobs/{}/events'.format(self.course.id, job.id)
+        response = self.client.get(url + '?offset=12')
+        self.assert_200(response)
+        self.assertEqual(response.json, {'log': 'Finished!\n', 'offset': 22,
+                                         'status': 'finished', 'failed': False,
+                                         'progress': None})
+
+    def test_job_events_running(self):
+        job = jobs.create_job(example.test_job, description='Test Job',
+                              course_id=self.course.id, user_id=self.admin.id)
+        job.status = 'running'
+        db.session.commit()
+
+        # Nothing has happened yet, and the endpoint does not wait for news
+        self.login(self.staff1.email)
+        url = '/admin/course/{}/jobs/{}/events'.format(self.course.id, job.id)
+        start = time.time()
+        response = self.client.get(url)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(response.json, {'log': '', 'offset': 0, 'status': 'running',
+                                         'failed': False, 'progress': None})
+
+        # The job logs something and reports progress
+        db.session.add(JobLogChunk(job_id=job.id, start=0, end=12,
+                                   contents='Starting...\n'))
+        db.session.commit()
+        progress = {'type': 'progress', 'done': 1, 'total': 4, 'eta': 30}
+        key = jobs.job_progress_key(job.id)
+        get_connection().set(key, json.dumps(progress), ex=60)
+        self.addCleanup(get_connection().delete, key)
+        response = self.client.get(url + '?offset=0')
+        self.assertEqual(response.json, {'log': 'Starting...\n', 'offset': 12,
+                                         'status': 'running', 'failed': False,
+                                         'progress': progress})
+
+    def test_fan_out(self):
+        job = jobs.fan_out(
+            example.test_shard,
+            [[1, 2], [3], [4, 5, 6]],
+            example.test_gather,
+            description='Test Fan Out',
+            course_id=self.course.id,
+            user_id=self.admin.id,
+        )
+        self.assertEqual(job.name, 'test_gather')
+        self.assertEqual(len(job.children), 3)
+        self.assertEqual(job.children[1].description, 'Test Fan Out (shard 2 of 3)')
+
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertFalse(job.failed)
+        self.assertEqual([child.result for child in job.children], ['3', '3', '15'])
+        self.assertEqual(job.result, '21')
+        self.assertIn('Adding 3 numbers', job.log)
+        self.assertIn('Total: 21', job.log)
+
+    def test_fan_out_failure(self):
+        job = jobs.fan_out(
+            example.test_shard,
+            [[1, 2], []],
+            example.test_gather,
+            description='Test Fan Out',
+            course_id=self.course.id,
+            user_id=self.admin.id,
+            should_fail=True,
+        )
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertTrue(job.failed)
+        self.assertEqual(job.result, None)
+        self.assertIn('1 of 2 shards failed', job.log)
+        self.assertIn('ZeroDivisionError', job.log)
+
+    def test_fan_out_dead_shard(self):
+        job = jobs.fan_out(
+            example.test_shard,
+            [[1, 2], [3]],
+            example.test_gather,
+            description='Test Fan Out',
+            course_id=self.course.id,
+            user_id=self.admin.id,
+        )
+        # The worker running the first shard is killed
+        dead = rq.job.Job.fetch(str(job.children[0].id), connection=get_connection())
+        get_queue(dead.origin).remove(dead)
+        dead.set_status(rq.job.JobStatus.FAILED)
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'running')
+        # A finished shard is only counted once
+        jobs.shard_finished(job.children[1])
+        self.assertEqual(Job.query.get(job.id).status, 'running')
+
+        self.login(self.staff1.email)
+        response = self.client.get('/admin/course/{}/jobs/{}/'.format(
+            self.course.id, job.id))
+        self.assert_200(response)
+        db.session.expire_all()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertTrue(job.failed)
+        self.assertIn('1 of 2 shards failed', job.log)
+        self.assertIn('The worker running this shard died', job.log)
+
+    def test_fan_out_enqueue_failure(self):
+        enqueue_call = rq.Queue.enqueue_call
+
+        def fail_first_shard(queue, *args, **kwargs):
+            if kwargs['args'][0] == [1, 2]:
+                raise redis.exceptions.ConnectionError('Connection refused')
+            return enqueue_call(queue, *args, **kwargs)
+
+        with mock.patch.object(rq.Queue, 'enqueue_call', fail_first_shard):
+            job = jobs.fan_out(
+                example.test_shard,
+                [[1, 2], [3]],
+                example.test_gather,
+                description='Test Fan Out',
+                course_id=self.course.id,
+                user_id=self.admin.id,
+            )
+        self.assertTrue(job.children[0].failed)
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertTrue(job.failed)
+        self.assertIn('1 of 2 shards failed', job.log)
+        self.assertIn('Could not connect to Redis', job.log)
+
+    def test_export_archive(self):
+        Group.force_add(self.staff1, self.user1, self.user2, self.assignment)
+        files = {}
+        for user in (self.user1, self.user3):
+            backup = Backup(submitter=user, assignment=self.assignment, submit=True)
+            backup.messages = [Message(kind='file_contents', contents={
+                'hog.py': 'print("{}")'.format(user.email),
+                'tests/q1.py': 'assert True',
+                '../escape.py': 'oops',
+                'submit': True,
+            })]
+            db.session.add(backup)
+            db.session.commit()
+            files[backup.hashid + '/hog.py'] = 'print("{}")'.format(user.email)
+            files[backup.hashid + '/tests/q1.py'] = 'assert True'
+
+        data = b''.join(export.final_submissions_archive(self.assignment, 'zip'))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = set(archive.namelist())
+            self.assertEqual(names, set(files) | {'manifest.csv'})
+            for name, contents in files.items():
+                self.assertEqual(archive.read(name).decode('utf-8'), contents)
+            manifest = archive.read('manifest.csv').decode('utf-8')
+        rows = list(csv.DictReader(io.StringIO(manifest)))
+        self.assertEqual(len(rows), 2)
+        emails = {row['emails'] for row in rows}
+        self.assertEqual(emails, {
+            ', '.join(sorted([self.user1.email, self.user2.email])),
+            self.user3.email,
+        })
+
+        data = b''.join(export.final_submissions_archive(self.assignment, 'tgz'))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as archive:
+            self.assertEqual(set(archive.getnames()), set(files) | {'manifest.csv'})
+            for name, contents in files.items():
+                self.assertEqual(archive.extractfile(name).read().decode('utf-8'),
+                                 contents)
+
+        # Backups without file contents are still listed in the manifest
+        empty = Backup(submitter=self.user4, assignment=self.assignment, submit=True)
+        db.session.add(empty)
+        db.session.commit()
+        data = b''.join(export.final_submissions_archive(self.assignment, 'zip'))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            manifest = archive.read('manifest.csv').decode('utf-8')
+        rows = {row['backup_id']: row for row in csv.DictReader(io.StringIO(manifest))}
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[empty.hashid]['files'], '')
+        self.assertEqual(rows[empty.hashid]['emails'], self.user4.email)
+
+    def test_export_job(self):
+        backup = Backup(submitter=self.user1, assignment=self.assignment, submit=True)
+        backup.messages = [Message(kind='file_contents', contents={'hog.py': 'pass'})]
+        db.session.add(backup)
+        db.session.commit()
+        url = '/admin/course/{}/assignments/{}/submissions.tgz'.format(
+            self.course.id, self.assignment.id)
+
+        # A student upload with the same name is not an export
+        name = export.archive_name(self.assignment, 'tgz')
+        ExternalFile.upload([b'not an archive'], user_id=self.user1.id,
+                            name=name, course_id=self.course.id,
+                            assignment_id=self.assignment.id, prefix='uploads/')
+        self.assertIsNone(export.latest_archive(self.assignment, 'tgz'))
+
+        self.login(self.staff1.email)
+        response = self.client.get(url)
+        self.assertRedirects(response, '/admin/course/{}/assignments/{}'.format(
+            self.course.id, self.assignment.id))
+
+        job = jobs.enqueue_job(
+            export.export_final_submissions,
+            description='Export submissions',
+            course_id=self.course.id,
+            user_id=self.staff1.id,
+            assignment_id=self.assignment.id,
+            kind='tgz',
+            result_kind='html')
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertFalse(job.failed)
+
+        archive = export.latest_archive(self.assignment, 'tgz')
+        self.assertTrue(archive.staff_file)
+        self.assertTrue(archive.filename.endswith('-submissions.tar.gz'))
+        self.assertEqual(archive.mimetype, 'application/gzip')
+        self.assertIn(archive.download_link, job.result)
+        response = self.client.get(url)
+        self.assertRedirects(response, archive.download_link)
+
+        self.login(self.user1.email)
+        response = self.client.get(url)
+        self.assertNotIn(archive.download_link, response.location or '')
+
+    def test_similarity(self):
+        # Renamed variables and added comments do not hide copying
+        self.assertEqual(
+            [t for t, _ in similarity.tokenize(ORIGINAL, 'python')],
+            [t for t, _ in similarity.tokenize(COPIED, 'python')])
+
+        backups = {}
+        for user, source in ((self.user1, ORIGINAL), (self.user2, COPIED),
+                             (self.user3, DIFFERENT)):
+            backup = Backup(submitter=user, assignment=self.assignment, submit=True)
+            backup.messages = [Message(kind='file_contents', contents={
+                'hog.py': source, 'README': 'hello'})]
+            db.session.add(backup)
+            db.session.commit()
+            backups[user.id] = backup.id
+
+        owners = self.assignment.final_submission_owners()
+        documents = similarity.submission_fingerprints(
+            self.assignment, owners, 'python', file_regex=r'.*\.py')
+        matches = similarity.compare(documents)
+        self.assertEqual(len(matches), 1)
+        # Code shared by more than max_shared submissions is ignored
+        self.assertEqual(similarity.compare(documents, max_shared=1), [])
+        match = matches[0]
+        self.assertEqual({match['a'], match['b']},
+                         {backups[self.user1.id], backups[self.user2.id]})
+        self.assertEqual(match['a_fraction'], 1)
+        self.assertEqual(match['b_fraction'], 1)
+        self.assertTrue(all(filename == 'hog.py' for filename, _ in match['a_lines']))
+
+        report = similarity.html_report(matches, owners)
+        self.assertIn(self.user1.email, report)
+        self.assertNotIn(self.user3.email, report)
+
+        # Code from the template is not evidence of copying
+        self.assignment.files = {'hog.py': ORIGINAL}
+        db.session.commit()
+        documents = similarity.submission_fingerprints(
+            self.assignment, owners, 'python', file_regex=r'.*\.py')
+        self.assertEqual(similarity.compare(documents), [])
+
+    def test_winnowing(self):
+        tokens = [(str(i % 7), i) for i in range(100)]
+        selected = similarity.fingerprints(tokens, k=3, window=4)
+        hashes = [similarity.fingerprints(tokens[i:i + 3], k=3, window=1)
+                  for i in range(len(tokens) - 2)]
+        # Every window of 4 consecutive k-grams contributes a fingerprint
+        for i in range(len(hashes) - 3):
+            window = set().union(*hashes[i:i + 4])
+            self.assertTrue(window & set(selected))
+        self.assertEqual(similarity.fingerprints(tokens[:2], k=3), {})
+
+    def test_fingerprint_index(self):
+        def submit(user, source, submit=True):
+            return make_backup(user, self.assignment.id, {
+                'file_contents': {'hog.py': source, 'README': 'hello'}}, submit)
+
+        original = submit(self.user1, ORIGINAL)
+        earlier = submit(self.user1, ORIGINAL)
+        copied = submit(self.user2, COPIED)
+        different = submit(self.user3, DIFFERENT)
+        draft = submit(self.user4, COPIED, submit=False)
+        self.assertEqual(Fingerprint.query.count(), 0)
+        self.run_jobs()
+
+        indexed = {f.backup_id for f in Fingerprint.query}
+        self.assertEqual(indexed, {original.id, earlier.id, copied.id, different.id})
+        self.assertTrue(all(f.filename == 'hog.py' for f in Fingerprint.query))
+        # Every indexed fingerprint is counted once
+        values = collections.Counter(f.value for f in Fingerprint.query)
+        self.assertEqual({c.value: c.backups for c in FingerprintCount.query},
+                         dict(values))
+
+        # A student's own submissions are not matches
+        matches = Fingerprint.top_matches(original)
+        self.assertEqual([b for b, _ in matches], [copied])
+        self.assertEqual(
+            Fingerprint.top_matches(original, course_ids=[self.course.id + 1]), [])
+        # Fingerprints in more than max_shared backups are ignored
+        self.assertEqual(Fingerprint.top_matches(original, max_shared=2), [])
+
+        self.login(self.staff1.email)
+        response = self.client.get('/admin/grading/{}'.format(original.hashid))
+        self.assert_200(response)
+        self.assertIn('Similar Submissions', response.data.decode('utf-8'))
+        self.assertIn(self.user2.email, response.data.decode('utf-8'))
+
+        # Backfill the index
+        Fingerprint.query.filter(Fingerprint.backup_id != original.id).delete()
+        db.session.commit()
+        self.assertEqual(similarity.index_submissions(), 3)
+        self.assertEqual(similarity.index_submissions(), 0)
+        self.assertEqual({f.backup_id for f in Fingerprint.query}, indexed)
+
+        # Backfill with a sharded job
+        Fingerprint.query.filter(Fingerprint.backup_id != original.id).delete()
+        db.session.commit()
+        response = self.client.post(
+            '/admin/course/{}/assignments/{}/similarity/index'.format(
+                self.course.id, self.assignment.id))
+        job = Job.query.filter_by(name='finish_index').one()
+        self.assertRedirects(response, '/admin/course/{}/jobs/{}/'.format(
+            self.course.id, job.id))
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'finished')
+        self.assertFalse(job.failed)
+        self.assertEqual(job.result, '3')
+        self.assertEqual({f.backup_id for f in Fingerprint.query}, indexed)
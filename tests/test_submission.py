@@ -1,7 +1,7 @@
 import datetime
 from werkzeug.exceptions import BadRequest
 
-from server.models import db, Backup, Group, Message
+from server.models import db, Backup, FileBlob, FinalSubmission, Group, Message
 
 from tests import OkTestCase
 
@@ -108,6 +108,47 @@ class TestSubmission(OkTestCase):
         assert final == most_recent
         assert not submission.flagged
 
+    def test_final_submission_table(self):
+        def stored():
+            return {fs.user_id: fs.backup_id for fs in
+                    FinalSubmission.query.filter_by(assignment_id=self.assignment.id)}
+
+        def expected():
+            return {uid: self.assignment.final_submission(
+                        self.assignment.active_user_ids(uid)).id
+                    for uid in self.active_user_ids}
+
+        # Spread out submission times so that the final submission is unique
+        for backup in Backup.query.all():
+            backup.created = self.assignment.due_date - datetime.timedelta(
+                minutes=backup.id)
+        db.session.commit()
+        assert stored() == expected()
+
+        submission = self.assignment.submissions([self.user1.id]).all()[3]
+        self.assignment.flag(submission.id, [self.user1.id])
+        assert stored()[self.user1.id] == submission.id
+        assert stored() == expected()
+
+        Group.invite(self.user1, self.user2, self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.accept(self.user2)
+        assert stored()[self.user2.id] == submission.id
+        assert stored() == expected()
+
+        group.remove(self.user1, self.user2)
+        assert stored()[self.user2.id] != submission.id
+        assert stored() == expected()
+
+        self.assignment.unflag(submission.id, [self.user1.id])
+        assert stored() == expected()
+
+        backup = Backup(submitter_id=self.user3.id, assignment=self.assignment,
+                        submit=True)
+        db.session.add(backup)
+        db.session.commit()
+        assert stored()[self.user3.id] == backup.id
+
     def test_unflag_not_flagged(self):
         submission = self.assignment.submissions(self.active_user_ids).all()[3]
         self.assertRaises(BadRequest, self.assignment.unflag, submission.id, self.active_user_ids)
@@ -152,6 +193,32 @@ class TestSubmission(OkTestCase):
             'hog.py': 'def foo():\n    return'
         }
 
+    def test_files_deduplicated(self):
+        files = {'hog.py': 'def foo():\n    return', 'submit': ''}
+        backups = []
+        for user in (self.user1, self.user2):
+            backup = Backup(submitter_id=user.id, assignment=self.assignment)
+            backup.messages = [Message(kind='file_contents', contents=files)]
+            db.session.add(backup)
+            backups.append(backup)
+        db.session.commit()
+        backup_ids = [b.id for b in backups]
+        db.session.remove()
+
+        # Identical files are stored once, no matter how many backups have them
+        digest = FileBlob.digest_of(files['hog.py'])
+        assert FileBlob.query.filter_by(digest=digest).count() == 1
+        for backup in Backup.query.filter(Backup.id.in_(backup_ids)):
+            message = backup.messages[0]
+            assert message.digests['hog.py'] == digest
+            assert message.contents == files
+            assert backup.files() == {'hog.py': 'def foo():\n    return'}
+        db.session.remove()
+
+        messages = Message.query.filter(Message.backup_id.in_(backup_ids)).all()
+        FileBlob.resolve_messages(messages)
+        assert all(m._files == files for m in messages)
+
     def test_backup_owners(self):
         backup = Backup(
             submitter_id=self.user1.id,
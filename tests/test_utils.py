@@ -33,6 +33,12 @@ class TestUtils(OkTestCase):
                           [20, 19, 20, 19, 20, 19, 20, 19, 20, 19, 20, 19, 19])
         self.assertEquals([len(x) for x in utils.chunks(range(960), 48)], [20] * 48)
 
+    def test_batches(self):
+        self.assertEquals([len(x) for x in utils.batches(range(45), 20)],
+                          [20, 20, 5])
+        self.assertEquals(list(utils.batches(range(4), 2)), [[0, 1], [2, 3]])
+        self.assertEquals(list(utils.batches([], 20)), [])
+
     def test_time(self):
         self.setup_course()
         # UTC Time
@@ -48,13 +54,6 @@ class TestUtils(OkTestCase):
         localized = eastern.localize(time)
         self.assertEquals(utils.local_time(localized, self.course), 'Wed 01/20 09:01 AM')
 
-    def test_generate_number_table(self):
-        results = {i: utils.generate_number_table(i) for i in range(1, 4)}
-
-        self.assertEquals(results[1], "SELECT 1 as pos")
-        self.assertEquals(results[2], "SELECT 1 as pos UNION SELECT 2 as pos")
-        self.assertEquals(results[3], "SELECT 1 as pos UNION SELECT 2 as pos UNION SELECT 3 as pos")
-
     def test_humanize_name(self):
         test_corpus = (
                 ("", ""),
@@ -1,21 +1,78 @@
 #!/usr/bin/env python3
+""" Start a pool of workers for each job queue.
+
+    ./worker.py                       # use WORKER_CONCURRENCY, or one per queue
+    ./worker.py interactive=2 bulk=4  # two interactive workers, four bulk workers
+
+Queues not given a count get no workers. Workers that die are restarted.
+"""
+import multiprocessing
 import os
+import signal
+import sys
+import time
 
 from flask_rq import get_worker
 from raven import Client
 from raven.transport.http import HTTPTransport
 from rq.contrib.sentry import register_sentry
 
-from server import create_app
+from server import create_app, jobs
 
-if __name__ == '__main__':
-    # default to dev config
-    env = os.environ.get('OK_ENV', 'dev')
+RESTART_INTERVAL = 5  # how often to check for dead workers, in seconds
+
+def parse_concurrency(specs):
+    """ Parse specs like 'bulk=4' into a dict of queue name -> number of
+    workers.
+    """
+    concurrency = {}
+    for spec in specs:
+        name, _, count = spec.partition('=')
+        if name not in jobs.WORKER_QUEUES:
+            raise ValueError('Unknown queue {}'.format(name))
+        concurrency[name] = int(count or 1)
+    return concurrency
+
+def run_worker(env, queue):
     app = create_app('settings/{0!s}.py'.format(env))
     with app.app_context():
-        worker = get_worker()
+        worker = get_worker(queue)
         sentry_dsn = os.getenv('SENTRY_DSN')
         if sentry_dsn:
             client = Client(sentry_dsn, transport=HTTPTransport)
             register_sentry(client, worker)
         worker.work()
+
+def start_worker(env, queue):
+    process = multiprocessing.Process(target=run_worker, args=(env, queue),
+                                      name='{}-worker'.format(queue))
+    process.start()
+    return process
+
+if __name__ == '__main__':
+    # default to dev config
+    env = os.environ.get('OK_ENV', 'dev')
+    specs = sys.argv[1:] or os.environ.get('WORKER_CONCURRENCY', '').split()
+    concurrency = parse_concurrency(specs) or {name: 1 for name in jobs.WORKER_QUEUES}
+
+    processes = [(queue, start_worker(env, queue))
+                 for queue, count in concurrency.items()
+                 for _ in range(count)]
+
+    def stop(signum, frame):
+        # Workers finish their current job before exiting on SIGTERM
+        for _, process in processes:
+            process.terminate()
+        for _, process in processes:
+            process.join()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        time.sleep(RESTART_INTERVAL)
+        for i, (queue, process) in enumerate(processes):
+            if not process.is_alive():
+                print('{} exited with {}, restarting'.format(process.name,
+                                                             process.exitcode))
+                processes[i] = (queue, start_worker(env, queue))